@@ -1 +1,11 @@
+import os
+import sys
+
+# the modules import each other by their bare names, as when run from this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if sys.argv[1:2] == ['record']:
+    import record
+    sys.exit(record.main(sys.argv[2:]))
+
 import gui
@@ -0,0 +1,223 @@
+"""Talking to a DAQ board from an asyncio event loop (Python 3.6 and later, Posix).
+
+AsyncCommPort is the asyncio counterpart of comm.CommPort:
+rather than a reading thread and an Event per command,
+the serial port's file descriptor is registered with the event loop
+(loop.add_reader), so any number of boards can share one loop and one thread.
+        comm = AsyncCommPort('/dev/ttyACM0')
+        await comm.connect()
+        model = await comm.command(b'M')
+        await comm.command(b'C', config_bytes)
+        await comm.command(b'G')
+        async for payloads in comm.batches():
+            ...
+The framing is the same as CommPort's (see the PROTOCOL comments in core.py),
+done by the same FrameParser, and the data payloads can be decoded
+with a core.PacketDecoder.
+"""
+
+import os
+import sys
+import errno
+import asyncio
+
+from getports import ports
+from getports.posixser import Serial
+from comm import CommPort, FrameParser, command_frame, tostr
+
+_int_E = ord(b'E')
+
+
+class AsyncCommPort(object):
+    BAUDRATE = CommPort.BAUDRATE
+    READ_CHUNK = CommPort.READ_CHUNK    # maximum number of bytes requested per read
+    COMMAND_TIMEOUT = 5         # seconds to wait for a command response before resending
+
+    def __init__(self, port, call_on_error=lambda x: None, call_on_fault=None,
+                 max_batches=None, loop=None):
+        """port: name of the serial port
+        call_on_error is called with the message of each error ('E') packet.
+        If call_on_fault is given, it is called with 'checksum', 'framing',
+        or 'timeout' for each damaged frame, resynchronization, or command timeout.
+        If max_batches is given, at most that many batches of data payloads
+        wait to be read from batches(); further batches are discarded
+        (and counted in num_dropped) until there is room again.
+        """
+        self.portname = port
+        self.ser = None
+        self.num_dropped = 0    # data payloads discarded because max_batches were waiting
+        self.read_calls = 0     # number of reads done by _readable
+        self._call_on_error = call_on_error
+        self._call_on_fault = call_on_fault
+        self._loop = loop
+        self._parser = FrameParser()
+        self._max_batches = max_batches
+        # the queue and lock are made by connect(), in the loop that will use them
+        # (before Python 3.10 they bind to the current loop when made)
+        self._batches = None
+        self._response = None   # Future for the response to the current command
+        self._command_lock = None
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    async def connect(self):
+        """Open the port (resetting the DAQ board), checking that it isn't
+        a Leonardo bootloader, as CommPort._reset does,
+        and start reading from it in the event loop.
+        """
+        before = ports()
+        s1 = Serial(self.portname, baudrate=self.BAUDRATE, timeout=1)
+        await asyncio.sleep(0.1)
+        s1.write(b'E')  # end leonardo bootloader
+        await asyncio.sleep(1)
+        new_ports = set(ports()) - set(before)
+        if new_ports:
+            # the bootloader has handed over to the Leonardo's own port
+            s1.close()
+            self.portname = tostr(new_ports.pop()[1])
+            self.ser = Serial(self.portname, baudrate=self.BAUDRATE, timeout=1)
+            await asyncio.sleep(0.1)
+        else:
+            self.ser = s1
+            await asyncio.sleep(0.6)
+        self._batches = asyncio.Queue(self._max_batches or 0)
+        self._command_lock = asyncio.Lock()
+        self.loop.add_reader(self.ser.fd, self._readable)
+
+    def _readable(self):
+        """Read everything waiting on the port (called by the event loop),
+        handing complete frames to _batch and _oncommand.
+        """
+        fd = self.ser.fd
+        parser = self._parser
+        while True:
+            try:
+                self.read_calls += 1
+                chunk = os.read(fd, self.READ_CHUNK)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    self._fail(e)
+                return
+            if not chunk:
+                return
+            parser.feed(chunk)
+            parser.parse_batch(self._batch, self._oncommand, self._call_on_fault)
+            if len(chunk) < self.READ_CHUNK:
+                return
+
+    def _batch(self, payloads):
+        try:
+            self._batches.put_nowait(payloads)
+        except asyncio.QueueFull:
+            self.num_dropped += len(payloads)
+
+    def _oncommand(self, cm, data):
+        """Handle a complete, checksummed '!' frame from the board.
+        cm is the integer command byte, data the bytes of the response.
+        """
+        if cm == _int_E:
+            self._call_on_error(data)
+            return
+        response = self._response
+        if response is None or response.done():
+            return      # e.g. the second response to 'S', sent once the queue empties
+        response.set_result((cm, data))
+
+    def _fail(self, exc):
+        """Stop reading after an error on the port, passing it to any waiting command."""
+        self.loop.remove_reader(self.ser.fd)
+        if self._response is not None and not self._response.done():
+            self._response.set_exception(exc)
+        self._end_batches()
+
+    async def _write(self, data):
+        """Write all of data, waiting in the event loop while the port is full."""
+        fd = self.ser.fd
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                writable = self.loop.create_future()
+                self.loop.add_writer(fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(fd)
+
+    async def command(self, c, d=b''):
+        """Send command c (a single-character byte string)
+        together with data d (a byte string)
+        and return the data from the response (a byte string).
+        Commands from different tasks are sent one at a time.
+        Like CommPort.command, a command that gets no response
+        within COMMAND_TIMEOUT seconds is sent again.
+        """
+        msg = command_frame(c, d)
+        async with self._command_lock:
+            while True:
+                self._response = self.loop.create_future()
+                await self._write(msg)
+                try:
+                    cm, res = await asyncio.wait_for(self._response, self.COMMAND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print('Warning: Command timeout for command {}'.format(c), file=sys.stderr)
+                    if self._call_on_fault is not None:
+                        self._call_on_fault('timeout')
+                    continue
+                finally:
+                    self._response = None
+                if cm == ord(c):
+                    return res
+                print('Warning: Invalid command response: sent {} command, response is {} {}'
+                      .format(c, chr(cm), res), file=sys.stderr)
+
+    async def batches(self):
+        """Yield lists of data payloads, in the order they arrived,
+        one list per read of the port, until close().
+        """
+        while True:
+            payloads = await self._batches.get()
+            if payloads is None:
+                return
+            yield payloads
+
+    async def packets(self):
+        """Yield the payload (bytes) of each data packet, until close()."""
+        async for payloads in self.batches():
+            for payload in payloads:
+                yield payload
+
+    def close(self):
+        """Stop reading, close the port, and end batches() and packets()."""
+        if self.ser is None:
+            return
+        self.loop.remove_reader(self.ser.fd)
+        self.ser.close()
+        self.ser = None
+        if self._response is not None and not self._response.done():
+            self._response.cancel()
+        self._end_batches()
+
+    def _end_batches(self):
+        """Queue the marker that ends batches(), making room for it if need be."""
+        try:
+            self._batches.put_nowait(None)
+        except asyncio.QueueFull:
+            self.num_dropped += len(self._batches.get_nowait())
+            self._batches.put_nowait(None)
+
+    def counters(self):
+        """Return a dict of reader statistics, as CommPort.counters() does."""
+        parser = self._parser
+        return dict(reads=self.read_calls,
+                syscalls=None,
+                packets=parser.num_packets,
+                checksum_errors=parser.checksum_errors,
+                framing_errors=parser.framing_errors)
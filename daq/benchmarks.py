@@ -0,0 +1,874 @@
+"""Benchmarks for the host side of PteroDAQ.
+
+Run from the daq directory as
+        python benchmarks.py NAME [arguments]
+where NAME is one of the benchmarks listed by
+        python benchmarks.py
+No board is needed: serial traffic is simulated through a pseudo-terminal.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import struct
+import errno
+import signal
+import codecs
+import tempfile
+from threading import Thread
+from timeit import default_timer as clock
+try:
+    from time import process_time
+except ImportError:     # Python 2
+    from time import clock as process_time
+
+from getports.posixser import Serial
+from comm import FrameParser, command_frame
+from boards import getboardinfo
+from core import ChannelDescriptor, Interpretation, TriggerTimed, PacketDecoder, \
+        DataAcquisition, firmware_version
+from store import SampleStore
+from stream import SampleStream
+from export import TextRecording
+from binfile import BinaryRecording, BinaryReader
+from capture import CaptureFile, Replay, READ, WRITE
+
+
+def data_frame(payload):
+    """Wrap payload (bytes) in a '*' data frame with length and checksum."""
+    frame = bytearray(b'*')
+    frame.append(len(payload))
+    frame.extend(payload)
+    frame.append(-sum(frame) % 256)
+    return bytes(frame)
+
+def timed_payloads(num_packets, num_analog):
+    """Return a list of num_packets timed-trigger payloads,
+    each with a 4-byte serial number and num_analog analog readings.
+    """
+    fmt = struct.Struct('<L' + 'H'*num_analog)
+    return [fmt.pack(n, *[(n*(k+1)) & 0xffff for k in range(num_analog)])
+            for n in range(num_packets)]
+
+class PtyLink(object):
+    """A pseudo-terminal with a Serial port open on the slave side.
+    send() writes bytes into the master side from a background thread,
+    so that the Serial port sees them as if sent by a board.
+    """
+    def __init__(self):
+        self.master, self._slave = os.openpty()
+        self.ser = Serial(os.ttyname(self._slave))
+
+    def send(self, data, chunk=4096):
+        def writer():
+            for start in range(0, len(data), chunk):
+                os.write(self.master, data[start:start+chunk])
+        t = Thread(target=writer)
+        t.daemon = True
+        t.start()
+        return t
+
+    def close(self):
+        self.ser.close()
+        os.close(self._slave)
+        os.close(self.master)
+
+
+def _legacy_read_packets(ser, num_packets):
+    """The reader used before FrameParser:
+    separate reads for the header, the payload, and the checksum of each packet.
+    """
+    rd = ser.read
+    got = 0
+    while got < num_packets:
+        first_two = bytearray(rd(2))
+        if len(first_two) < 2:
+            continue
+        c, ln = first_two
+        data = bytearray(rd(ln))
+        chk = bytearray(rd(1))
+        if chk and (c + ln + sum(data) + chk[0]) % 256 == 0:
+            got += 1
+
+def _chunked_read_packets(ser, num_packets):
+    """The reader CommPort._readin uses on ports without readinto():
+    large reads, copied into a FrameParser.
+    """
+    parser = FrameParser()
+    payloads = []
+    on_data = payloads.append
+    while parser.num_packets < num_packets:
+        chunk = ser.read_some(4096)
+        if chunk:
+            parser.feed(chunk)
+            parser.parse(on_data, None)
+
+def _readinto_read_packets(ser, num_packets):
+    """The reader CommPort._readin uses on ports with readinto():
+    large reads straight into the FrameParser's buffer,
+    payloads delivered as views of it.
+    """
+    parser = FrameParser()
+    runs = []
+    on_batch = runs.append
+    while parser.num_packets < num_packets:
+        if parser.readinto(ser.readinto, 4096):
+            parser.parse_batch(on_batch, None, None, False)
+            del runs[:]
+
+def bench_allocations(num_packets=100000, num_analog=4):
+    """Objects allocated per packet, and packet rate, reading and framing
+    with copies (read_some, feed, payloads as bytes)
+    or without (readinto, payloads as views of the FrameParser's buffer).
+    Allocations are counted as the growth of sys.getallocatedblocks()
+    from just before each read to the delivery of its payloads,
+    so they include the chunk read, the payloads, and the lists holding them.
+    """
+    num_packets = int(num_packets)
+    stream = b''.join(data_frame(p) for p in timed_payloads(num_packets, int(num_analog)))
+    print('allocations: {0} packets, {1} bytes'.format(num_packets, len(stream)))
+    blocks = sys.getallocatedblocks
+    for name, copy in (('copying', True), ('readinto', False)):
+        link = PtyLink()
+        ser = link.ser
+        parser = FrameParser()
+        counts = [0, 0, 0]      # blocks allocated before each read, packets, blocks allocated
+        def on_batch(payloads):
+            counts[1] += len(payloads)
+            counts[2] += blocks() - counts[0]
+        writer = link.send(stream)
+        start = clock()
+        while parser.num_packets < num_packets:
+            counts[0] = blocks()
+            if copy:
+                chunk = ser.read_some(4096)
+                if chunk:
+                    parser.feed(chunk)
+                    parser.parse_batch(on_batch, None)
+            elif parser.readinto(ser.readinto, 4096):
+                parser.parse_batch(on_batch, None, None, False)
+        elapsed = clock() - start
+        writer.join()
+        print('  {0:8s} {1:7.3f} allocations/packet {2:10.0f} packets/sec'.format(
+                name, counts[2]/counts[1], num_packets/elapsed))
+        link.close()
+
+def bench_framing(num_packets=20000, num_analog=4):
+    """Compare system calls per packet and packet rate for
+    the legacy per-field reader and the chunked and readinto FrameParser readers.
+    """
+    num_packets = int(num_packets)
+    stream = b''.join(data_frame(p) for p in timed_payloads(num_packets, int(num_analog)))
+    print('framing: {0} packets, {1} bytes'.format(num_packets, len(stream)))
+    for name, reader in (('legacy', _legacy_read_packets),
+                         ('chunked', _chunked_read_packets),
+                         ('readinto', _readinto_read_packets)):
+        link = PtyLink()
+        writer = link.send(stream)
+        start = clock()
+        reader(link.ser, num_packets)
+        elapsed = clock() - start
+        writer.join()
+        print('  {0:8s} {1:7.3f} syscalls/packet {2:10.0f} packets/sec'.format(
+                name, link.ser.syscalls/num_packets, num_packets/elapsed))
+        link.close()
+
+
+def make_board(model_num=7, bandgap_reading=20000, khz=48000):
+    """Return a Board as set up by the M command of the given model
+    (default Teensy LC, about 3.3V supply, 48MHz)."""
+    return getboardinfo(struct.pack('<HHL', model_num, bandgap_reading, khz))
+
+def channel_mix(num_analog, num_digital, num_frequency):
+    """Return a list of ChannelDescriptors with the requested numbers
+    of analog, digital, and frequency channels, interleaved."""
+    channels = []
+    for n in range(max(num_analog, num_digital, num_frequency)):
+        if n < num_analog:
+            channels.append(ChannelDescriptor('A{0}'.format(n), 1 | (n << 8),
+                    Interpretation(True, False, False, 1, 1)))
+        if n < num_digital:
+            channels.append(ChannelDescriptor('D{0}'.format(n), 2 | (n << 8),
+                    Interpretation(False, False, False, 1, 1)))
+        if n < num_frequency:
+            channels.append(ChannelDescriptor('F{0}'.format(n), 3 | (n << 8),
+                    Interpretation(False, False, True, 1, 1)))
+    return channels
+
+def board_channel_mix(board, num_analog, num_digital, num_frequency):
+    """Like channel_mix, but using real pins of board (so the channels can be saved)."""
+    channels = []
+    for name, mux in board.analogs[:num_analog]:
+        channels.append(ChannelDescriptor(name, 1 | (mux << 8),
+                Interpretation(True, False, False, 1, board.gain_from_name[name])))
+    for name, pin in board.digitals[:num_digital]:
+        channels.append(ChannelDescriptor(name, 2 | (pin << 8),
+                Interpretation(False, False, False, 1, 1)))
+    pins = [pin for group in board.frequencies for pin in group]
+    for name, pin in pins[:num_frequency]:
+        channels.append(ChannelDescriptor(name, 3 | (pin << 8),
+                Interpretation(False, False, True, 1, 1)))
+    return channels
+
+def mixed_payloads(channels, num_packets):
+    """Return num_packets timed-trigger payloads for the given channels."""
+    fields = []
+    digcount = 0
+    for ch in channels:
+        if ch.interpretation.is_analog:
+            fields.append('H')
+        elif ch.interpretation.is_frequency:
+            fields.append('L')
+        else:
+            digcount += 1
+            if not (digcount % 8):
+                fields.append('B')
+    if digcount % 8:
+        fields.append('B')
+    fmt = struct.Struct('<L' + ''.join(fields))
+    limits = {'H': 0xffff, 'L': 100000, 'B': 0xff}
+    return [fmt.pack(n, *[(n*(k+7)) % limits[f] for k, f in enumerate(fields)])
+            for n in range(num_packets)]
+
+def _legacy_decode(payloads, channels, board, period):
+    """The decoder used before PacketDecoder (timed triggers only):
+    branches on the interpretation of every channel of every packet.
+    """
+    data = []
+    dead_time = board.frequency_dead_time
+    unpack_ts = struct.Struct('<L').unpack_from
+    unpack_unsigned = struct.Struct('<H').unpack_from
+    unpack_signed = struct.Struct('<h').unpack_from
+    unpack_count = struct.Struct('<L').unpack_from
+    interps = [ch.interpretation for ch in channels]
+    for rd in payloads:
+        results = [unpack_ts(rd)[0] * period] + [None] * len(interps)
+        pos = 4
+        digbuf = bytearray()
+        digcount = 0
+        for n, interp in enumerate(interps, 1):
+            if interp.is_analog:
+                results[n] = (unpack_signed if interp.is_signed else unpack_unsigned)(rd, pos)[0]
+                pos += 2
+            elif interp.is_frequency:
+                freq = unpack_count(rd, pos)[0]/period
+                dead_counts = freq * dead_time
+                if dead_counts > 1:
+                    freq += (dead_counts-1)/period
+                results[n] = freq
+                pos += 4
+            else:
+                digcount += 1
+                if not (digcount % 8):
+                    digbuf.append(rd[pos])
+                    pos += 1
+        if digcount % 8:
+            digbuf.append(rd[pos])
+        bitcount = 0
+        bufpos = 0
+        for n, res in enumerate(results):
+            if res is None:
+                results[n] = bool((digbuf[bufpos] >> bitcount) & 1)
+                bitcount += 1
+                if bitcount == 8:
+                    bitcount = 0
+                    bufpos += 1
+        data.append(results)
+    return data
+
+def bench_decode(num_packets=50000):
+    """Compare the legacy per-channel decoder with the compiled PacketDecoder
+    (and its NumPy batch decoder, if NumPy is installed)
+    for 1, 8, and 16 channel mixes.
+    """
+    num_packets = int(num_packets)
+    board = make_board()
+    mixes = (('1 analog', (1, 0, 0)),
+             ('8 mixed', (4, 3, 1)),
+             ('16 mixed', (8, 6, 2)))
+    print('decode: {0} packets per mix'.format(num_packets))
+    for name, mix in mixes:
+        channels = channel_mix(*mix)
+        payloads = mixed_payloads(channels, num_packets)
+        trigger = TriggerTimed(0.0001)
+        start = clock()
+        legacy = _legacy_decode(payloads, channels, board, trigger.period)
+        legacy_time = clock() - start
+        decoder = PacketDecoder(trigger, channels, board)
+        start = clock()
+        compiled = decoder.decode_batch(payloads)
+        compiled_time = clock() - start
+        # the compiled decoder leaves timestamps in ticks
+        assert legacy == [[row[0]*decoder.time_scale] + row[1:] for row in compiled]
+        report = '  {0:9s} legacy {1:9.0f}  compiled {2:9.0f}'.format(
+                name, num_packets/legacy_time, num_packets/compiled_time)
+        if decoder.dtype is not None:
+            start = clock()
+            for first in range(0, num_packets, 1000):
+                columns = decoder.decode_columns(payloads[first:first+1000])
+            numpy_time = clock() - start
+            columns[0] = columns[0] * decoder.time_scale
+            assert [list(col) for col in columns] == [list(col) for col in zip(*legacy[first:])]
+            report += '  numpy {0:9.0f}'.format(num_packets/numpy_time)
+        print(report + ' packets/sec')
+
+def bench_store(num_packets=100000):
+    """Compare memory per sample for a list of rows and the columnar SampleStore
+    (8 channel mix).
+    """
+    import tracemalloc      # Python 3.4 and later
+    num_packets = int(num_packets)
+    channels = channel_mix(4, 3, 1)
+    decoder = PacketDecoder(TriggerTimed(0.0001), channels, make_board())
+    payloads = mixed_payloads(channels, num_packets)
+    print('store: {0} samples of {1} channels'.format(num_packets, len(channels)))
+    for name in ('rows', 'columns'):
+        tracemalloc.start()
+        if name == 'rows':
+            kept = []
+            for start in range(0, num_packets, 1000):
+                kept.extend(decoder.decode_batch(payloads[start:start+1000]))
+        else:
+            kept = SampleStore(channels)
+            for start in range(0, num_packets, 1000):
+                kept.append_rows(decoder.decode_batch(payloads[start:start+1000]))
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  {0:8s} {1:7.1f} bytes/sample'.format(name, used/num_packets))
+        del kept
+
+def _sequence_cases(num_packets):
+    """Return (name, sequences, max_sequence for each batch of 1000) test cases
+    for GapIndex.check_sequence.
+    """
+    clean = list(range(num_packets))
+    ahead = [first + 1100 for first in range(0, num_packets, 1000)]
+    behind = [first + 500 for first in range(0, num_packets, 1000)]
+    gapped = [n for n in clean if n % 997]
+    damaged = [n ^ (1 << 20) if n % 1009 == 5 else n for n in clean]
+    restarts = [n % 30000 for n in clean]
+    return (('clean', clean, ahead),
+            ('past max', clean, behind),
+            ('gaps', gapped, ahead),
+            ('damaged', damaged, ahead),
+            ('restarts', restarts, [None]*len(ahead)))
+
+def bench_gaps(num_packets=200000):
+    """Time GapIndex.check_sequence on batches of 1000 sequence numbers,
+    clean and irregular, and check that it finds the same gaps and rejects
+    the same packets with and without its NumPy fast path.
+    """
+    from store import GapIndex
+    num_packets = int(num_packets)
+    print('gaps: {0} sequence numbers per case'.format(num_packets))
+    for name, sequences, limits in _sequence_cases(num_packets):
+        times = []
+        results = []
+        for check in (GapIndex.check_sequence, GapIndex._check_from):
+            gaps = GapIndex()
+            gaps.expect(0)
+            row = 0
+            rejected = []
+            start = clock()
+            for first, max_sequence in zip(range(0, num_packets, 1000), limits):
+                batch = sequences[first:first+1000]
+                dropped = check(gaps, row, batch, max_sequence)
+                rejected.extend(first + i for i in dropped)
+                row += len(batch) - len(dropped)
+            times.append(clock() - start)
+            results.append((rejected, gaps.gaps, gaps.counters, gaps.next_sequence))
+        assert results[0] == results[1], name
+        print('  {0:9s} check_sequence {1:9.0f}  pure Python {2:9.0f} packets/sec'
+              '  {3:6d} rejected  {4:6d} dropped'.format(
+                name, num_packets/times[0], num_packets/times[1],
+                len(results[0][0]), gaps.num_dropped()))
+
+def _legacy_write_rows(f, data, channels, convvolts, power_voltage):
+    """The row loop used by save() before TextRecording formatted rows in blocks:
+    a separate write for every timestamp, tab, and value.
+    """
+    old_time=0
+    time_offset=None
+    for d in zip(*[data.column(n) for n in range(len(channels)+1)]):
+        time=d[0]
+        if time_offset==None:
+            time_offset=time
+        if time<old_time:
+            time_offset=time
+            f.write('\n')
+        old_time=time
+        f.write('{0:.7f}'.format(time-time_offset))
+        for n, x in enumerate(d[1:]):
+            ch = channels[n]
+            f.write('\t')
+            if convvolts and ch.interpretation.is_analog:
+                f.write("{0:.6f}".format(ch.volts(x,power_voltage)))
+            elif ch.interpretation.is_frequency:
+                f.write("{0:.6f}".format(x))
+            else:
+                f.write(str(int(x)))
+        f.write('\n')
+
+def bench_export(num_rows=1000000):
+    """Compare export speed (MB/s) of the legacy per-field row loop,
+    TextRecording's block writer (8 channel mix, volts), and BinaryRecording.
+    """
+    num_rows = int(num_rows)
+    trigger = TriggerTimed(0.0001)
+    daq = DataAcquisition()
+    daq.board = make_board()
+    channels = board_channel_mix(daq.board, 4, 3, 1)
+    daq.channels = channels
+    daq.conf = (trigger, 'Power', 1, channels)
+    daq._data = SampleStore(channels)
+    decoder = PacketDecoder(trigger, channels, daq.board)
+    payloads = mixed_payloads(channels, 10000)
+    while len(daq._data) < num_rows:
+        daq._data.append_columns(decoder.decode_columns(
+                payloads[:num_rows-len(daq._data)], prev_tick=None))
+    print('export: {0} rows of {1} channels'.format(num_rows, len(channels)))
+    fd, fn = tempfile.mkstemp(suffix='.pdaq')
+    os.close(fd)
+    try:
+        for name in ('legacy', 'block', 'binary'):
+            start = clock()
+            if name == 'legacy':
+                with codecs.open(fn, 'w', 'utf-8') as f:
+                    _legacy_write_rows(f, daq._data, channels, True, daq.board.power_voltage)
+            else:
+                recording_class = BinaryRecording if name == 'binary' else TextRecording
+                recording = recording_class(fn, daq, '', True, daq.conf)
+                recording.write_rows()
+                recording.close()
+            elapsed = clock() - start
+            size = os.path.getsize(fn)
+            print('  {0:8s} {1:7.1f} MB/s {2:10.0f} rows/sec {3:7.1f} bytes/row'.format(
+                    name, size/elapsed/1e6, num_rows/elapsed, size/num_rows))
+        start = clock()
+        with BinaryReader(fn) as reader:
+            reader.chunks(1)[0][0]
+        print('  opening binary recording and reading a value: {0:.4f} sec'.format(
+                clock() - start))
+    finally:
+        os.remove(fn)
+
+def bench_stream(num_rows=200000, block_size=1024):
+    """Throughput and delivery latency of DataAcquisition.stream()
+    for each policy (8 channel mix, stored 64 packets at a time
+    as the serial reader does, with a consumer thread summing a channel).
+    """
+    from bisect import bisect_left
+    num_rows = int(num_rows)
+    block_size = int(block_size)
+    trigger = TriggerTimed(0.0001)
+    daq = DataAcquisition()
+    daq.board = make_board()
+    channels = board_channel_mix(daq.board, 4, 3, 1)
+    daq.channels = channels
+    daq.conf = (trigger, 'Power', '1', channels)
+    payloads = mixed_payloads(channels, num_rows)
+    print('stream: {0} rows of {1} channels, blocks of {2} rows'.format(
+            num_rows, len(channels), block_size))
+    for policy in SampleStream.POLICIES:
+        daq._decoder = PacketDecoder(trigger, channels, daq.board)
+        daq._data = daq._new_store(channels, trigger)
+        daq._data.gaps.expect(0)
+        stream = daq.stream(block_size, max_blocks=4, policy=policy)
+        stored = []         # (rows stored after each batch, time it arrived)
+        latencies = []
+        def consume():
+            total = 0
+            for block in stream:
+                now = clock()
+                total += sum(block.columns[1])
+                k = bisect_left(stored, (block.stop,))
+                latencies.append(now - stored[k][1])
+        consumer = Thread(target=consume)
+        consumer.start()
+        start = clock()
+        for first in range(0, num_rows, 64):
+            stored.append((min(first+64, num_rows), clock()))
+            daq._parsedata_batch(payloads[first:first+64])
+        stream.flush()
+        stream.close()
+        consumer.join()
+        elapsed = clock() - start
+        latencies.sort()
+        print('  {0:12s} {1:9.0f} rows/sec  {2:7d} dropped'
+              '  latency median {3:6.2f} ms  max {4:6.2f} ms'.format(
+                policy, num_rows/elapsed, stream.num_dropped,
+                latencies[len(latencies)//2]*1e3, latencies[-1]*1e3))
+
+def write_capture(fn, model, conf, payloads, chunk=4096):
+    """Write a capture file of a run on a board whose 'M' response is model:
+    the handshake, configuration conf, go, the data packets with the given payloads
+    (read chunk bytes at a time), and stop.
+    """
+    class SentCommand(object):
+        def command(self, c, d=b''):
+            self.sent = d
+    daq = DataAcquisition()
+    daq.board = getboardinfo(model)
+    daq.comm = SentCommand()
+    daq.config(conf)        # only to get the configuration bytes sent
+    capture = CaptureFile(fn)
+    now = [0.]          # capture time: each exchange takes a millisecond
+    def exchange(c, request=b'', response=b''):
+        now[0] += 0.001
+        capture.record(WRITE, command_frame(c, request), now[0])
+        capture.record(READ, command_frame(c, response), now[0])
+    capture.record(WRITE, b'E', 0.)     # CommPort's Leonardo check
+    exchange(b'H', response=b'DAQ')
+    exchange(b'V', response=firmware_version)
+    exchange(b'M', response=model)
+    exchange(b'C', daq.comm.sent)
+    exchange(b'G')
+    frames = [data_frame(payload) for payload in payloads]
+    data = b''.join(frames)
+    # each chunk arrives as its last complete packet is taken, one every period
+    ends = []
+    end = 0
+    for frame in frames:
+        end += len(frame)
+        ends.append(end)
+    period = conf[0].period if isinstance(conf[0], TriggerTimed) else 0.0001
+    packets = 0
+    for start in range(0, len(data), chunk):
+        while packets < len(ends) and ends[packets] <= start + chunk:
+            packets += 1
+        capture.record(READ, data[start:start+chunk], now[0] + packets*period)
+    now[0] += len(payloads)*period
+    exchange(b'S')
+    exchange(b'M', response=model)
+    capture.close()
+
+def bench_replay(num_packets=200000, speed=None):
+    """End-to-end rate replaying a capture file through CommPort, FrameParser,
+    PacketDecoder, and the store (8 channel mix), with no board attached.
+    speed is the multiple of the captured speed (default: as fast as possible).
+    """
+    from threading import Event
+    num_packets = int(num_packets)
+    speed = float(speed) if speed is not None else None
+    model = struct.pack('<HHL', 7, 20000, 48000)
+    board = getboardinfo(model)
+    channels = board_channel_mix(board, 4, 3, 1)
+    conf = (TriggerTimed(0.0001), 'Power', '1', channels)
+    fd, fn = tempfile.mkstemp(suffix='.cap')
+    os.close(fd)
+    try:
+        write_capture(fn, model, conf, mixed_payloads(channels, num_packets))
+        print('replay: {0} packets of {1} channels, {2:.1f} MB captured'.format(
+                num_packets, len(channels), os.path.getsize(fn)/1e6))
+        replay = Replay(fn, speed)
+        daq = DataAcquisition()
+        daq.serial_class = replay.serial_class()
+        connected = Event()
+        daq.connect('replay', lambda fail: connected.set())
+        connected.wait()
+        daq.config(conf)
+        start = clock()
+        daq.go()
+        while len(daq.data()) < num_packets:
+            replay.finished.wait(0.01)
+        elapsed = clock() - start
+        daq.stop()
+        print('  {0:9.0f} packets/sec  {1} reads  {2} dropped'.format(
+                num_packets/elapsed, daq.comm.read_calls, daq.gaps().num_dropped()))
+    finally:
+        os.remove(fn)
+
+def bench_handoff(num_packets=100000, stall_ms=20, stall_every=20):
+    """Reading-thread responsiveness with a decoder that stalls,
+    decoding in the reading thread or through a PacketQueue with each policy.
+    Every stall_every batches the decoder stalls for stall_ms milliseconds
+    (as when the GUI holds the interpreter); the longest time the port goes unread
+    is what a real board's buffer must ride out.
+    """
+    from threading import Event
+    from time import sleep
+    num_packets = int(num_packets)
+    stall = float(stall_ms) / 1000
+    stall_every = int(stall_every)
+    model = struct.pack('<HHL', 7, 20000, 48000)
+    board = getboardinfo(model)
+    channels = board_channel_mix(board, 4, 3, 1)
+    conf = (TriggerTimed(0.0001), 'Power', '1', channels)
+    fd, fn = tempfile.mkstemp(suffix='.cap')
+    os.close(fd)
+    try:
+        write_capture(fn, model, conf, mixed_payloads(channels, num_packets), chunk=1024)
+        print('handoff: {0} packets, decoder stalls {1} ms every {2} batches'.format(
+                num_packets, stall_ms, stall_every))
+        for queue_size, policy in ((None, None), (16384, 'block'),
+                                   (4096, 'drop-oldest'), (4096, 'drop-newest')):
+            replay = Replay(fn)
+            read_times = []
+            def open_port(port, **args):
+                ser = replay.serial_class()(port, **args)
+                readinto = ser.readinto
+                def timed_readinto(buffer):
+                    read_times.append(clock())
+                    return readinto(buffer)
+                ser.readinto = timed_readinto
+                return ser
+            daq = DataAcquisition()
+            daq.serial_class = open_port
+            daq.queue_size = queue_size
+            daq.queue_policy = policy or 'block'
+            parse = daq._parsedata_batch
+            batches = [0]
+            def stalling_parse(payloads):
+                batches[0] += 1
+                if batches[0] % stall_every == 0:
+                    sleep(stall)
+                parse(payloads)
+            daq._parsedata_batch = stalling_parse
+            connected = Event()
+            daq.connect('replay', lambda fail: connected.set())
+            connected.wait()
+            daq.config(conf)
+            start = clock()
+            first_read = len(read_times)
+            daq.go()
+            daq.stop()      # returns once everything before the 'S' response is decoded
+            elapsed = clock() - start
+            times = read_times[first_read:]
+            longest = max(b - a for a, b in zip(times, times[1:]))
+            counters = daq.comm.counters()
+            print('  {0:12s} {1:9.0f} packets/sec  longest unread {2:7.2f} ms'
+                  '  high water {3:>6}  overflows {4:>6}  dropped {5:6d}'.format(
+                    policy or 'inline', num_packets/elapsed, longest*1e3,
+                    counters.get('queue_high_water', '-'), counters.get('queue_overflows', '-'),
+                    daq.gaps().num_dropped()))
+    finally:
+        os.remove(fn)
+
+def _legacy_write(ser, d):
+    """Serial.write as it was: retrying the write at once on EAGAIN."""
+    remaining = len(d)
+    while remaining:
+        try:
+            ser.syscalls += 1
+            remaining -= os.write(ser.fd, d[-remaining:])
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+def bench_write(num_commands=2000, drain_rate=50000):
+    """CPU time writing commands into a saturated link, and the share
+    of the interpreter left to another thread, for the legacy write
+    (retrying at once on EAGAIN) and Serial.write (waiting in select
+    for the port to drain).
+    The far end (another process) reads only drain_rate bytes/sec, in 1 ms slices,
+    so the port's output buffer stays full, while another thread computes;
+    its progress is compared with its progress alone.
+    """
+    from time import sleep
+    try:
+        from time import thread_time
+    except ImportError:     # before Python 3.7: the process's time includes the other threads'
+        thread_time = process_time
+    num_commands = int(num_commands)
+    drain_rate = float(drain_rate)
+    msg = command_frame(b'C', bytes(bytearray(range(250))))
+    done = [False]
+    progress = [0]
+    def compute():
+        while not done[0]:
+            sum(range(1000))
+            progress[0] += 1
+    worker = Thread(target=compute)
+    worker.daemon = True
+    worker.start()
+    sleep(1)
+    alone = progress[0]
+    done[0] = True
+    worker.join()
+    print('write: {0} commands of {1} bytes, link drained at {2:.0f} bytes/sec'.format(
+            num_commands, len(msg), drain_rate))
+    for name in ('legacy', 'select'):
+        link = PtyLink()
+        ser = link.ser
+        write = ser.write if name == 'select' else lambda d: _legacy_write(ser, d)
+        fill = bytes(bytearray(4096))
+        while True:             # fill the port's output buffer
+            try:
+                os.write(ser.fd, fill)
+            except OSError:
+                break
+        drainer = os.fork()     # a process of its own, so it never waits for the interpreter
+        if drainer == 0:
+            try:
+                while True:
+                    os.read(link.master, int(drain_rate/1000))
+                    sleep(0.001)
+            finally:
+                os._exit(0)
+        done[0] = False
+        progress[0] = 0
+        worker = Thread(target=compute)
+        worker.daemon = True
+        worker.start()
+        syscalls = ser.syscalls
+        start, cpu = clock(), thread_time()
+        for n in range(num_commands):
+            write(msg)
+        elapsed, cpu = clock() - start, thread_time() - cpu
+        done[0] = True
+        worker.join()
+        os.kill(drainer, signal.SIGKILL)
+        os.waitpid(drainer, 0)
+        print('  {0:7s} {1:6.2f} s  {2:6.2f} s CPU writing  {3:7.1f} syscalls/command'
+              '  other thread at {4:3.0f}% of its speed alone'.format(
+                name, elapsed, cpu, (ser.syscalls - syscalls)/num_commands,
+                100*progress[0]/elapsed/alone))
+        link.close()
+
+def _serve_emulator(model, port_queue, done):
+    """Run a BoardEmulator until done is set (in a process of its own)."""
+    from emulator import BoardEmulator
+    emulator = BoardEmulator(model)
+    emulator.start()
+    port_queue.put(emulator.port)
+    done.wait()
+    emulator.close()
+
+def bench_isolation(rate=20000, seconds=3, hold_ms=50):
+    """Samples lost by an emulated board while the host process is busy,
+    acquiring in that process or in an AcquisitionProcess.
+    A thread of the host process keeps computing, holding the interpreter
+    for up to hold_ms milliseconds at a time (like a slow GUI redraw).
+    """
+    import multiprocessing
+    from threading import Event
+    from time import sleep
+    from core import TriggerTimed, channel_for_pin
+    from procacq import AcquisitionProcess
+    rate, seconds, hold = float(rate), float(seconds), float(hold_ms) / 1000
+    context = multiprocessing.get_context('spawn')
+    port_queue, done = context.Queue(), context.Event()
+    board_process = context.Process(target=_serve_emulator, args=(7, port_queue, done))
+    board_process.start()
+    port = port_queue.get()
+    print('isolation: emulated Teensy LC on {0}, {1:.0f} samples/sec for {2} s,'
+          ' host busy in {3} ms slices'.format(port, rate, seconds, hold_ms))
+    switch_interval = sys.getswitchinterval()
+    try:
+        for where in ('child', 'in-process'):     # a child closes its port on exit
+            if where == 'child':
+                daq = AcquisitionProcess()
+                daq.connect(port)
+            else:
+                daq = DataAcquisition()
+                connected = Event()
+                daq.connect(port, lambda fail: connected.set())
+                connected.wait()
+            board = daq.board
+            channels = [channel_for_pin(board, pin, pin) for pin in ('A0', 'A1', 'A2', 'A3')]
+            daq.config((TriggerTimed(1./rate), board.aref[0][0], None, channels))
+            busy = [True]
+            def compute():
+                total = 0
+                while busy[0]:
+                    total += sum(range(1000))
+            hog = Thread(target=compute)
+            sys.setswitchinterval(hold)
+            hog.start()
+            daq.go()
+            sleep(seconds)
+            busy[0] = False
+            hog.join()
+            sys.setswitchinterval(switch_interval)
+            daq.stop()
+            num_rows, gaps = len(daq.data()), daq.gaps()
+            if where == 'child':
+                daq.close()
+            print('  {0:12s} {1:8d} samples  {2:7d} lost in {3:5d} gaps'.format(
+                    where, num_rows, gaps.num_dropped(), len(gaps)))
+    finally:
+        sys.setswitchinterval(switch_interval)
+        done.set()
+        board_process.join()
+
+
+def bench_latency(command='I', num_commands=1000, port=None):
+    """Command round-trip time (p50, p99, max) with and without the serial
+    driver's low-latency flag, sending command ('I': one reading, as when
+    polling a sensor, or 'H': the handshake) num_commands times,
+    to the board on port or to an emulated Teensy LC.
+    The flag only matters on a driver that accepts it (see the last column):
+    the emulator's pseudo-terminal does not, so against it the two runs
+    differ only by noise.
+    """
+    import multiprocessing
+    from threading import Event
+    from core import channel_for_pin
+    num_commands = int(num_commands)
+    board_process = done = None
+    if port is None:
+        context = multiprocessing.get_context('spawn')
+        port_queue, done = context.Queue(), context.Event()
+        board_process = context.Process(target=_serve_emulator, args=(7, port_queue, done))
+        board_process.start()
+        port = port_queue.get()
+    print('latency: {0} {1} commands to {2}'.format(num_commands, command, port))
+    try:
+        for name, low_latency in (('default', False), ('low-latency', True)):
+            daq = DataAcquisition()
+            daq.low_latency = low_latency
+            connected = Event()
+            daq.connect(port, lambda fail: connected.set())
+            connected.wait()
+            if command == 'I':
+                board = daq.board
+                send = daq.oneread
+                daq.config((TriggerTimed(0.001), board.aref[0][0], None,
+                            [channel_for_pin(board, 'A0', 'A0')]))
+            else:
+                send = lambda: daq.comm.command(command.encode('ascii'))
+            times = []
+            for n in range(num_commands):
+                start = clock()
+                send()
+                times.append(clock() - start)
+            times.sort()
+            driver = getattr(daq.comm.ser, 'low_latency', None)
+            print('  {0:12s} p50 {1:7.3f} ms  p99 {2:7.3f} ms  max {3:7.3f} ms'
+                  '  (driver low-latency flag {4})'.format(name,
+                    times[len(times)//2]*1e3, times[int(len(times)*0.99)]*1e3, times[-1]*1e3,
+                    {True: 'set', False: 'not set', None: '-'}[driver]))
+            comm = daq.comm         # release the port for the next mode
+            comm._do_readin = False
+            comm._readthread.join()
+            comm.ser.close()
+    finally:
+        if board_process is not None:
+            done.set()
+            board_process.join()
+
+
+benchmarks = dict(
+    allocations=bench_allocations,
+    decode=bench_decode,
+    export=bench_export,
+    framing=bench_framing,
+    gaps=bench_gaps,
+    handoff=bench_handoff,
+    isolation=bench_isolation,
+    latency=bench_latency,
+    replay=bench_replay,
+    store=bench_store,
+    stream=bench_stream,
+    write=bench_write,
+    )
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('usage: python benchmarks.py NAME [arguments]', file=sys.stderr)
+        for name in sorted(benchmarks):
+            print('  {0:12s} {1}'.format(name,
+                    benchmarks[name].__doc__.split('\n')[0]), file=sys.stderr)
+        sys.exit(2)
+    benchmarks[sys.argv[1]](*sys.argv[2:])
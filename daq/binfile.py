@@ -0,0 +1,459 @@
+"""Binary recording files (.pdaq).
+
+A binary recording holds the same information as a text recording,
+but stores the raw samples in fixed-width columns,
+so it is several times smaller, much faster to write,
+and can be opened without parsing:
+a reader maps the file into memory and views each chunk's columns in place.
+
+Layout (all integers little-endian):
+        MAGIC (8 bytes)
+        header length (uint32), then the header: UTF-8 JSON, padded to 8 bytes
+        chunks, one after the other, each:
+                CHUNK_MAGIC (8 bytes), then as uint64: first row, number of rows,
+                then seconds per tick (float64),
+                then, as uint64, the number of samples of each channel,
+                then the chunk's columns
+        chunk index: for each chunk, as uint64: offset (of its columns),
+                then its header as above, from first row on
+        gap list: UTF-8 JSON
+        trailer: offset of chunk index (uint64), number of chunks (uint64), INDEX_MAGIC
+
+The header records the configuration (trigger, analog reference, averaging,
+channels with their probes and interpretations), board.power_voltage,
+the notes, and the typecode of each column:
+        'Q' uint64, 'd' float64, 'H' uint16, 'h' int16, or '?' (bits, packed 8 per byte,
+        low-order bit first).
+Column 0 holds the timestamps and column n channel n, as in store.SampleStore.
+Timestamps are kept exact, as the ticks the board sent ('Q', or 'd' if
+written by Python 2); the chunk index gives the seconds per tick of each chunk,
+and a chunk never spans a change of scale.
+
+Each channel is stored at its own rate: a downsampled channel
+has only the samples taken at rows that are multiples of its downsampling.
+A chunk holding rows f up to f+r has r timestamps,
+then for each channel its s samples from those rows
+(s bits for '?' columns), followed, if s < r, by the s timestamps
+of those samples.  Each is padded to a multiple of 8 bytes.
+
+The chunk index and gap list are written when the recording is closed.
+The gap list is a JSON object
+with the lost samples, "gaps": [[sample, count, cause], ...]
+(sample numbered from the first in the file, as for store.GapIndex),
+and "counters": the numbers of checksum, framing, timeout, and overflow events.
+A file that was not closed (after a crash, say) has no index,
+but since each chunk describes itself, BinaryReader recovers
+the chunks written in full by following them from the header
+(the gap list is lost).  Version 1 files had no chunk headers,
+and can only be read if closed.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import io
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional; without it columns are memoryviews or arrays
+    np = None
+
+from store import TICKS64
+
+MAGIC = b'PteroDAQ'
+INDEX_MAGIC = b'PDQindex'
+CHUNK_MAGIC = b'PDQchunk'
+FORMAT_VERSION = 2
+EXTENSION = '.pdaq'
+
+_header_length = struct.Struct(str('<L'))
+_trailer = struct.Struct(str('<QQ8s'))
+
+_ITEMSIZE = {'Q': 8, 'd': 8, 'H': 2, 'h': 2}
+_NUMPY_TYPES = {'Q': '<u8', 'd': '<f8', 'H': '<u2', 'h': '<i2'}
+
+def _index_entry(num_channels):
+    """Struct for a chunk index entry (see above)."""
+    return struct.Struct(str('<QQQd' + 'Q'*num_channels))
+
+def _chunk_header(num_channels):
+    """Struct for a chunk header (see above)."""
+    return struct.Struct(str('<8sQQd' + 'Q'*num_channels))
+
+def is_binary_filename(fn):
+    """Should fn be saved in the binary format (judging by its extension)?"""
+    return fn.lower().endswith(EXTENSION)
+
+def _padded(num_bytes):
+    return (num_bytes + 7) & ~7
+
+def _column_bytes(typecode, num_rows):
+    """Number of bytes (before padding) of num_rows values of a column."""
+    if typecode == '?':
+        return (num_rows + 7) >> 3
+    return num_rows * _ITEMSIZE[typecode]
+
+
+class BinaryRecording(object):
+    """A binary recording file for the data of a DataAcquisition.
+    Has the same interface as export.TextRecording:
+    write_rows() appends the samples not yet written as a chunk,
+    and close() finishes the file by writing the chunk index.
+    """
+    CHUNK_ROWS = 1 << 16    # maximum rows in one chunk
+
+    def __init__(self, fn, daq, notes, convvolts, new_conf, streaming=False):
+        """Arguments as for export.TextRecording.
+        convvolts and streaming make no difference to the file:
+        samples are always stored as raw readings, and the header is complete
+        when written.
+        """
+        if getattr(daq, 'conf', None):
+            self.conf = daq.conf
+        else:
+            # configuration never done, probably because no data recorded yet
+            self.conf = new_conf
+        self.board = daq.board
+        self.data = daq.data()
+        self.num_written = 0    # number of the next sample to write
+        self.num_samples = 0    # number of samples in the file
+        self.typecodes = [TICKS64] + [col.typecode or '?' for col in self.data.columns[1:]]
+        self._index_entry = _index_entry(len(self.typecodes) - 1)
+        self._chunk_header = _chunk_header(len(self.typecodes) - 1)
+        self._index = []        # index entry (see above) for each chunk
+        self._f = io.open(fn, 'wb')
+        self._f.write(MAGIC)
+        header = json.dumps(self._header(notes, new_conf), sort_keys=True).encode('utf-8')
+        self._f.write(_header_length.pack(len(header)))
+        self._f.write(header)
+        self._pad()
+
+    def _header(self, notes, new_conf):
+        trigger, aref, avg, channels = self.conf
+        if hasattr(trigger, 'period'):
+            trigger_info = dict(type='timed', period=trigger.period)
+        else:
+            trigger_info = dict(type='pinchange', pin=trigger.pin, sense=trigger.sense)
+        # Use passed-in configuration for names, rather than the ones saved
+        # (as in text recordings).
+        channel_info = [dict(name=ch_name.name,
+                             probe=ch.probe,
+                             probe_name=self.board.name_from_probe.get(ch.probe),
+                             interpretation=ch.interpretation._asdict())
+                        for ch_name, ch in zip(new_conf[-1], channels)]
+        return dict(version=FORMAT_VERSION,
+                    saved_at='{0:%Y %b %d %H:%M:%S}'.format(datetime.now()),
+                    board=list(self.board.names),
+                    power_voltage=self.board.power_voltage,
+                    trigger=trigger_info,
+                    aref=aref,
+                    avg=avg,
+                    notes=notes,
+                    channels=channel_info,
+                    typecodes=self.typecodes)
+
+    def _pad(self):
+        pad = -self._f.tell() & 7
+        if pad:
+            self._f.write(b'\0' * pad)
+
+    def write_rows(self, stop=None):
+        """Write the samples from num_written up to (not including) stop
+        (default, all samples stored), skipping any no longer retained,
+        as chunks of at most CHUNK_ROWS rows with the same seconds per tick.
+        Returns the number of samples written.
+        """
+        data = self.data
+        start = self.num_written
+        if stop is None:
+            stop = len(data)
+        if stop <= start:
+            return 0
+        num_before = self.num_samples
+        chunk_start = start
+        while chunk_start < stop:
+            with data.lock:
+                # skip any rows a RingStore has already overwritten
+                chunk_start = max(chunk_start, data.first_row)
+                chunk_stop = min(chunk_start + self.CHUNK_ROWS, stop)
+                if chunk_stop <= chunk_start:
+                    break
+                scale_start, chunk_stop, scale = data.time_scales(chunk_start, chunk_stop)[0]
+                ticks_code = self.typecodes[0]
+                chunk = [self._numeric_bytes(ticks_code, data.ticks(chunk_start, chunk_stop))]
+                counts = []
+                for n, typecode in enumerate(self.typecodes[1:], 1):
+                    count = data.num_samples(n, chunk_start, chunk_stop)
+                    counts.append(count)
+                    if typecode == '?':
+                        chunk.append(data.packed(n, chunk_start, chunk_stop))
+                    else:
+                        chunk.append(self._numeric_bytes(typecode,
+                                data.native_column(n, chunk_start, chunk_stop)))
+                    if count < chunk_stop - chunk_start:
+                        chunk.append(self._numeric_bytes(ticks_code,
+                                data.sample_ticks(n, chunk_start, chunk_stop)))
+            fields = [chunk_start, chunk_stop - chunk_start, scale] + counts
+            self._f.write(self._chunk_header.pack(CHUNK_MAGIC, *fields))
+            self._index.append([self._f.tell()] + fields)
+            for column_bytes in chunk:
+                self._f.write(column_bytes)
+                self._pad()
+            self.num_samples += chunk_stop - chunk_start
+            chunk_start = chunk_stop
+        self.num_written = stop
+        return self.num_samples - num_before
+
+    @staticmethod
+    def _numeric_bytes(typecode, values):
+        """Return the bytes of values stored with typecode."""
+        if not isinstance(values, array) or values.typecode != typecode:
+            values = array(typecode, values.tolist() if hasattr(values, 'tolist') else values)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+    def flush(self):
+        """Push everything written so far out to the disk."""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _gap_list(self):
+        gaps = self.data.gaps
+        first = self._index[0][1] if self._index else 0
+        return json.dumps(dict(
+                gaps=[[row-first, count, cause] for row, count, cause in list(gaps.gaps)
+                      if first <= row <= self.num_written],
+                counters=gaps.counters)).encode('utf-8')
+
+    def close(self):
+        """Write any samples not yet written, then the chunk index and gap list."""
+        if self._f.closed:
+            return
+        self.write_rows()
+        index_offset = self._f.tell()
+        for entry in self._index:
+            self._f.write(self._index_entry.pack(*entry))
+        self._f.write(self._gap_list())
+        self._f.write(_trailer.pack(index_offset, len(self._index), INDEX_MAGIC))
+        self._f.close()
+
+
+class BinaryReader(object):
+    """Read a binary recording by mapping it into memory.
+
+    header is the decoded JSON header (a dict), and len() the number of rows.
+    gaps is a list of (sample, count, cause) and counters a dict,
+    from the gap list.
+    A file that was not closed is read as far as its last complete chunk,
+    with recovered set True, and gaps and counters empty.
+    chunks(n) returns views of the samples of column n (0 for timestamps,
+    in ticks), one per chunk of at most BinaryRecording.CHUNK_ROWS rows:
+    this is the way to read them without copying.
+    column(n) returns a copy of them all in one sequence.
+    tick_chunks(n) returns the timestamps of the samples of channel n
+    (which differ from column 0 for a downsampled channel) in the same way,
+    and times(n) and times_chunks(n) return them converted to seconds.
+    The file stays mapped until close() (or the end of a with statement).
+    """
+    def __init__(self, fn):
+        self._file = io.open(fn, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{0} is not a PteroDAQ binary recording'.format(fn))
+        pos = len(MAGIC)
+        header_length = _header_length.unpack_from(self._map, pos)[0]
+        pos += _header_length.size
+        self.header = json.loads(self._map[pos:pos+header_length].decode('utf-8'))
+        self.typecodes = self.header['typecodes']
+        self.version = self.header.get('version', 1)
+        self.recovered = False  # True if the file was not closed, and its chunks were recovered
+        num_channels = len(self.typecodes) - 1
+        if len(self._map) >= _trailer.size:
+            index_offset, num_chunks, index_magic = _trailer.unpack_from(
+                            self._map, len(self._map) - _trailer.size)
+        else:
+            index_magic = None
+        if index_magic == INDEX_MAGIC:
+            entry = _index_entry(num_channels)
+            entries = [entry.unpack_from(self._map, index_offset + k*entry.size)
+                       for k in range(num_chunks)]
+            gap_list = self._map[index_offset + num_chunks*entry.size:
+                                 len(self._map) - _trailer.size]
+        elif self.version >= 2:
+            entries = self._scan_chunks(_padded(pos + header_length))
+            gap_list = b''
+            self.recovered = True
+        else:
+            self.close()
+            raise ValueError('{0} has no chunk index (recording not closed?)'.format(fn))
+        # for each chunk, (number of rows, seconds per tick,
+        #       list of (offset, count, times offset) for each column),
+        #       with times offset None if timestamps are column 0's
+        self._chunks = []
+        for fields in entries:
+            offset, first_row, num_rows, scale = fields[:4]
+            layout, end = self._layout(offset, num_rows, fields[4:])
+            self._chunks.append((num_rows, scale, layout))
+        self._len = sum(chunk[0] for chunk in self._chunks)
+        gap_list = json.loads(gap_list.decode('utf-8')) if gap_list else {}
+        self.gaps = [tuple(gap) for gap in gap_list.get('gaps', [])]
+        self.counters = gap_list.get('counters', {})
+
+    def _layout(self, offset, num_rows, counts):
+        """Return the layout of a chunk whose columns start at offset
+        (a list of (offset, count, times offset) for each column),
+        and the offset of its end.
+        """
+        ticks_code = self.typecodes[0]
+        layout = [(offset, num_rows, None)]
+        offset += _padded(_column_bytes(ticks_code, num_rows))
+        for typecode, count in zip(self.typecodes[1:], counts):
+            times_offset = None
+            values_offset = offset
+            offset += _padded(_column_bytes(typecode, count))
+            if count < num_rows:
+                times_offset = offset
+                offset += _padded(_column_bytes(ticks_code, count))
+            layout.append((values_offset, count, times_offset))
+        return layout, offset
+
+    def _scan_chunks(self, offset):
+        """Return index entries for the complete chunks found by following
+        their headers from offset (for a file with no chunk index).
+        """
+        header = _chunk_header(len(self.typecodes) - 1)
+        entries = []
+        while offset + header.size <= len(self._map):
+            fields = header.unpack_from(self._map, offset)
+            if fields[0] != CHUNK_MAGIC:
+                break
+            offset += header.size
+            layout, end = self._layout(offset, fields[2], fields[4:])
+            if end > len(self._map):
+                break       # the chunk was being written
+            entries.append((offset,) + fields[1:])
+            offset = end
+        return entries
+
+    def __len__(self):
+        return self._len
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap the file.
+        If views returned by column() or chunks() are still in use,
+        the mapping is left for the garbage collector to close.
+        """
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+    @property
+    def num_channels(self):
+        return len(self.typecodes) - 1
+
+    def _view(self, typecode, offset, num_rows):
+        """Return a view of num_rows values starting at byte offset of the file."""
+        num_bytes = _column_bytes(typecode, num_rows)
+        if typecode == '?':
+            if np is not None:
+                return np.frombuffer(self._map, np.uint8, num_bytes, offset)
+            return memoryview(self._map)[offset:offset+num_bytes]
+        if np is not None:
+            return np.frombuffer(self._map, _NUMPY_TYPES[typecode], num_rows, offset)
+        if sys.byteorder != 'little' or not hasattr(memoryview, 'cast'):
+            # copy, as the file's byte order is not native (or Python 2)
+            values = array(str(typecode), self._map[offset:offset+num_bytes])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            return values
+        return memoryview(self._map)[offset:offset+num_bytes].cast(str(typecode))
+
+    def chunks(self, n):
+        """Return a list of views of the samples of column n, one for each chunk.
+        Digital ('?') columns are views of the packed bytes;
+        use bits() to unpack them.
+        """
+        typecode = self.typecodes[n]
+        return [self._view(typecode, layout[n][0], layout[n][1])
+                for num_rows, scale, layout in self._chunks]
+
+    def tick_chunks(self, n):
+        """Return a list of views of the timestamps, in ticks,
+        of the samples of channel n, one for each chunk.
+        """
+        ticks_code = self.typecodes[0]
+        views = []
+        for num_rows, scale, layout in self._chunks:
+            offset, count, times_offset = layout[n]
+            if times_offset is None:
+                views.append(self._view(ticks_code, layout[0][0], num_rows))
+            else:
+                views.append(self._view(ticks_code, times_offset, count))
+        return views
+
+    def times_chunks(self, n):
+        """Return a list of the timestamps, in seconds,
+        of the samples of channel n, one for each chunk.
+        """
+        times = []
+        for ticks, (num_rows, scale, layout) in zip(self.tick_chunks(n), self._chunks):
+            if np is not None:
+                times.append(ticks * scale)
+            else:
+                times.append(array(str('d'), [tick*scale for tick in ticks]))
+        return times
+
+    @staticmethod
+    def _joined(views, typecode):
+        """Return a copy of the views as one sequence."""
+        if np is not None:
+            return np.concatenate(views) if views else np.zeros(0, _NUMPY_TYPES[typecode])
+        values = array(str(typecode))
+        for view in views:
+            values.extend(view)
+        return values
+
+    def column(self, n):
+        """Return a copy of all the samples of column n (0 for timestamps).
+        With NumPy, this is a NumPy array (of bools, for digital channels),
+        otherwise an array of numbers, or a list of bools.
+        Use chunks() to read them in place.
+        """
+        if self.typecodes[n] == '?':
+            return self.bits(n)
+        return self._joined(self.chunks(n), self.typecodes[n])
+
+    def times(self, n):
+        """Return the timestamps, in seconds, of all the samples of channel n."""
+        times = self.times_chunks(n)
+        return times[0] if len(times) == 1 else self._joined(times, 'd')
+
+    def bits(self, n):
+        """Return the samples of digital column n, unpacked."""
+        values = []
+        for view, (num_rows, scale, layout) in zip(self.chunks(n), self._chunks):
+            count = layout[n][1]
+            if np is not None:
+                values.append(np.unpackbits(view, bitorder='little')[:count].astype(bool))
+            else:
+                packed = bytearray(view)
+                values.append([bool((packed[i >> 3] >> (i & 7)) & 1) for i in range(count)])
+        if np is not None:
+            return np.concatenate(values) if values else np.zeros(0, bool)
+        return [bit for chunk in values for bit in chunk]
@@ -50,18 +50,20 @@ class Board(object):
                         # but can be overridden in specific boards
     
     
-    # Some of these should probably be instance variables rather than class variables.
-    # We've been sloppy about this, because we assume only one board ever instantiated.
-    power_voltage = None # power supply voltage, needed for analog reference info
-    
     frequency_dead_cycles = 0   # how many cycles is frequency counter turned off for
         # on each sample.
 
     def __init__(self):
         """Build dict self.name_from_probe, mapping probes to names.
         Build dict self.probe_from_name, mapping names to probes.
+        
+        What setup() measures is kept on the instance, not the class,
+        so several boards (even of the same model) can be connected at once.
         """
+        self.power_voltage = None # power supply voltage, needed for analog reference info
         self.timestamp_res = None # resolution of timestamps in seconds
+        self._tmr_base = None     # seconds per CPU clock cycle
+        self.frequency_dead_time = 0    # seconds frequency counter is off on each sample
         self.name_from_probe=dict()
         self.probe_from_name=dict()
         self.gain_from_name=dict()
@@ -214,6 +216,13 @@ class ArduinoAVR(Board):
         actual = (pr * top * base)
         return actual, (n, top)
 
+    def timer_period(self, n, top):
+        """Return the period in seconds of the timer parameters
+        (n, top) that timer_calc returns (as the firmware interprets them).
+        """
+        prescales = (1, 8, 64, 256, 1024)
+        return prescales[n-1] * top * self._tmr_base
+
 
 @Board.supported(1)
 class ArduinoStandard(ArduinoAVR):
@@ -519,6 +528,12 @@ class FreedomKL25(Board):
         actual = (reload + 1)*(n+1) * base
         return actual, (n, reload)
 
+    def timer_period(self, n, reload):
+        """Return the period in seconds of the timer parameters
+        (n, reload) that timer_calc returns (as the firmware interprets them).
+        """
+        return (reload + 1)*(n+1) * self.timestamp_res
+
 
 @Board.supported(6)
 class Teensy3_1(Board):
@@ -633,6 +648,12 @@ class Teensy3_1(Board):
         actual = (reload + 1)*(n+1) * base
         return actual, (n, reload)
 
+    def timer_period(self, n, reload):
+        """Return the period in seconds of the timer parameters
+        (n, reload) that timer_calc returns (as the firmware interprets them).
+        """
+        return (reload + 1)*(n+1) * self.timestamp_res
+
 
 @Board.supported(7)
 class Teensy_LC(Board):
@@ -728,6 +749,12 @@ class Teensy_LC(Board):
         actual = (reload + 1)*(n+1) * base
         return actual, (n, reload)
 
+    def timer_period(self, n, reload):
+        """Return the period in seconds of the timer parameters
+        (n, reload) that timer_calc returns (as the firmware interprets them).
+        """
+        return (reload + 1)*(n+1) * self.timestamp_res
+
 
 
 
@@ -0,0 +1,266 @@
+"""Capturing the raw serial byte stream of a run, and replaying it.
+
+A capture file records, in order, every chunk of bytes read from the board
+and every write sent to it, each with the host time (seconds from the start
+of the capture) at which it happened:
+        magic           8 bytes, b'PDAQCAP1'
+        records         kind (1 byte: 0 read, 1 write), time (8-byte double),
+                        length (4 bytes), then length bytes
+all little-endian.
+
+Both ends plug into CommPort in place of the serial port class
+(DataAcquisition.serial_class):
+        daq.serial_class = CaptureFile('run.cap').serial_class()
+records a run with a real board, and
+        daq.serial_class = Replay('run.cap').serial_class()
+feeds the recorded bytes back through the unchanged CommPort, FrameParser,
+and PacketDecoder, with no board attached.
+A ReplaySerial hands out the bytes the board sent after the host's k-th write
+only once the host has written k times, so command responses follow their
+commands as they did when captured.  With speed=None the bytes are replayed
+as fast as they are read; otherwise reads are paced to the recorded times
+(speed=1 for the original speed, 2 for twice as fast, ...).
+"""
+
+from __future__ import division, print_function
+
+import io
+import sys
+import struct
+from threading import Condition, Event, Lock
+from timeit import default_timer as clock
+
+from getports import Serial
+
+MAGIC = b'PDAQCAP1'
+READ = 0
+WRITE = 1
+_record_header = struct.Struct('<BdI')
+
+
+class CaptureFile(object):
+    """A capture file being written.
+    Every port opened through serial_class() adds to the same file,
+    so a reopened port (as for a Leonardo) continues the capture.
+    """
+    def __init__(self, fn):
+        self._f = io.open(fn, 'wb')
+        self._f.write(MAGIC)
+        self._lock = Lock()
+        self._start = clock()
+        self.num_read = 0       # bytes read from the board
+        self.num_written = 0    # bytes written to the board
+
+    def record(self, kind, data, time=None):
+        """Append a record of data read (kind READ) or written (kind WRITE)
+        at time (seconds since the file was created; default now).
+        """
+        if not data:
+            return
+        if time is None:
+            time = clock() - self._start
+        with self._lock:
+            self._f.write(_record_header.pack(kind, time, len(data)))
+            self._f.write(data)
+        if kind == READ:
+            self.num_read += len(data)
+        else:
+            self.num_written += len(data)
+
+    def serial_class(self, serial_class=Serial):
+        """Return a function opening a serial_class port that records into this file,
+        for use as CommPort's serial_class.
+        """
+        def open_port(port, **args):
+            return CaptureSerial(serial_class(port, **args), self)
+        return open_port
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class CaptureSerial(object):
+    """A serial port recording everything read and written into a CaptureFile."""
+    def __init__(self, ser, capture):
+        self.ser = ser
+        self.capture = capture
+
+    @property
+    def syscalls(self):
+        return getattr(self.ser, 'syscalls', None)
+
+    def read(self, n):
+        data = self.ser.read(n)
+        self.capture.record(READ, data)
+        return data
+
+    def read_some(self, n):
+        data = self.ser.read_some(n)
+        self.capture.record(READ, data)
+        return data
+
+    def readinto(self, buffer):
+        if hasattr(self.ser, 'readinto'):
+            n = self.ser.readinto(buffer)
+        else:
+            data = self.ser.read_some(len(buffer))
+            n = len(data)
+            buffer[:n] = data
+        self.capture.record(READ, buffer[:n])
+        return n
+
+    def write(self, d):
+        self.capture.record(WRITE, d)
+        self.ser.write(d)
+
+    def close(self):
+        self.ser.close()
+
+
+def read_capture(fn):
+    """Return the records of capture file fn as a list of (kind, time, bytes)."""
+    with io.open(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a PteroDAQ capture file'.format(fn))
+        records = []
+        while True:
+            header = f.read(_record_header.size)
+            if len(header) < _record_header.size:
+                return records
+            kind, time, length = _record_header.unpack(header)
+            records.append((kind, time, f.read(length)))
+
+
+class Replay(object):
+    """The contents of a capture file, being fed back to the host.
+    All the ports opened through serial_class() share one position in the capture.
+    """
+    def __init__(self, fn, speed=None):
+        """speed: None to replay as fast as possible,
+                or the multiple of the original speed at which to replay
+        """
+        self.speed = speed
+        self.finished = Event()     # set once every byte read has been handed out
+        self.needs_write = Event()  # set while the bytes up to the host's next write
+                                    # have all been handed out (e.g., a run's data is done)
+        self.mismatched_writes = 0  # host writes that differ from those captured
+        self._chunks = []           # (bytes read, number of writes before them, time)
+        self._writes = []           # the bytes of each write, in order
+        self._write_times = []
+        for kind, time, data in read_capture(fn):
+            if kind == READ:
+                self._chunks.append((data, len(self._writes), time))
+            else:
+                self._writes.append(data)
+                self._write_times.append(time)
+        self._next = 0              # index in _chunks of the next chunk to hand out
+        self._offset = 0            # bytes of that chunk already handed out
+        self._num_writes = 0        # writes made by the host so far
+        self._ref = (clock(), 0.)   # (host clock, capture time) that pacing is measured from
+        self.time = 0.              # capture time of the last chunk read or write made
+        self._cond = Condition()
+        self._check_progress()
+
+    def _check_progress(self):
+        """Set or clear finished and needs_write for the next chunk."""
+        if self._next >= len(self._chunks):
+            self.finished.set()
+            self.needs_write.set()
+        elif self._chunks[self._next][1] > self._num_writes:
+            self.needs_write.set()
+        else:
+            self.needs_write.clear()
+
+    def serial_class(self):
+        """Return a function opening a ReplaySerial on this replay,
+        for use as CommPort's serial_class.
+        """
+        def open_port(port, **args):
+            return ReplaySerial(self)
+        return open_port
+
+    def write(self, d):
+        with self._cond:
+            k = self._num_writes
+            if k < len(self._writes):
+                if self._writes[k] != bytes(d):
+                    self.mismatched_writes += 1
+                    print('Warning: replay write {0} is {1!r}, captured {2!r}'.format(
+                            k, bytes(d), self._writes[k]), file=sys.stderr)
+                self._ref = (clock(), self._write_times[k])
+                self.time = self._write_times[k]
+            self._num_writes = k + 1
+            self._check_progress()
+            self._cond.notify_all()
+
+    def read_some(self, n, timeout=1.0):
+        """Return up to n bytes of the next chunk the board sent,
+        waiting (at most timeout seconds) for the host write it followed
+        and, if pacing, for its time to come.  Returns b'' on timeout.
+        """
+        deadline = clock() + timeout
+        with self._cond:
+            while True:
+                if self._next >= len(self._chunks):
+                    self._cond.wait(max(0, deadline - clock()))
+                    return b''
+                data, writes_before, time = self._chunks[self._next]
+                wait = deadline - clock()
+                if self._num_writes >= writes_before:
+                    if self.speed is None:
+                        break
+                    due = self._ref[0] + (time - self._ref[1]) / self.speed
+                    if clock() >= due:
+                        break
+                    wait = min(wait, due - clock())
+                if wait <= 0:
+                    return b''
+                self._cond.wait(wait)
+            self.time = time
+            offset = self._offset
+            piece = data[offset:offset+n]
+            if offset + n < len(data):
+                self._offset = offset + n
+            else:
+                self._next += 1
+                self._offset = 0
+                self._check_progress()
+            return piece
+
+
+class ReplaySerial(object):
+    """A serial port whose input comes from a Replay rather than a board."""
+    def __init__(self, replay):
+        self.replay = replay
+        self.syscalls = None
+
+    def read_some(self, n):
+        return self.replay.read_some(n)
+
+    def readinto(self, buffer):
+        data = self.replay.read_some(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, n):
+        result = []
+        while n:
+            data = self.replay.read_some(n)
+            if not data:
+                break
+            result.append(data)
+            n -= len(data)
+        return b''.join(result)
+
+    def write(self, d):
+        self.replay.write(d)
+
+    def clock(self):
+        """The capture time of what was last read or written,
+        for timing the board's data when replaying faster than it was captured.
+        """
+        return self.replay.time
+
+    def close(self):
+        pass
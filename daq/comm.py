@@ -1,12 +1,19 @@
 from __future__ import division, print_function
 
 import sys
+import errno
 from sys import version_info
 from time import sleep
-from threading import Thread, Event
+from collections import deque
+from threading import Thread, Event, Condition
 
 from getports import Serial,ports
 
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional, used only to check long runs of frames faster
+    np = None
+
 if version_info[0] == 3:
     # Python 3
     def tobytes(x):
@@ -36,23 +43,432 @@ else:
     def toints(bs):
         return [ord(c) for c in bs]
 
+_int_star = ord(b'*')
+_int_bang = ord(b'!')
+_int_E = ord(b'E')
+
+def command_frame(c, d=b''):
+    """Return the '!' frame sending command c (a single-character byte string)
+    with data d (a byte string) to the board.
+    """
+    mbase = b'!' + c + asbyte(len(d)) + d
+    return mbase + asbyte(-bytesum(mbase) % 256)
+
+class FrameRun(object):
+    """Consecutive data frames of the same length in a FrameParser's buffer,
+    as a sequence of payloads (memoryviews) without copying them.
+    Like the buffer, a FrameRun is only valid until the parser next reads.
+    """
+    __slots__ = ('view', 'start', 'count', 'length')
+
+    def __init__(self, view, start, count, length):
+        """view: memoryview of the buffer; start: offset of the first frame;
+        count: number of frames; length: payload length of each frame
+        """
+        self.view = view
+        self.start = start
+        self.count = count
+        self.length = length
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('frame index out of range')
+        first = self.start + i*(self.length + 3) + 2
+        return self.view[first:first + self.length]
+
+    def __iter__(self):
+        view = self.view
+        length = self.length
+        for first in range(self.start + 2, self.start + self.count*(length + 3), length + 3):
+            yield view[first:first + length]
+
+    def array(self):
+        """Return the payloads as a NumPy array of count rows of length bytes,
+        viewing the buffer (needs NumPy).
+        """
+        frames = np.frombuffer(self.view, np.uint8, self.count*(self.length + 3), self.start)
+        return frames.reshape(self.count, self.length + 3)[:, 2:self.length + 2]
+
+class FrameParser(object):
+    """Incremental parser for the byte stream coming from a DAQ board.
+    
+    Bytes go into a buffer allocated once (and enlarged only if feed()
+    is given more than fits), either appended with feed() or read
+    straight into it with readinto(); parse() extracts every complete
+    '!' and '*' frame in one pass, moving any partial frame to the start
+    of the buffer for the next read.
+    Both Python 2 and Python 3 index a bytearray as integers,
+    so the same code works for both.
+    If NumPy is available, long runs of data frames of one length
+    (the usual case, as the length is fixed by the configuration)
+    are checked all at once.
+    """
+    MIN_RUN = 16        # shorter runs are checked faster one frame at a time
+    
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self._view = memoryview(self.buf)
+        self._end = 0               # number of bytes of buf holding data
+        self.num_packets = 0        # number of valid frames extracted
+        self.checksum_errors = 0    # number of frames with bad checksums
+        self.framing_errors = 0     # number of bytes skipped to find a frame
+    
+    def _make_room(self, n):
+        """Make sure n more bytes fit in the buffer."""
+        if self._end + n > len(self.buf):
+            buf = bytearray(max(2*len(self.buf), self._end + n))
+            buf[:self._end] = self._view[:self._end]
+            self.buf = buf
+            self._view = memoryview(buf)
+    
+    def feed(self, chunk):
+        """Append the bytes in chunk to the buffer."""
+        n = len(chunk)
+        self._make_room(n)
+        self._view[self._end:self._end + n] = chunk
+        self._end += n
+    
+    def readinto(self, read_into, max_size=None):
+        """Append bytes read by read_into (a function like Serial.readinto,
+        filling a writable buffer and returning the number of bytes it read)
+        to the buffer, up to max_size bytes at a time, without copying them.
+        Returns the number of bytes read.
+        """
+        free = len(self.buf) - self._end
+        if max_size is not None and max_size < free:
+            free = max_size
+        n = read_into(self._view[self._end:self._end + free])
+        self._end += n
+        return n
+    
+    def parse(self, on_data, on_command, on_error=None, copy=True):
+        """Extract all complete frames from the buffer.
+        For each data ('*') frame, call on_data(payload).
+        For each command response ('!') frame, call on_command(cm, payload),
+                where cm is the integer command byte.
+        If on_error is given, call on_error('checksum') for each frame
+                with a bad checksum, and on_error('framing') each time
+                bytes had to be skipped to find a frame.
+        Frames and errors are handled in the order they arrived.
+        After a checksum error, scanning resumes one byte after the
+        start of the bad frame, so that a dropped byte costs only
+        the damaged frame.
+        Payloads are bytes, or, if copy is false, memoryviews of the buffer,
+        valid only until the next feed() or readinto().
+        """
+        self._discard(self._parse(on_data, None, on_command, on_error, copy))
+    
+    def _parse(self, on_data, on_run, on_command, on_error, copy):
+        """parse(), also calling on_run(FrameRun) for runs of data frames
+        checked together, if on_run is given.
+        Returns the number of bytes used (see _discard).
+        """
+        buf = self.buf
+        view = self._view
+        end_buf = self._end
+        pos = 0
+        skipped = 0
+        check_runs = on_run is not None and np is not None
+        while end_buf - pos >= 2:
+            c = buf[pos]
+            if c == _int_star:
+                start = pos + 2
+                if check_runs and end_buf - pos >= self.MIN_RUN*(buf[pos+1] + 3):
+                    count = self._check_run(pos, buf[pos+1])
+                    if count:
+                        if skipped:
+                            self._report_skipped(skipped, on_error)
+                            skipped = 0
+                        self.num_packets += count
+                        on_run(FrameRun(view, pos, count, buf[pos+1]))
+                        pos += count*(buf[pos+1] + 3)
+                        continue
+            elif c == _int_bang:
+                if end_buf - pos < 3:
+                    break
+                start = pos + 3
+            else:
+                skipped += 1
+                pos += 1
+                continue
+            stop = start + buf[start-1]     # checksum is at buf[stop]
+            if stop >= end_buf:
+                break           # rest of frame not here yet
+            if sum(buf[pos:stop+1]) & 0xff:
+                self.checksum_errors += 1
+                if c == _int_star:
+                    print('Warning: Checksum error on data packet.', file=sys.stderr)
+                else:
+                    print('Warning: Checksum error on', buf[pos+1], 'packet', file=sys.stderr)
+                if on_error is not None:
+                    on_error('checksum')
+                pos += 1
+                continue
+            if skipped:
+                self._report_skipped(skipped, on_error)
+                skipped = 0
+            self.num_packets += 1
+            if c == _int_star:
+                on_data(bytes(view[start:stop]) if copy else view[start:stop])
+            else:
+                on_command(buf[pos+1], bytes(view[start:stop]))
+            pos = stop + 1
+        if skipped:
+            self._report_skipped(skipped, on_error)
+        return pos
+    
+    def _discard(self, used):
+        """Drop the first used bytes of the buffer, once their payloads are handled,
+        moving any partial frame to the start.
+        """
+        view = self._view
+        view[:self._end - used] = view[used:self._end]
+        self._end -= used
+    
+    def _check_run(self, pos, length):
+        """Return how many valid data frames of payload length length
+        follow one another from pos (0 if fewer than MIN_RUN).
+        """
+        size = length + 3
+        count = (self._end - pos) // size
+        frames = np.frombuffer(self.buf, np.uint8, count*size, pos).reshape(count, size)
+        valid = ((frames[:, 0] == _int_star) & (frames[:, 1] == length)
+                 & (frames.sum(axis=1, dtype=np.uint32) & 0xff == 0))
+        count = count if valid.all() else int(np.argmin(valid))
+        return count if count >= self.MIN_RUN else 0
+    
+    def parse_batch(self, on_batch, on_command, on_error=None, copy=True):
+        """Like parse(), but collect consecutive data payloads,
+        calling on_batch(payloads) once per run of data frames
+        instead of once per frame.
+        Any pending batch is delivered before a command response or error,
+        so that data, responses, and errors stay in order.
+        payloads is a list of bytes, or, if copy is false,
+        a list of memoryviews or a FrameRun, valid only until
+        the next feed() or readinto().
+        """
+        batch = []
+        def deliver():
+            if batch:
+                on_batch(list(batch))
+                del batch[:]
+        def command(cm, data):
+            deliver()
+            on_command(cm, data)
+        def error(cause):
+            deliver()
+            on_error(cause)
+        def run(frames):
+            deliver()
+            on_batch(frames if not copy else [bytes(p) for p in frames])
+        used = self._parse(batch.append, run, command,
+                error if on_error is not None else None, copy)
+        if batch:
+            on_batch(batch)
+        self._discard(used)
+    
+    def _report_skipped(self, skipped, on_error):
+        self.framing_errors += skipped
+        print('Warning: packet frame missing: expecting "!" or "*", skipped',
+                skipped, 'bytes', file=sys.stderr)
+        if on_error is not None:
+            on_error('framing')
+
+class PacketQueue(object):
+    """Bounded hand-off of data payloads from the reading thread
+    to the decoding thread.
+
+    The payloads are kept in a ring of capacity slots, allocated once.
+    Command responses, error packets, and faults are queued alongside,
+    at their place among the payloads, and are never discarded,
+    so the decoding thread sees everything in the order it arrived.
+    When the ring is full, the policy decides what happens to a new payload:
+            'block'         the reading thread waits for the decoding thread
+            'drop-oldest'   the oldest waiting payload is discarded
+            'drop-newest'   the new payload is discarded
+    Discarded payloads are counted in num_overflows, and reported
+    to the decoding thread as a fault ('overflow', count) where they were lost.
+    """
+    POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, capacity=16384, policy='block'):
+        if policy not in self.POLICIES:
+            raise ValueError('policy must be one of {0}, not {1!r}'.format(
+                    ', '.join(self.POLICIES), policy))
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.policy = policy
+        self.high_water = 0     # most payloads ever waiting at once
+        self.num_overflows = 0  # payloads discarded by the policy
+        self.closed = False
+        self._slots = [None] * capacity
+        self._head = 0          # number of payloads taken (or discarded from the front)
+        self._tail = 0          # number of payloads put
+        self._events = deque()  # (payloads put before it, function, args)
+        self._dropped_at_head = 0   # payloads discarded just before _head, not yet reported
+        self._cond = Condition()
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def put_many(self, payloads):
+        """Queue a list of data payloads (called by the reading thread)."""
+        slots = self._slots
+        capacity = self.capacity
+        with self._cond:
+            for payload in payloads:
+                if self._tail - self._head >= capacity:
+                    if self.policy == 'block':
+                        while self._tail - self._head >= capacity and not self.closed:
+                            self._cond.wait()
+                        if self.closed:
+                            return
+                    elif self.policy == 'drop-oldest':
+                        slots[self._head % capacity] = None
+                        self._head += 1
+                        self._dropped_at_head += 1
+                        self.num_overflows += 1
+                    else:
+                        self._drop_newest()
+                        continue
+                slots[self._tail % capacity] = payload
+                self._tail += 1
+            waiting = self._tail - self._head
+            if waiting > self.high_water:
+                self.high_water = waiting
+            self._cond.notify_all()
+
+    def _drop_newest(self):
+        self.num_overflows += 1
+        events = self._events
+        if events and events[-1][0] == self._tail and events[-1][2][0] == 'overflow':
+            position, function, (cause, count) = events.pop()
+            events.append((position, function, (cause, count+1)))
+        else:
+            events.append((self._tail, None, ('overflow', 1)))
+
+    def put_event(self, function, *args):
+        """Queue a call of function(*args), to be made by the decoding thread
+        after the payloads already queued have been handed over.
+        """
+        with self._cond:
+            self._events.append((self._tail, function, args))
+            self._cond.notify_all()
+
+    def get(self, on_fault=None):
+        """Wait for payloads or events, then hand over the payloads waiting
+        before the next event by returning them as a list,
+        together with the event as (function, args), or None if there is no event.
+        An overflow fault is returned as (on_fault, ('overflow', count)).
+        Returns None once the queue is closed and empty.
+        """
+        slots = self._slots
+        capacity = self.capacity
+        with self._cond:
+            events = self._events
+            while self._tail == self._head and not events and not self._dropped_at_head:
+                if self.closed:
+                    return None
+                self._cond.wait()
+            if self._dropped_at_head:
+                count, self._dropped_at_head = self._dropped_at_head, 0
+                return [], (on_fault, ('overflow', count))
+            stop = self._tail
+            if events and events[0][0] < stop:
+                stop = max(events[0][0], self._head)
+            head = self._head
+            payloads = [slots[n % capacity] for n in range(head, stop)]
+            for n in range(head, stop):
+                slots[n % capacity] = None
+            self._head = stop
+            event = None
+            if events and events[0][0] <= stop:
+                position, function, args = events.popleft()
+                event = (function or on_fault, args)
+            self._cond.notify_all()     # room for a waiting reader
+            return payloads, event
+
+    def close(self):
+        """Release the reading thread if it is waiting, and end get()
+        once the queue is empty.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+def _read_waiting(ser):
+    """Return a read_some(n) function for a port class without one
+    (such as pyserial's Serial): it reads whatever is waiting, up to n bytes,
+    or else waits (up to the port's timeout) for a single byte.
+    """
+    def read_some(n):
+        return ser.read(max(1, min(n, ser.in_waiting)))
+    return read_some
+
 class CommPort(object):
     BAUDRATE = 1000000 # may NOT be 1200, must match other end
                 # 1Mbaud seems to be fastes reliable Arduino UART speed
                 # BAUDRATE is irrelevant for true USB communication
                 #       (used by Leonardo and KL25Z)
+    READ_CHUNK = 4096   # maximum number of bytes requested per read
     
     def __init__(self, port, 
                 data_call_on_packet, 
                 call_when_connected, 
-                call_on_error=lambda x:None):
+                call_on_error=lambda x:None,
+                data_call_on_batch=None,
+                call_on_fault=None,
+                serial_class=None,
+                queue_size=None,
+                queue_policy='block',
+                low_latency=False):
+        """data_call_on_packet is called with the payload of each data packet.
+        If data_call_on_batch is given, it is called instead with a list
+        of all the payloads extracted from one read of the serial port,
+        so that per-packet overhead is paid once per batch.
+        If call_on_fault is given, it is called as call_on_fault(cause, count)
+        with cause 'checksum', 'framing', or 'timeout' and count 1
+        for each damaged frame, resynchronization, or command timeout,
+        in order with the data.
+        serial_class, if given, is called instead of Serial to open the port
+        (capture.py uses this to record or replay the byte stream).
+        The port is read with its readinto() if it has one, else with read_some(),
+        else with read() of whatever in_waiting says is there;
+        either of the first two should return whatever bytes are waiting
+        rather than wait for a full buffer.
+        If queue_size is given, the reading thread only frames and checks packets,
+        handing them through a PacketQueue of that many payloads
+        (with the given queue_policy) to a separate decoding thread,
+        which makes all the calls above; then call_on_fault is also called
+        with cause 'overflow' and the number of payloads when the policy discards them.
+        Otherwise the reading thread makes the calls itself.
+        If low_latency is true, the port is opened with the serial driver's
+        low-latency flag set, where the driver has one (see getports.posixser.Serial).
+        """
         self.portname = port
+        self._serial_class = serial_class or Serial
+        self._serial_args = dict(baudrate=self.BAUDRATE, timeout=1)
+        if low_latency:     # only asked for, as other serial classes may not know it
+            self._serial_args['low_latency'] = True
         self._respavail = Event()       # set when a full command 
                         # response has been read.
                         
         self._data_call_on_packet = data_call_on_packet
+        self._data_call_on_batch = data_call_on_batch
         self._call_when_connected = call_when_connected
         self._call_on_error       = call_on_error
+        self._call_on_fault       = call_on_fault
+        self._parser = FrameParser()
+        self.read_calls = 0     # number of reads done by _readin
+        self.queue = None       # PacketQueue between _readin and _decode, if used
+        if queue_size:
+            self.queue = PacketQueue(queue_size, queue_policy)
     
     def connect(self):
         """Initiate a connection with the serial port specified upon instantiation.
@@ -61,6 +477,9 @@ class CommPort(object):
         t1.daemon = True
         self._readthread = t2 = Thread(target=self._readin)
         t2.daemon = True
+        if self.queue is not None:
+            self._decodethread = t3 = Thread(target=self._decode)
+            t3.daemon = True
         t1.start()
     
     def _connect(self):
@@ -71,6 +490,8 @@ class CommPort(object):
 #        print('DEBUG: enter comm._connect',file=sys.stderr)
         self._reset()
         self._do_readin = True  # set False to kill _readthread
+        if self.queue is not None:
+            self._decodethread.start()
         self._readthread.start()
 #        print('DEBUG:about to handshake', file=sys.stderr)
         self._call_when_connected()
@@ -91,7 +512,7 @@ class CommPort(object):
         t.daemon = True # let program stop even if enum thread still running
         t.start()       
 #        print("DEBUG: about to open s1 Serial(",repr(p),",",self.BAUDRATE,")", file=sys.stderr)
-        s1 = Serial(p, baudrate=self.BAUDRATE, timeout=1)       #open port
+        s1 = self._serial_class(p, **self._serial_args)       #open port
 #        print("DEBUG: back from attempt to open s1 Serial", file=sys.stderr)
         sleep(0.1)
         s1.write(b'E') # end leonardo bootloader
@@ -108,7 +529,7 @@ class CommPort(object):
         
         # open Leonardo port now that bootloader has stopped
         p = self.portname = self._enum_found
-        self.ser = Serial(p, baudrate=self.BAUDRATE, timeout=1)
+        self.ser = self._serial_class(p, **self._serial_args)
         sleep(0.1)
         return
     
@@ -117,15 +538,22 @@ class CommPort(object):
         together with data d (a byte string)
         and return the data from the response (a byte string).
         """
-        mbase = b'!' + c + asbyte(len(d)) + d
-        msg = mbase + asbyte(-bytesum(mbase) % 256)
+        msg = command_frame(c, d)
         while True:
 #            print("DEBUG: sending message", msg[:2],
 #                    " ".join(map(hex, toints(msg[2:]))), file=sys.stderr)
-            self.ser.write(msg)
-            self._respavail.wait(timeout=5)
+            try:
+                self.ser.write(msg)
+            except OSError as e:
+                if e.errno != errno.ETIMEDOUT:
+                    raise
+                # the port would not take the command: handled as unanswered
+            else:
+                self._respavail.wait(timeout=5)
             if not self._respavail.is_set():
                 print('Warning: Command timeout for command {}'.format(c),file=sys.stderr)
+                if self._call_on_fault is not None:
+                    self._call_on_fault('timeout', 1)
                 if c=='H':
                     print('Try killing port-select window, and rerunning after unplugging and replugging the board into the USB port',
                         file=sys.stderr)
@@ -137,92 +565,117 @@ class CommPort(object):
             print('Warning: Invalid command response: sent {} command, response is {} {}'.format(c,
                          chr(cm), res), file=sys.stderr)
     
-    if version_info[0] == 3:
-        # Python 3
-        def _readin(self):
-            """Read and process data from the serial port.
-            If it forms a command response, store in _cmresp and set _respavail.
-            _cmresp is tuple( integer command, bytes response)
-            If it forms a data record, call _datacallback with it.
-            """
-            rd = self.ser.read
-            int_star = b'*'[0]
-            int_bang = b'!'[0]
-            int_E = b'E'[0]
-            # print('DEBUG: readin begin on self.ser=', self.ser, file=sys.stderr)
-            while self._do_readin:
-                first_two=b''
-                while not first_two:
-                    first_two = rd(2)
-                c,cm = first_two
-    #            print("DEBUG: c=", c,"clock=", clock(), file=sys.stderr)
-                if c == int_bang:
-                    ln = rd(1)[0]
-                    data = rd(ln)
-                    chk = rd(1)
-                    if len(chk)>0  and (c+cm+ln + sum(data) + chk[0]) % 256 == 0:
-                        if cm == int_E:
-                            self._call_on_error(data)
-                        else:
-                            self._cmresp = cm, data
-                            self._respavail.set()
-                    else:
-                        print('Warning: Checksum error on',cm,'packet',file=sys.stderr)
-                elif c == int_star:
-                    ln = cm
-                    data = rd(ln)
-                    chk = rd(1)
-    #                print('DEBUG: data=', data, 'clock=', clock(), file=sys.stderr)
-                    if len(chk)>0 and (c + ln + sum(data) + chk[0]) % 256 == 0:
-                        self._data_call_on_packet(data)
-                    else:
-                        print('Warning: Checksum error on data packet.',file=sys.stderr)
-                elif c:
-                    print('Warning: packet frame missing: expecting "!" or "*", but got', 
-                            hex(c), file=sys.stderr)
-    else:    
-        # Python 2
-        def _readin(self):
-            """Read and process data from the serial port.
-            If it forms a command response, store in _cmresp and set _respavail.
-            If it forms a data record, call _datacallback with it.
-            """
-            rd = self.ser.read
-            int_star = ord(b'*')
-            int_bang = ord(b'!')
-            int_E = ord(b'E')
-            # print('DEBUG: readin begin on self.ser=', self.ser, file=sys.stderr)
-            while self._do_readin:
-                first_two=b''
-                while not first_two:
-                    first_two = rd(2)
-                c=ord(first_two[0])
-                cm = ord(first_two[1])
-    #            print("DEBUG: c=", c,"clock=", clock(), file=sys.stderr)
-                if c == int_bang:
-                    ln = ord(rd(1))
-                    data = rd(ln)
-                    chk = rd(1)
-                    if len(chk)>0  and (c+cm+ln + sum(bytearray(data)) + ord(chk)) % 256 == 0:
-                        if cm == int_E:
-                            self._call_on_error(data)
-                        else:
-                            self._cmresp = cm, data
-                            self._respavail.set()
-                    else:
-                        print('Warning: Checksum error on',cm,'packet',file=sys.stderr)
-                elif c == int_star:
-                    ln = cm
-                    data = rd(ln)
-                    chk = rd(1)
-    #                print('DEBUG: data=', data, 'clock=', clock(), file=sys.stderr)
-                    if len(chk)>0 and (c + ln + sum(bytearray(data)) + ord(chk)) % 256 == 0:
-                        self._data_call_on_packet(data)
-                    else:
-                        print('Warning: Checksum error on data packet.',file=sys.stderr)
-                elif c:
-                    print('Warning: packet frame missing: expecting "!" or "*", but got', 
-                            hex(c), file=sys.stderr)
+    def _readin(self):
+        """Read and process data from the serial port.
+        Bytes are read in large chunks (whatever is available)
+        and handed to self._parser, which extracts every complete frame;
+        a port with readinto() reads straight into the parser's buffer.
+        If a frame is a command response, store in _cmresp and set _respavail.
+        _cmresp is tuple( integer command, bytes response)
+        If it forms a data record, call _data_call_on_packet with it,
+        or pass all the data records from the chunk to _data_call_on_batch,
+        as memoryviews of the parser's buffer (valid only during the call).
+        With a PacketQueue, the data records (copied to bytes), responses,
+        and faults are queued instead, for _decode to handle.
+        """
+        read_into = getattr(self.ser, 'readinto', None)
+        if read_into is None:
+            rd = getattr(self.ser, 'read_some', None) or _read_waiting(self.ser)
+        parser = self._parser
+        queue = self.queue
+        copy = queue is not None
+        if queue is not None:
+            parse = parser.parse_batch
+            on_data = queue.put_many
+            on_command = lambda cm, data: queue.put_event(self._oncommand, cm, data)
+            on_fault = None
+            if self._call_on_fault is not None:
+                on_fault = lambda cause: queue.put_event(self._call_on_fault, cause, 1)
+        elif self._data_call_on_batch is not None:
+            parse = parser.parse_batch
+            on_data = self._data_call_on_batch
+        else:
+            parse = parser.parse
+            on_data = self._data_call_on_packet
+        if queue is None:
+            on_command = self._oncommand
+            on_fault = None
+            if self._call_on_fault is not None:
+                on_fault = lambda cause: self._call_on_fault(cause, 1)
+        chunk_size = self.READ_CHUNK
+        # print('DEBUG: readin begin on self.ser=', self.ser, file=sys.stderr)
+        while self._do_readin:
+            if read_into is not None:
+                count = parser.readinto(read_into, chunk_size)
+            else:
+                chunk = rd(chunk_size)
+                count = len(chunk)
+                if count:
+                    parser.feed(chunk)
+            self.read_calls += 1
+            if count:
+                parse(on_data, on_command, on_fault, copy)
+    
+    def _decode(self):
+        """Hand the payloads, responses, and faults queued by _readin
+        to the callbacks, in order.
+        """
+        get = self.queue.get
+        on_batch = self._data_call_on_batch
+        on_packet = self._data_call_on_packet
+        def on_fault(cause, count):
+            if self._call_on_fault is not None:
+                self._call_on_fault(cause, count)
+        while True:
+            item = get(on_fault)
+            if item is None:
+                return
+            payloads, event = item
+            if payloads:
+                if on_batch is not None:
+                    on_batch(payloads)
+                else:
+                    for payload in payloads:
+                        on_packet(payload)
+            if event is not None:
+                function, args = event
+                function(*args)
+    
+    def _oncommand(self, cm, data):
+        """Handle a complete, checksummed '!' frame from the board.
+        cm is the integer command byte, data the bytes of the response.
+        """
+        if cm == _int_E:
+            self._call_on_error(data)
+        else:
+            self._cmresp = cm, data
+            self._respavail.set()
+    
+    def counters(self):
+        """Return a dict of reader statistics:
+            reads           number of read calls made on the serial port
+            syscalls        number of system calls made by the serial port
+                                (None if the port does not count them)
+            packets         number of complete, valid frames received
+            checksum_errors number of frames discarded for bad checksums
+            framing_errors  number of bytes skipped while resynchronizing
+        and, with a PacketQueue:
+            queue_length    number of payloads waiting to be decoded
+            queue_high_water    most payloads ever waiting at once
+            queue_overflows number of payloads discarded by the queue policy
+        """
+        parser = self._parser
+        counters = dict(reads=self.read_calls,
+                syscalls=getattr(getattr(self, 'ser', None), 'syscalls', None),
+                packets=parser.num_packets,
+                checksum_errors=parser.checksum_errors,
+                framing_errors=parser.framing_errors)
+        queue = self.queue
+        if queue is not None:
+            counters.update(queue_length=len(queue),
+                    queue_high_water=queue.high_water,
+                    queue_overflows=queue.num_overflows)
+        return counters
     
     def _enum(self):
         """Keep track of the number of serial ports available.
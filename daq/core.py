@@ -2,10 +2,9 @@ from __future__ import division, print_function, unicode_literals
 
 import sys
 import struct
-from datetime import datetime
 from collections import namedtuple
-from math import sqrt
-import codecs
+from timeit import default_timer as clock
+from operator import itemgetter
 try:
     from future_builtins import zip
 except ImportError:     # either before Python2.6 or one of the Python 3.*
@@ -14,8 +13,17 @@ except ImportError:     # either before Python2.6 or one of the Python 3.*
     except ImportError: # not an early Python, so must be Python 3.*
         pass
 
-from comm import CommPort, tobytes, tostr
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional, used only to decode large batches faster
+    np = None
+
+from comm import CommPort, FrameRun, tobytes, tostr
 from boards import getboardinfo
+from store import SampleStore, RingStore, tick_typecode
+from export import TextRecording, AutoSaver
+from stream import SampleStream
+from binfile import BinaryRecording, is_binary_filename
 
 firmware_version = b'v0.3' # code used in firmware to identify protocol version
 
@@ -139,6 +147,19 @@ class ChannelDescriptor(namedtuple('ChannelDescriptor',
     def volts(self,raw_value, aref):
         return raw_value/65536.*aref/self.interpretation.gain
 
+def channel_for_pin(board, pin_name, name, downsample=1):
+    """Return the ChannelDescriptor for reading pin pin_name of board
+    (a name from board.probe_from_name) as channel name.
+    """
+    return ChannelDescriptor(name=name,
+                probe=board.probe_from_name[pin_name],
+                interpretation=Interpretation(
+                    is_analog=board.is_analog(pin_name) or board.is_differential(pin_name),
+                    is_signed=board.is_differential(pin_name),
+                    is_frequency=board.is_frequency(pin_name),
+                    downsample=downsample,
+                    gain=board.gain_from_name[pin_name]))
+
 class TriggerTimed(object):
     def __init__(self, period):
         self.period = period    # period in seconds
@@ -146,12 +167,222 @@ class TriggerPinchange(object):
     def __init__(self, pin, sense):
         self.pin, self.sense = pin, sense
 
+# _BITS[b] is the tuple of 8 Booleans for the bits of byte b, low-order first
+_BITS = tuple(tuple(bool((b >> i) & 1) for i in range(8)) for b in range(256))
+
+# NumPy types for the struct codes used in data packets
+_NUMPY_TYPES = {'B': '<u1', 'H': '<u2', 'h': '<i2', 'L': '<u4', 'Q': '<u8'}
+
+class PacketDecoder(object):
+    """Decoder for data packets, compiled for one configuration.
+    
+    The layout of a data packet is fixed once the trigger and channels are known,
+    so a single struct.Struct covers the timestamp and all fixed-width fields,
+    digital bytes are expanded by table lookup,
+    and the rows are assembled with an itemgetter,
+    rather than branching on the interpretation of each channel for each packet.
+    
+    If NumPy is available, large batches are instead decoded all at once
+    with a structured dtype built from the same layout.
+    """
+    NUMPY_MIN_BATCH = 16        # smaller batches are faster without NumPy
+    
+    def __init__(self, trigger, channels, board):
+        """trigger: TriggerTimed (with period already adjusted to the board timer)
+                or TriggerPinchange
+        channels: list of ChannelDescriptors
+        board: the boards.Board that will send the packets
+        """
+        self.is_timed = isinstance(trigger, TriggerTimed)
+        if self.is_timed:
+            codes = ['L']
+            self.period = trigger.period
+            self.time_scale = trigger.period
+            self.dead_time = board.frequency_dead_time
+        else:
+            codes = ['Q']
+            self.time_scale = board.timestamp_res
+        # timestamps are kept as the integers sent (seconds = ticks * time_scale)
+        self.tick_typecode = tick_typecode(self.is_timed)
+        
+        # Find where each channel's value will be in the tuple made by
+        #       unpacking the packet then appending the bits of the digital bytes.
+        field_for_channel = []
+        digital_fields = []     # indices of digital bytes in unpacked tuple
+        digcount = 0
+        for ch in channels:
+            interp = ch.interpretation
+            if interp.is_analog:
+                field_for_channel.append(len(codes))
+                codes.append('h' if interp.is_signed else 'H')
+            elif interp.is_frequency:
+                field_for_channel.append(len(codes))
+                codes.append('L')
+            else:
+                # bits are numbered after all the unpacked fields
+                field_for_channel.append(-1-digcount)
+                digcount += 1
+                if not (digcount % 8):
+                    digital_fields.append(len(codes))
+                    codes.append('B')
+        if digcount % 8:
+            digital_fields.append(len(codes))
+            codes.append('B')
+        num_fields = len(codes)
+        field_for_channel = [f if f >= 0 else num_fields-1-f for f in field_for_channel]
+        
+        self.struct = struct.Struct(('<' + ''.join(codes)).encode('ascii'))
+        self.packet_length = self.struct.size
+        self.digital_fields = tuple(digital_fields)
+        self.field_for_channel = tuple(field_for_channel)
+        self.num_fields = num_fields
+        # getter always returns a tuple, even for a single value
+        self.getter = itemgetter(0, *field_for_channel)
+        # columns (1-based, as in rows) holding frequency counts
+        self.frequency_columns = tuple(n for n, ch in enumerate(channels, 1)
+                                    if ch.interpretation.is_frequency)
+        if np is not None:
+            self.dtype = np.dtype([(str('f{0}'.format(n)), _NUMPY_TYPES[c])
+                                    for n, c in enumerate(codes)])
+        else:
+            self.dtype = None
+    
+    def decode_batch(self, payloads, prev_tick=None):
+        """Decode a list of payloads into a list of rows.
+        Each row is a list [timestamp in ticks, value for each channel],
+        where a tick is time_scale seconds.
+        prev_tick is the timestamp of the last row decoded before this batch
+        (or None), needed for frequencies from pin-change triggers.
+        """
+        unpack = self.struct.unpack
+        length = self.packet_length
+        getter = self.getter
+        digital_fields = self.digital_fields
+        bits = _BITS
+        rows = []
+        append = rows.append
+        for rd in payloads:
+            if len(rd) != length:
+                # firmware may send trailing bytes; decode the fixed part
+                rd = rd[:length]
+            vals = unpack(rd)
+            for f in digital_fields:
+                vals += bits[vals[f]]
+            append(list(getter(vals)))
+        
+        if self.frequency_columns:
+            self._frequencies(rows, prev_tick)
+        return rows
+    
+    def _frequencies(self, rows, prev_tick):
+        """Convert the edge counts in the frequency columns to frequencies (in Hz)."""
+        if self.is_timed:
+            period = self.period
+            dead_time = self.dead_time
+            for n in self.frequency_columns:
+                for row in rows:
+                    freq = row[n]/period
+                    # estimate how many counts occurred in the dead time
+                    dead_counts = freq * dead_time
+                    if dead_counts > 1:
+                        # compensate for counts in the dead time that would have been missed
+                        freq += (dead_counts-1)/period
+                    row[n] = freq
+        else:
+            # subtract ticks before scaling, so that intervals stay exact
+            #       however long the run
+            scale = self.time_scale
+            for row in rows:
+                if prev_tick is None:
+                    for n in self.frequency_columns:
+                        row[n] = 0
+                else:
+                    dt = (row[0] - prev_tick)*scale
+                    for n in self.frequency_columns:
+                        row[n] = row[n]/dt
+                prev_tick = row[0]
+    
+    def decode_columns(self, payloads, prev_tick=None):
+        """Decode a list of payloads into columns:
+        [timestamps in ticks, values for channel 1, values for channel 2, ...]
+        prev_tick is as for decode_batch.
+        
+        payloads may be a list of bytes-like objects or a comm.FrameRun.
+        Batches of at least NUMPY_MIN_BATCH packets, all of the expected length,
+        are decoded with NumPy (if available) and the columns are NumPy arrays
+        (a FrameRun without copying the payloads).
+        Otherwise the columns are lists.
+        The values are the same either way.
+        """
+        if self.dtype is not None and len(payloads) >= self.NUMPY_MIN_BATCH:
+            if isinstance(payloads, FrameRun) and payloads.length >= self.packet_length:
+                # view the payloads in place, ignoring any trailing bytes
+                packets = payloads.array()[:, :self.packet_length].view(self.dtype)[:, 0]
+                return self._decode_numpy(packets, prev_tick)
+            if set(map(len, payloads)) == set([self.packet_length]):
+                packets = np.frombuffer(b''.join(payloads), dtype=self.dtype)
+                return self._decode_numpy(packets, prev_tick)
+        rows = self.decode_batch(payloads, prev_tick)
+        return [list(col) for col in zip(*rows)]
+    
+    def _decode_numpy(self, packets, prev_tick):
+        """Decode a NumPy array of packets (of dtype self.dtype) all at once."""
+        ticks = packets['f0']
+        columns = [ticks]
+        for n, f in enumerate(self.field_for_channel, 1):
+            if f < self.num_fields:
+                if n in self.frequency_columns:
+                    columns.append(self._numpy_frequencies(packets['f{0}'.format(f)],
+                                ticks, prev_tick))
+                else:
+                    columns.append(packets['f{0}'.format(f)])
+            else:
+                bit = f - self.num_fields
+                byte = packets['f{0}'.format(self.digital_fields[bit >> 3])]
+                columns.append(((byte >> (bit & 7)) & 1).astype(bool))
+        return columns
+    
+    def _numpy_frequencies(self, counts, ticks, prev_tick):
+        """Vectorized version of _frequencies for one column of counts."""
+        if self.is_timed:
+            freq = counts / self.period
+            dead_counts = freq * self.dead_time
+            return np.where(dead_counts > 1, freq + (dead_counts-1)/self.period, freq)
+        ticks = ticks.astype(np.int64)     # signed, in case time goes backwards
+        dt = np.empty(len(ticks), np.float64)
+        dt[1:] = (ticks[1:] - ticks[:-1]) * self.time_scale
+        dt[0] = 1 if prev_tick is None else (int(ticks[0]) - prev_tick) * self.time_scale
+        freq = counts / dt
+        if prev_tick is None:
+            freq[0] = 0
+        return freq
+
+def _drop_rows(columns, rows):
+    """Return columns (lists or NumPy arrays) without the given rows (sorted indices)."""
+    rows = set(rows)
+    return [[v for i, v in enumerate(col) if i not in rows] if isinstance(col, list)
+            else np.delete(col, list(rows)) for col in columns]
+
 class DataAcquisition(object):
     def __init__(self):
-        self._data = []
+        self.spill_rows = 1 << 21       # samples kept in memory; older ones go to disk
+        self.spill_dir = None           # directory for spilled samples (None: system temp)
+        self.monitor_samples = None     # if set, keep only this many latest samples
+        self.monitor_seconds = None     # if set (timed triggers), keep only this many seconds
+        self._data = SampleStore()      # columnar store of all samples
         self.num_saved = 0      # how long was self._data when self.save() was last run
         self._timeoffset = None         # timestamp of first data packet received (sets 0 time)
         self.trigger_error=None         # error message to display on gui for triggering errors
+        self._decoder = None            # PacketDecoder for current configuration
+        self._autosaver = None          # AutoSaver while start_recording() is active
+        self._streams = ()              # open SampleStreams from stream()
+        self.host_offset = None         # host clock() at board time 0 (see _parsedata_batch)
+        self._go_time = None            # _port_clock() when 'G' was last sent
+        self.serial_class = None        # opens the port, if not the usual Serial (see capture.py)
+        self.queue_size = 16384         # packets waiting between reading and decoding
+                                        # (None to decode in the reading thread)
+        self.queue_policy = 'block'     # what to do when the queue is full (see comm.PacketQueue)
+        self.low_latency = False        # set the serial driver's low-latency flag (see comm.CommPort)
     
     def is_timed_trigger(self):
         return self.conf and isinstance(self.conf[0], TriggerTimed)
@@ -163,19 +394,39 @@ class DataAcquisition(object):
         """
 #        print('DEBUG: enter daq.connect', file=sys.stderr)
         self._conncall = call_when_done
-        self.comm = CommPort(port, self._parsedata, self._onconnect, self._onerror)
+        self.comm = CommPort(port, self._parsedata, self._onconnect, self._onerror,
+                data_call_on_batch=self._parsedata_batch,
+                call_on_fault=self._onfault,
+                serial_class=self.serial_class,
+                queue_size=self.queue_size,
+                queue_policy=self.queue_policy,
+                low_latency=self.low_latency)
         self.comm.connect()
+    def _port_clock(self):
+        """The time by the port's clock: a replayed port keeps the capture's time."""
+        return getattr(self.comm.ser, 'clock', clock)()
     def go(self):
         self.trigger_error=None
         self.data_length_before_go = len(self._data)
+        self.host_offset = None
+        self._go_time = self._port_clock()  # the board starts counting after this
+        self._data.gaps.expect(0)       # timed packets are numbered from 0 after 'G'
 #        print("DEBUG: starting with", self.data_length_before_go, "packets",file=sys.stderr)
         self.comm.command(b'G')
     def oneread(self):
         self.trigger_error=None
         self.data_length_before_go = 0 # 'I' command doesn't reset pseudo-timer
+        self.host_offset = None
+        self._go_time = None
+        self._data.gaps.expect(None)
         self.comm.command(b'I')
     def stop(self):
         self.comm.command(b'S')
+        # packets discarded by the hand-off queue at the end of the run
+        # have no later packet to carry their gap
+        self._data.gaps.flush_overflows(len(self._data))
+        for stream in self._streams:
+            stream.flush()
         # redo the setup to remeasure supply voltage
         model = self.comm.command(b'M')
         self.board.setup(model[2:])
@@ -202,6 +453,14 @@ class DataAcquisition(object):
             pin = next(x[1] for x in self.board.eint if x[0] == trigger.pin)
             force_flush =0x10   # always force flush---don't know when next pin interrupt will be
             confsend.extend(struct.pack(b'<BBB', force_flush | 2, sense, pin))
+        # after timer_calc, so that a ring kept for monitor_seconds is sized
+        # for the period the board will actually use
+        if (self._data.num_channels != len(channels)
+                or getattr(self._data, 'capacity', None) != self._monitor_capacity(trigger)):
+            self._close_streams()
+            self._data = self._new_store(channels, trigger)
+        else:
+            self._data.reconfigure(channels)
         arefnum = next(x[1] for x in self.board.aref if x[0] == aref)
         confsend.append(arefnum)
         if not avg:
@@ -212,13 +471,56 @@ class DataAcquisition(object):
             confsend.append(probe& 0xff)
             confsend.append(probe >> 8)
         self.conf = conf
+        self._decoder = PacketDecoder(trigger, channels, self.board)
+        self._data.set_timebase(self._decoder.time_scale, self._decoder.tick_typecode)
 #        print('DEBUG: confsend', confsend, file=sys.stderr)
         self.comm.command(b'C', bytes(confsend))
     
     def data(self):
+        """Return the SampleStore holding all the samples.
+        Use its column() and value() methods to read the data
+        without building a row for each sample.
+        """
         return self._data
+    def gaps(self):
+        """Return the GapIndex of the stored data:
+        where samples were lost (gaps.gaps, gaps.num_dropped())
+        and the counts of checksum, framing, timeout, and overflow events (gaps.counters).
+        """
+        return self._data.gaps
+    def set_monitor(self, samples=None, seconds=None):
+        """Keep only the latest samples, or (for a timed trigger) the latest seconds,
+        of data in a fixed-size RingStore, so that acquisition can run
+        indefinitely in constant memory.  With neither, keep everything.
+        Takes effect at the next config() or clear(), discarding stored data.
+        """
+        self.monitor_samples = samples
+        self.monitor_seconds = seconds
+    def _monitor_capacity(self, trigger):
+        """Number of samples to keep for monitoring with trigger,
+        or None to keep everything.
+        """
+        if self.monitor_seconds and isinstance(trigger, TriggerTimed):
+            return max(8, int(round(self.monitor_seconds / trigger.period)))
+        if self.monitor_samples:
+            return max(8, self.monitor_samples)
+        return None
+    def _new_store(self, channels, trigger=None):
+        if trigger is None and getattr(self, 'conf', None):
+            trigger = self.conf[0]
+        capacity = self._monitor_capacity(trigger)
+        if capacity:
+            store = RingStore(channels, capacity)
+        else:
+            store = SampleStore(channels, self.spill_rows, self.spill_dir)
+        decoder = self._decoder
+        if decoder is not None:
+            store.set_timebase(decoder.time_scale, decoder.tick_typecode)
+        return store
     def clear(self):
-        self._data = []
+        self.stop_recording()
+        self._close_streams()
+        self._data = self._new_store(getattr(self, 'channels', ()))
         self._timeoffset = None
         self.trigger_error=""
         self.num_saved=0
@@ -227,95 +529,77 @@ class DataAcquisition(object):
                 adding notes to the metadata header.
            If convvolts is true, scale by board.power_voltage
               to report measurements in volts.
+           If fn ends with .pdaq, save in the binary format of binfile.py
+              (which always holds the raw readings).
         """
-        if hasattr(self,'conf') and self.conf:
-            use_conf=self.conf
-        else:
-            # configuration never done, probably because no data recorded yet
-            use_conf=new_conf
-        
-        eol = '\r\n' if sys.platform=='win32' else '\n'
-        
-        scale = self.board.power_voltage / 65536.
-        with codecs.open(fn, 'w', 'utf-8') as f:
-            f.write('# PteroDAQ recording{}'.format(eol))
-            f.write('# saved at {0:%Y %b %d %H:%M:%S}{1}'.format(datetime.now(),eol))
-            if len(self.board.names)>1:
-                f.write('# board is one of {0}{1}'.format( ", ".join(self.board.names),eol))
-            else:
-                f.write('# board is {0}{1}'.format(self.board.names[0],eol))
-            if isinstance(use_conf[0], TriggerTimed):
-                f.write('# Recording every {0} sec ({1} Hz){2}'.format(use_conf[0].period, 1./use_conf[0].period,eol))
-            elif isinstance(use_conf[0], TriggerPinchange):
-                f.write('# Recording when {0} {1}{2}'.format(use_conf[0].pin, use_conf[0].sense,eol))
-            f.write('# Analog reference is {0}{1}'.format(use_conf[1],eol))
-            if use_conf[2] != 1:
-                f.write('# Averaging {0} readings together{1}'.format(use_conf[2],eol))
-            f.write('# Power supply is {0:.4f} volts'.format(self.board.power_voltage,eol))
-            if convvolts:
-                f.write('# Scale: 0 to {0:.4f} volts{1}'.format(self.board.power_voltage,eol))
-            else:
-                f.write('# Scale: 0 to 65535{0}'.format(eol))
-            f.write('# Notes:{}'.format(eol))
-            for ln in notes.split('\n'):
-                f.write('#   {0}{1}'.format(ln,eol))
-            x0 = len(self._data)
-            f.write('# {0} samples{1}'.format(x0,eol))
-
-            f.write('# Recording channels:{}'.format(eol))
-            f.write('#   timestamp (in seconds){}'.format(eol))
-            # Use passed-in configuration for names, rather than the ones saved
-            # but use saved for probes and downsampling
-            # Note that channels is the last field of the configuration tuple.
-            for chan_num,(ch_name,ch_probe) in enumerate(zip(new_conf[-1],use_conf[-1])):
-                downsample = ch_probe.interpretation.downsample
-                if downsample>1:
-                    f.write('#   {0} : {1} downsample by {2}\t'.format(ch_name.name, 
-                        self.board.name_from_probe[ch_probe.probe],
-                        downsample))
-                else:
-                    f.write('#   {0} : {1}\t'.format(ch_name.name, 
-                        self.board.name_from_probe[ch_probe.probe]))
-                if x0:
-                    x1 = sum(d[chan_num+1]    for d in self._data)
-                    x2 = sum(d[chan_num+1]**2 for d in self._data)
-                    mean = x1/x0
-                    m2 = max(x2/x0-mean**2, 0)
-                    if convvolts:
-                        ch=self.channels[chan_num]
-                        f.write(" DC= {0:.7g} RMS= {1:.7g}{2}".format(
-                                  ch.volts(mean,self.board.power_voltage), 
-                                  ch.volts(sqrt(m2),self.board.power_voltage),
-                                  eol
-                                ))
-                    else:
-                        f.write(" DC= {0:.7g} RMS= {1:.7g}{2}".format(
-                        	mean, sqrt(m2),eol))
-                else:
-                    f.write(eol)
-            old_time=0
-            time_offset=None
-            for d in self._data:
-                time=d[0]
-                if time_offset==None:
-                    time_offset=time
-                if time<old_time:
-                    time_offset=time
-                    f.write(eol)   # blank line if back in time
-                old_time=time
-            
-                f.write('{0:.7f}'.format(time-time_offset)) # timestamp
-                for n, x in enumerate(d[1:]):
-                    ch = self.channels[n]
-                    f.write('\t')
-                    if convvolts and ch.interpretation.is_analog:
-                        f.write("{0:.6f}".format(ch.volts(x,self.board.power_voltage)))
-                    elif ch.interpretation.is_frequency:
-                    	f.write("{0:.6f}".format(x))
-                    else:
-                        f.write(str(int(x)))
-                f.write(eol)
-        self.num_saved = len(self._data)
+        recording = self._recording_class(fn)(fn, self, notes, convvolts, new_conf)
+        try:
+            recording.write_rows()
+        finally:
+            recording.close()
+        self.num_saved = recording.num_written
+    
+    def start_recording(self, fn, notes, convvolts, new_conf, interval=5.0, every=None):
+        """Start saving into file named fn as the data arrives,
+        appending the samples not yet written every interval seconds
+        (or as soon as every samples are waiting, if every is given).
+        The file has the same format as save() produces;
+        for a text file, the sample count and channel statistics in the header
+        are filled in by stop_recording().
+        """
+        self.stop_recording()
+        recording = self._recording_class(fn)(fn, self, notes, convvolts, new_conf,
+                streaming=True)
+        self._autosaver = AutoSaver(recording, interval, every,
+                call_after_write=self._set_num_saved)
+    
+    def recording_error(self):
+        """Return the exception that stopped the recording started by
+        start_recording() (which stop_recording() will raise), or None.
+        """
+        autosaver = self._autosaver
+        return autosaver.error if autosaver is not None else None
+    
+    def stop_recording(self):
+        """Write any remaining samples and close the file started by start_recording().
+        Does nothing if no recording is in progress.
+        Raises the exception that stopped the recording, if one did.
+        """
+        autosaver, self._autosaver = self._autosaver, None
+        if autosaver is not None:
+            autosaver.close()
+    
+    @staticmethod
+    def _recording_class(fn):
+        return BinaryRecording if is_binary_filename(fn) else TextRecording
+    
+    def stream(self, block_size=1024, max_blocks=16, policy='block', max_wait=None):
+        """Return a SampleStream yielding the samples stored from now on
+        in SampleBlocks of block_size rows, as they arrive:
+                for block in daq.stream(block_size=1024):
+                    ...
+        At most max_blocks blocks are buffered; when the consumer falls that far behind,
+        policy 'block' makes acquisition wait for it, while 'drop-oldest' and
+        'drop-newest' discard blocks (counted in the stream's num_dropped).
+        If max_wait is given, a short block is yielded rather than waiting
+        longer than max_wait seconds.
+        The stream ends when closed, or when clear() or a new configuration
+        replaces the stored data.
+        """
+        stream = SampleStream(self._data, block_size, max_blocks, policy, max_wait,
+                call_on_close=self._remove_stream)
+        self._streams += (stream,)
+        return stream
+    
+    def _remove_stream(self, stream):
+        self._streams = tuple(s for s in self._streams if s is not stream)
+    
+    def _close_streams(self):
+        for stream in self._streams:
+            stream.close()
+    
+    def _set_num_saved(self, num_saved):
+        self.num_saved = num_saved
     
     def _onconnect(self):
         """A callback routine for handshake and other initial communication
@@ -358,63 +642,67 @@ class DataAcquisition(object):
             # Illegal trigger type requested of board
             raise RuntimeError("Error: illegal trigger type requested: {0}".format(err_bytes[1]))
     
+    def _onfault(self, cause, count):
+        """A callback routine for damaged frames, command timeouts,
+        and packets discarded by the hand-off queue.
+        """
+        self._data.gaps.record_error(cause, count)
+    
     def _parsedata(self, rd):
-        # print('DEBUG: dat', repr(rd), file=sys.stderr)
-        if not hasattr(self,'conf'):
+        """Decode and store a single data packet (payload bytes rd)."""
+        self._parsedata_batch((rd,))
+    
+    def _parsedata_batch(self, payloads):
+        """Decode and store a batch of data packets (a list of payload bytes),
+        using the PacketDecoder compiled by config().
+        
+        Also keeps host_offset, the host clock() time corresponding to
+        board time 0 in the current run: a sample cannot arrive before
+        it was taken, so the smallest (arrival time - timestamp) seen
+        is the best estimate, off only by the shortest transfer delay.
+        """
+        host_time = clock()
+        # print('DEBUG: dat', repr(payloads), file=sys.stderr)
+        decoder = self._decoder
+        if decoder is None:
             # No configuration sent yet.  Old packet in queue
             print("Warning: ignoring data packet before configuration set",file=sys.stderr)
             return
-        if self.is_timed_trigger():
-            ts = struct.unpack_from(b'<L', rd)[0]
-            ts *= self.conf[0].period
-            pos = 4
+        data = self._data
+        num_before = len(data)
+        columns = decoder.decode_columns(payloads,
+                        data.ticks(-1)[0] if num_before else None)
+        if not columns:
+            return
+        if decoder.is_timed:
+            max_sequence = None
+            if self._go_time is not None:
+                # the board cannot have taken more samples than its clock
+                # (give or take 1%) allows since 'G' was sent
+                elapsed = self._port_clock() - self._go_time
+                max_sequence = int(elapsed * 1.01 / decoder.period) + 1
+            rejected = data.gaps.check_sequence(num_before, columns[0], max_sequence)
+            if rejected:
+                columns = _drop_rows(columns, rejected)
+                if not len(columns[0]):
+                    return
         else:
-            ts = struct.unpack_from(b'<Q', rd)[0]
-            ts *= self.board.timestamp_res
-            pos = 8
-        digbuf = bytearray()
-        results = [ts] + [None] * len(self.channels)
-        digcount = 0
-        for n, ch in enumerate(self.channels, 1):
-            if ch.interpretation.is_analog:
-                results[n] = struct.unpack_from(b'<h' if ch.interpretation.is_signed else b'<H', rd, pos)[0]
-                pos += 2
-            elif ch.interpretation.is_frequency:
-                count = struct.unpack_from(b'<L', rd, pos)[0]
-                if self.is_timed_trigger():
-                    freq = count/self.conf[0].period
-                    # estimate how many counts occurred in the dead time
-                    dead_counts =  freq *self.board.frequency_dead_time 
-                    if dead_counts > 1:
-                        # compensate for counts in the dead time that would have been missed
-                        freq += (dead_counts-1)/self.conf[0].period
-                    results[n] = freq
-                elif self._data:
-                    results[n] = count/(ts - self._data[-1][0])
+            data.gaps.flush_pending(num_before)
+        num_new = len(columns[0])
+        if decoder.frequency_columns and num_before < 2 <= num_before+num_new:
+            # replace the bogus first reading by duplicating second
+            for n in decoder.frequency_columns:
+                second = columns[n][1-num_before]
+                if num_before:
+                    data.set_value(0, n, second)
                 else:
-                    results[n] = 0   
-                if len(self._data)==1:
-                    # replace the bogus first reading by duplicating second
-#                    print("DEBUG: replacing freq[0]", self._data[0][n], "with", results[n], file=sys.stderr)
-                    self._data[0][n] = results[n]   
-                pos += 4
-            else:
-                digcount += 1
-                if not (digcount % 8):
-                    digbuf.append(rd[pos])
-                    pos += 1
-        if digcount % 8:
-            digbuf.append(rd[pos])
-        bitcount = 0
-        bufpos = 0
-        for n, res in enumerate(results):
-            if res is None:
-                results[n] = bool((digbuf[bufpos] >> bitcount) & 1)
-                bitcount += 1
-                if bitcount == 8:
-                    bitcount = 0
-                    bufpos += 1
-        for n in range(len(self.channels)):
-            if len(self._data) % self.channels[n].interpretation.downsample:
-                results[n+1] = self._data[-1][n+1]
-        self._data.append(results)
+                    columns[n][0] = second
+        data.append_columns(columns)   # the store handles downsampling
+        offset = host_time - data.value(len(data)-1, 0)
+        if self.host_offset is None or offset < self.host_offset:
+            self.host_offset = offset
+        autosaver = self._autosaver
+        if autosaver is not None:
+            autosaver.notify(len(data))
+        for stream in self._streams:
+            stream.notify(len(data))
@@ -0,0 +1,402 @@
+"""A software PteroDAQ board behind a pseudo-terminal (Posix).
+
+BoardEmulator speaks protocol v0.3 (see the PROTOCOL comments in core.py
+and firmware/commands.c) on the master side of a pty,
+so that CommPort, unmodified, can connect to the slave side (emulator.port)
+as if to a board on a USB serial port:
+        emulator = BoardEmulator(model=7)
+        emulator.start()
+        daq.connect(emulator.port, call_when_done)
+        ...
+        emulator.close()
+or, from the daq directory,
+        python emulator.py --model 7
+which prints the port to connect to (for instance with python -m daq record).
+Generating samples takes Python time, so for sampling rates above a few kHz
+run the emulator in its own process, as above, rather than beside the host
+in one process.
+
+It emulates each board model of boards.py:
+its 'M' response (model number, bandgap reading for the chosen supply voltage,
+and CPU clock), its timer (the period set by the 'C' command is what
+the board's timer_period() makes of the parameters), and its timestamps
+(4-byte sequence numbers for timed triggers, 8-byte timer ticks for pin changes).
+Samples come from synthetic waveforms (see Waveforms), packed the way
+the firmware packs them, and go through a queue of the firmware's size:
+if the host does not keep up, the queue fills and samples are lost,
+leaving a gap in the sequence numbers, as on a real board.
+
+Faults can be injected at chosen rates: damaged checksums, dropped bytes,
+and (with max_rate) triggering faster than the board can handle,
+which the firmware reports with '!E' error 1.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import math
+import errno
+import fcntl
+import select
+import struct
+import random
+from threading import Thread
+from timeit import default_timer as clock
+
+from boards import Board, ArduinoAVR, getboardinfo
+
+# model number: (CPU clock in kHz, supply voltage, firmware QUEUE_SIZE in bytes)
+MODELS = {
+    1: (16000, 5.0, 1024),
+    2: (16000, 5.0, 1024),
+    3: (16000, 5.0, 1024),
+    4: (16000, 5.0, 1024),
+    5: (48000, 3.3, 8192),
+    6: (72000, 3.3, 32768),
+    7: (48000, 3.3, 4096),
+    }
+
+FIRMWARE_VERSION = b'v0.3'
+HANDSHAKE_CODE = b'DAQ'
+MAX_COMMAND_DATA = 64       # longer commands are ignored, as by the firmware
+PACKETS_PER_PASS = 4096     # most data packets generated between checks for commands
+
+
+def _frame(start, body):
+    frame = bytearray(start)
+    frame.extend(body)
+    frame.append(-sum(frame) % 256)
+    return frame
+
+
+class Waveforms(object):
+    """The synthetic signals sampled by a BoardEmulator.
+    Channels are numbered from 0 within each kind, in configuration order;
+    t is the time in seconds since the run started.
+    Replace the methods (or pass another object with the same methods)
+    for other signals.
+    """
+    def analog(self, k, t):
+        """Fraction of full scale (0 to 1) on analog channel k:
+        a sine wave of (k+1) Hz between 0.1 and 0.9.
+        """
+        return 0.5 + 0.4*math.sin(2*math.pi*(k+1)*t)
+
+    def differential(self, k, t):
+        """Fraction of full scale (-0.5 to 0.5) on differential channel k."""
+        return 0.4*math.sin(2*math.pi*(k+1)*t)
+
+    def digital(self, k, t):
+        """Level (0 or 1) of digital channel k: a square wave of (k+1)/2 Hz."""
+        return int(t*(k+1)) & 1
+
+    def frequency(self, k, t0, t1):
+        """Number of rising edges between times t0 and t1 on frequency channel k:
+        a square wave of 1000*(k+1) Hz.
+        """
+        f = 1000.*(k+1)
+        return int(math.floor(t1*f)) - int(math.floor(t0*f))
+
+
+class BoardEmulator(object):
+    def __init__(self, model=7, power_voltage=None, khz=None, waveforms=None,
+                 pin_rate=100., max_rate=None,
+                 checksum_error_rate=0., dropped_byte_rate=0., seed=None):
+        """model: board model number (a key of Board.by_id)
+        power_voltage, khz: supply voltage and CPU clock (default: typical for the model)
+        waveforms: the signals to sample (default Waveforms())
+        pin_rate: triggers per second for a pin-change trigger
+        max_rate: if given, the fastest the board can trigger;
+                faster timed triggers are missed and reported with '!E' error 1
+        checksum_error_rate: probability that a data packet has a bad checksum
+        dropped_byte_rate: probability that a data packet loses one byte
+        seed: for the random faults
+        """
+        if model not in Board.by_id:
+            raise ValueError('no board model {0}'.format(model))
+        default_khz, default_voltage, self.queue_size = MODELS[model]
+        self.khz = khz or default_khz
+        self.power_voltage = power_voltage or default_voltage
+        board_class = Board.by_id[model]
+        bandgap_reading = int(round(65536. * board_class.bandgap / self.power_voltage))
+        self.model_info = struct.pack('<HHL', model, bandgap_reading, self.khz)
+        self.board = getboardinfo(self.model_info)
+        self.waveforms = waveforms or Waveforms()
+        self.pin_rate = pin_rate
+        self.max_rate = max_rate
+        self.checksum_error_rate = checksum_error_rate
+        self.dropped_byte_rate = dropped_byte_rate
+        self._random = random.Random(seed)
+        self._adc_mask = 0xffc0 if isinstance(self.board, ArduinoAVR) else 0xffff  # 10-bit ADC
+        self._differential_muxes = set(d[1] for d in self.board.differentials)
+
+        self.num_packets = 0        # data packets sent
+        self.num_lost = 0           # data packets lost because the queue was full
+        self.num_faults = 0         # data packets damaged on purpose
+        self.commands = []          # command bytes received, in order
+
+        self._conf = None
+        self._running = False
+        self._start = clock()       # host clock() at 'G' (or 'H'): time 0 of the board's timer
+        self._interval = None       # seconds between triggers while running
+        self._next_trigger = 0.
+        self._last_time = 0.
+        self._readcount = 0         # triggers since 'G' (the timed trigger's sequence number)
+        self._trigger_errors = 0
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()  # bytes waiting for the host: the firmware's queue
+        self._thread = None
+        self._alive = False
+
+        self.master, self._slave = os.openpty()
+        self.port = os.ttyname(self._slave)
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def start(self):
+        """Start answering the host from a background thread."""
+        self._alive = True
+        self._thread = Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the background thread and close the pty."""
+        self._alive = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _serve(self):
+        master = self.master
+        while self._alive:
+            timeout = 0.1
+            if self._running:
+                timeout = max(0, min(timeout, self._next_trigger - (clock() - self._start)))
+            wlist = [master] if self._outbuf else []
+            try:
+                rlist, wlist, xlist = select.select([master], wlist, [], timeout)
+            except (OSError, select.error):
+                return
+            if rlist:
+                try:
+                    self._inbuf.extend(os.read(master, 4096))
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EIO):
+                        raise
+                self._parse_commands()
+            if self._running:
+                self._trigger_due()
+            if self._outbuf:
+                try:
+                    written = os.write(master, bytes(self._outbuf))
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EIO):
+                        raise
+                    written = 0
+                del self._outbuf[:written]
+
+    def _parse_commands(self):
+        """Handle every complete command frame in the input,
+        skipping bytes before a '!' and ignoring frames with bad checksums,
+        as firmware's handle_command does.
+        """
+        buf = self._inbuf
+        while True:
+            start = buf.find(b'!')
+            if start < 0:
+                del buf[:]
+                return
+            del buf[:start]
+            if len(buf) < 3:
+                return
+            length = buf[2]
+            if length > MAX_COMMAND_DATA:
+                del buf[:1]
+                continue
+            if len(buf) < length + 4:
+                return
+            frame, rest = buf[:length+4], buf[length+4:]
+            buf[:] = rest
+            if sum(frame) & 0xff:
+                continue
+            self._command(frame[1:2], bytes(frame[3:-1]))
+
+    def _respond(self, cmd, data=b''):
+        self._outbuf.extend(_frame(b'!', bytearray(cmd) + bytearray([len(data)]) + bytearray(data)))
+
+    def _report_error(self, code, extra=b''):
+        self._respond(b'E', bytearray([code]) + bytearray(extra))
+
+    def _command(self, cmd, data):
+        self.commands.append(bytes(cmd))
+        if cmd == b'V':
+            self._respond(cmd, FIRMWARE_VERSION)
+        elif cmd == b'C':
+            self._configure(bytearray(data))
+            self._respond(cmd)
+        elif cmd == b'G':
+            if self._conf is not None:
+                self._start_running()
+            self._respond(cmd)
+        elif cmd == b'S':
+            self._running = False
+            self._respond(cmd)
+        elif cmd == b'I':
+            if self._conf is not None:
+                self._trigger(clock() - self._start)
+            self._respond(cmd)
+        elif cmd == b'H':
+            self._running = False
+            del self._outbuf[:]     # queue_clear
+            self._readcount = 0
+            self._start = clock()
+            self._respond(cmd, HANDSHAKE_CODE)
+        elif cmd == b'M':
+            self._respond(cmd, self.model_info)
+
+    def _configure(self, buf):
+        """Parse a 'C' command as firmware's parse_config does."""
+        trigtype = buf[0] & ~0x10
+        if trigtype == 1:
+            prescale, reload = struct.unpack_from('<BL', buf, 1)
+            period = self.board.timer_period(prescale, reload)
+            ind = 6
+        elif trigtype == 2:
+            period = None
+            ind = 3
+        else:
+            self._report_error(2, bytearray([trigtype]))
+            return
+        ind += 2        # analog reference and averaging
+        channels = []
+        counts = {}
+        while ind + 1 < len(buf):
+            kind, choice = buf[ind], buf[ind+1]
+            ind += 2
+            if kind == 1 and choice in self._differential_muxes:
+                kind = 'differential'
+            kind = {1: 'analog', 2: 'digital', 3: 'frequency'}.get(kind, kind)
+            channels.append((kind, counts.get(kind, 0)))
+            counts[kind] = counts.get(kind, 0) + 1
+        self._conf = (trigtype, period, channels)
+
+    def _start_running(self):
+        trigtype, period, channels = self._conf
+        self._start = clock()
+        self._readcount = 0
+        self._trigger_errors = 0
+        self._last_time = 0.
+        if trigtype == 1:
+            interval = period
+            if self.max_rate and period < 1./self.max_rate:
+                interval = 1./self.max_rate     # the triggers in between are missed
+        else:
+            interval = 1./self.pin_rate
+        self._interval = interval
+        self._next_trigger = 0.     # timed triggers start at time ~0
+        if trigtype == 2:
+            self._next_trigger = interval
+        self._running = True
+
+    def _trigger_due(self):
+        """Trigger for every interval that has passed (up to PACKETS_PER_PASS)."""
+        now = clock() - self._start
+        for n in range(PACKETS_PER_PASS):
+            if self._next_trigger > now or not self._running:
+                return
+            self._trigger(self._next_trigger)
+            self._next_trigger += self._interval
+
+    def _trigger(self, t):
+        """Take one sample at time t (seconds since 'G') and queue its packet,
+        as firmware's trigger_handler does.
+        """
+        trigtype, period, channels = self._conf
+        self._readcount += 1
+        if trigtype == 1:
+            payload = bytearray(struct.pack('<L', (self._readcount - 1) & 0xffffffff))
+            t = (self._readcount - 1) * period
+            if self._running and self._interval > period:
+                self._trigger_errors += 1
+                if self._trigger_errors & 0x3ff == 1:
+                    self._report_error(1)
+        else:
+            payload = bytearray(struct.pack('<Q', int(t / self.board.timestamp_res)))
+        waveforms = self.waveforms
+        bits = 0
+        num_bits = 0
+        for kind, k in channels:
+            if kind == 'analog':
+                value = int(min(max(waveforms.analog(k, t), 0), 65535/65536.) * 65536)
+                payload.extend(struct.pack('<H', value & self._adc_mask))
+            elif kind == 'differential':
+                value = int(min(max(waveforms.differential(k, t), -0.5), 0.5) * 65535)
+                payload.extend(struct.pack('<h', value))
+            elif kind == 'frequency':
+                payload.extend(struct.pack('<L', waveforms.frequency(k, self._last_time, t)))
+            else:
+                bits |= (waveforms.digital(k, t) & 1) << num_bits
+                num_bits += 1
+                if num_bits == 8:
+                    payload.append(bits)
+                    bits = num_bits = 0
+        if num_bits:
+            payload.append(bits)
+        self._last_time = t
+        frame = _frame(b'*', bytearray([len(payload)]) + payload)
+        if len(self._outbuf) + len(frame) > self.queue_size:
+            self.num_lost += 1      # queue full: the firmware skips the sample
+            return
+        frame = self._inject_faults(frame)
+        self._outbuf.extend(frame)
+        self.num_packets += 1
+
+    def _inject_faults(self, frame):
+        rnd = self._random
+        if self.checksum_error_rate and rnd.random() < self.checksum_error_rate:
+            frame[-1] = (frame[-1] + 1) & 0xff
+            self.num_faults += 1
+        elif self.dropped_byte_rate and rnd.random() < self.dropped_byte_rate:
+            del frame[rnd.randrange(len(frame))]
+            self.num_faults += 1
+        return frame
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Emulate a PteroDAQ board on a pseudo-terminal.')
+    parser.add_argument('--model', type=int, default=7, choices=sorted(MODELS),
+            help='board model number (see boards.py; default 7, Teensy LC)')
+    parser.add_argument('--voltage', type=float, help='supply voltage')
+    parser.add_argument('--pin-rate', type=float, default=100.,
+            help='triggers per second for pin-change triggers')
+    parser.add_argument('--max-rate', type=float,
+            help='fastest timed trigger rate before triggers are missed')
+    parser.add_argument('--checksum-errors', type=float, default=0.,
+            help='probability of a bad checksum on each data packet')
+    parser.add_argument('--dropped-bytes', type=float, default=0.,
+            help='probability of a byte dropped from each data packet')
+    args = parser.parse_args(argv)
+    emulator = BoardEmulator(args.model, args.voltage, pin_rate=args.pin_rate,
+            max_rate=args.max_rate, checksum_error_rate=args.checksum_errors,
+            dropped_byte_rate=args.dropped_bytes)
+    emulator.start()
+    print('Emulating {0} on {1}'.format(emulator.board.names[0], emulator.port))
+    sys.stdout.flush()
+    try:
+        while emulator._thread.is_alive():
+            emulator._thread.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+        print('{0} data packets sent, {1} lost from a full queue, {2} damaged'.format(
+                emulator.num_packets, emulator.num_lost, emulator.num_faults))
+
+
+if __name__ == '__main__':
+    main()
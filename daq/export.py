@@ -0,0 +1,367 @@
+"""Writing recordings to text files.
+
+TextRecording writes the tab-separated PteroDAQ text format
+(a '#'-commented metadata header, then one line per sample,
+then, if any samples were lost or link errors counted, a '#'-commented
+summary of them and a list of the gaps).
+It can write a whole recording at once (as DataAcquisition.save does),
+or be kept open to append only the samples that arrived since the last write,
+with the sample count and channel statistics in the header
+filled in when the recording is closed.
+Those header fields have a fixed width (the count right-aligned,
+DC and RMS each right-aligned in 14 characters, "nan" when there are no samples),
+whichever way the file is written, so a streamed recording and one
+written at once have the same layout.
+
+AutoSaver does those appends from a background thread,
+on a timer or whenever enough new samples have arrived.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import io
+import os
+import sys
+from datetime import datetime
+from threading import Thread, Event
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional, used only to convert to volts faster
+    np = None
+
+
+def _volts_converter(gain, power_voltage):
+    """Return a function converting a column of raw analog readings to volts,
+    with the same arithmetic as ChannelDescriptor.volts
+    (so the results are identical to the last bit).
+    """
+    if np is not None:
+        def convert(values):
+            return (np.asarray(values, dtype=np.float64)/65536.*power_voltage/gain).tolist()
+    else:
+        def convert(values):
+            return [x/65536.*power_voltage/gain for x in values]
+    return convert
+
+
+class TextRecording(object):
+    """A text recording file for the data of a DataAcquisition.
+
+    If streaming is false, the header is written with the statistics
+    of all the samples currently stored, and write_rows() should then
+    be called once to write them.
+    If streaming is true, the header is written with the sample count
+    and statistics as they are at the start, which close() overwrites
+    in place with the final values (the fields have a fixed width).
+    """
+    COUNT_FORMAT = '# {0:>16} samples'
+    STATS_FORMAT = ' DC= {0:>14.7g} RMS= {1:>14.7g}'
+    BLOCK_ROWS = 8192   # rows formatted and written together
+
+    def __init__(self, fn, daq, notes, convvolts, new_conf, streaming=False):
+        """fn: name of file to write
+        daq: the DataAcquisition whose data is saved
+        notes: string added to the metadata header
+        convvolts: if true, scale analog channels by board.power_voltage
+                to report measurements in volts.
+        new_conf: configuration from the GUI, used for channel names
+                (and for everything, if daq has never been configured)
+        """
+        if getattr(daq, 'conf', None):
+            self.conf = daq.conf
+        else:
+            # configuration never done, probably because no data recorded yet
+            self.conf = new_conf
+        self.new_conf = new_conf
+        self.board = daq.board
+        self.data = daq.data()
+        self.convvolts = convvolts
+        self.streaming = streaming
+        self.eol = '\r\n' if sys.platform=='win32' else '\n'
+        self.num_written = 0    # number of the next sample to write
+        self.num_samples = 0    # number of samples in the file
+        self.first_written = None   # number of the first sample written
+        self._old_time = 0
+        self._time_offset = None
+        self._patches = []      # (file offset, length, function returning text)
+        self._plan = None       # (row format, converters) from _format_plan()
+        self._restarts = []
+        self._f = io.open(fn, 'wb')
+        self._write_header(notes)
+
+    def _write(self, text):
+        self._f.write(text.encode('utf-8'))
+
+    def _write_patchable(self, text_func):
+        """Write text_func() now, and if streaming, again when the file is closed."""
+        text = text_func().encode('utf-8')
+        if self.streaming:
+            self._patches.append((self._f.tell(), len(text), text_func))
+        self._f.write(text)
+
+    def _count_text(self):
+        if self.streaming:
+            return self.COUNT_FORMAT.format(self.num_samples)
+        return self.COUNT_FORMAT.format(len(self.data) - self.data.first_row)
+
+    def _write_header(self, notes):
+        eol = self.eol
+        board = self.board
+        use_conf = self.conf
+        self._write('# PteroDAQ recording{}'.format(eol))
+        self._write('# saved at {0:%Y %b %d %H:%M:%S}{1}'.format(datetime.now(),eol))
+        if len(board.names)>1:
+            self._write('# board is one of {0}{1}'.format( ", ".join(board.names),eol))
+        else:
+            self._write('# board is {0}{1}'.format(board.names[0],eol))
+        trigger = use_conf[0]
+        if hasattr(trigger, 'period'):
+            self._write('# Recording every {0} sec ({1} Hz){2}'.format(trigger.period, 1./trigger.period,eol))
+        else:
+            self._write('# Recording when {0} {1}{2}'.format(trigger.pin, trigger.sense,eol))
+        self._write('# Analog reference is {0}{1}'.format(use_conf[1],eol))
+        if use_conf[2] != 1:
+            self._write('# Averaging {0} readings together{1}'.format(use_conf[2],eol))
+        self._write('# Power supply is {0:.4f} volts'.format(board.power_voltage,eol))
+        if self.convvolts:
+            self._write('# Scale: 0 to {0:.4f} volts{1}'.format(board.power_voltage,eol))
+        else:
+            self._write('# Scale: 0 to 65535{0}'.format(eol))
+        self._write('# Notes:{}'.format(eol))
+        for ln in notes.split('\n'):
+            self._write('#   {0}{1}'.format(ln,eol))
+        self._write_patchable(self._count_text)
+        self._write(eol)
+
+        self._write('# Recording channels:{}'.format(eol))
+        self._write('#   timestamp (in seconds){}'.format(eol))
+        # Use passed-in configuration for names, rather than the ones saved
+        # but use saved for probes and downsampling
+        # Note that channels is the last field of the configuration tuple.
+        for chan_num,(ch_name,ch_probe) in enumerate(zip(self.new_conf[-1],use_conf[-1])):
+            downsample = ch_probe.interpretation.downsample
+            if downsample>1:
+                self._write('#   {0} : {1} downsample by {2}\t'.format(ch_name.name,
+                    board.name_from_probe[ch_probe.probe],
+                    downsample))
+            else:
+                self._write('#   {0} : {1}\t'.format(ch_name.name,
+                    board.name_from_probe[ch_probe.probe]))
+            self._write_patchable(lambda n=chan_num: self._stats_text(n))
+            self._write(eol)
+
+    def _stats_text(self, chan_num):
+        """Return the DC and RMS summary for channel chan_num (counting from 0),
+        with nan for both if there are no samples.
+        """
+        stats = self.data.stats(chan_num+1)
+        if not stats.count:
+            return self.STATS_FORMAT.format(float('nan'), float('nan'))
+        if self.convvolts:
+            ch = self.conf[-1][chan_num]
+            power_voltage = self.board.power_voltage
+            return self.STATS_FORMAT.format(
+                    ch.volts(stats.mean,power_voltage),
+                    ch.volts(stats.rms,power_voltage))
+        return self.STATS_FORMAT.format(stats.mean, stats.rms)
+
+    def _format_plan(self):
+        """Return the row format (for the % operator)
+        and a list of conversion functions, one per channel (None for no conversion),
+        so that formatting a row needs no per-cell decisions.
+        Each conversion takes a column of values and returns a list.
+        """
+        formats = ['%.7f']      # timestamp
+        converters = []
+        power_voltage = self.board.power_voltage
+        for ch in self.conf[-1]:
+            interp = ch.interpretation
+            if self.convvolts and interp.is_analog:
+                formats.append('%.6f')
+                converters.append(_volts_converter(interp.gain, power_voltage))
+            elif interp.is_frequency:
+                formats.append('%.6f')
+                converters.append(None)
+            else:
+                # '%d' truncates floats like str(int(x)) does
+                formats.append('%d')
+                converters.append(None)
+        return '\t'.join(formats) + self.eol, converters
+
+    def write_rows(self, stop=None):
+        """Write the samples from num_written up to (not including) stop
+        (default, all samples stored), skipping any no longer retained.
+        Returns the number of samples written.
+        Rows are formatted BLOCK_ROWS at a time,
+        and each block is written with a single write.
+        """
+        data = self.data
+        start = self.num_written
+        if stop is None:
+            stop = len(data)
+        if stop <= start:
+            return 0
+        if self._plan is None:
+            self._plan = self._format_plan()
+        row_format, converters = self._plan
+        num_before = self.num_samples
+        block_start = start
+        while block_start < stop:
+            with data.lock:
+                # skip any rows a RingStore has already overwritten
+                block_start = max(block_start, data.first_row)
+                block_stop = min(block_start+self.BLOCK_ROWS, stop)
+                if block_stop <= block_start:
+                    break
+                if self.first_written is None:
+                    self.first_written = block_start
+                columns = [data.column(n, block_start, block_stop)
+                           for n in range(len(converters)+1)]
+            columns[0] = self._times(columns[0])
+            for n, convert in enumerate(converters, 1):
+                if convert is not None:
+                    columns[n] = convert(columns[n])
+            lines = [row_format % row for row in zip(*columns)]
+            for i in self._restarts:
+                lines[i] = self.eol + lines[i]   # blank line if back in time
+            self._f.write(''.join(lines).encode('utf-8'))
+            self.num_samples += len(lines)
+            block_start = block_stop
+        self.num_written = stop
+        return self.num_samples - num_before
+
+    def _times(self, times):
+        """Return the timestamps relative to the start of their run,
+        recording in self._restarts the indexes where time went backwards.
+        """
+        old_time = self._old_time
+        time_offset = self._time_offset
+        if time_offset is None:
+            time_offset = times[0]
+        restarts = []
+        relative = []
+        for i, time in enumerate(times):
+            if time < old_time:
+                time_offset = time
+                restarts.append(i)
+            old_time = time
+            relative.append(time-time_offset)
+        self._old_time = old_time
+        self._time_offset = time_offset
+        self._restarts = restarts
+        return relative
+
+    def flush(self):
+        """Push everything written so far out to the disk."""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _write_gaps(self):
+        """Write a comment line summarizing the samples lost and the link errors,
+        if there were any, then one for each gap among the samples written,
+        numbering the samples in the file from 0.
+        The summary goes at the end rather than in the header,
+        as its length is not known until the recording is finished.
+        """
+        gaps = self.data.gaps
+        if not (len(gaps) or any(gaps.counters.values())):
+            return
+        self._write('# ' + gaps.describe() + self.eol)
+        first = self.first_written
+        if first is None:
+            return
+        lines = ['# {0} samples dropped before sample {1} ({2}){3}'.format(
+                        count, row-first, cause, self.eol)
+                 for row, count, cause in list(gaps.gaps)
+                 if first <= row <= self.num_written]
+        if lines:
+            self._write('# Gaps:' + self.eol + ''.join(lines))
+
+    def close(self):
+        """Finish the file.
+        If streaming, any samples not yet written are written,
+        and the sample count and statistics in the header are rewritten.
+        """
+        if self._f.closed:
+            return
+        try:
+            if self.streaming:
+                self.write_rows()
+            self._write_gaps()
+            for offset, length, text_func in self._patches:
+                text = text_func().encode('utf-8')
+                if len(text) != length:
+                    raise ValueError('header field {0!r} no longer fits'.format(text))
+                self._f.seek(offset)
+                self._f.write(text)
+        finally:
+            self._f.close()
+
+
+class AutoSaver(object):
+    """Appends new samples to a streaming TextRecording from a background thread.
+
+    Samples are written every interval seconds,
+    or sooner once at least every samples are waiting (if every is given),
+    and each write is flushed to disk,
+    so a crash loses at most the samples since the last write.
+    If a write fails (the disk is full, say), autosaving stops,
+    error is set to the exception, and close() raises it.
+    """
+    def __init__(self, recording, interval=5.0, every=None, call_after_write=None):
+        """recording: TextRecording opened with streaming=True
+        call_after_write: if given, called with the number of samples
+                written so far after each write
+        """
+        self.recording = recording
+        self.interval = interval
+        self.every = every
+        self._call_after_write = call_after_write
+        self.error = None       # the exception that stopped autosaving, if any
+        self._wake = Event()
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def notify(self, num_samples):
+        """Called (from the acquisition thread) with the number of samples stored.
+        Wakes the writer early if enough samples are waiting.
+        """
+        if self.every and num_samples - self.recording.num_written >= self.every:
+            self._wake.set()
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self._write()
+            except Exception as e:
+                self.error = e
+                return
+
+    def _write(self):
+        if self.recording.write_rows():
+            self.recording.flush()
+            if self._call_after_write is not None:
+                self._call_after_write(self.recording.num_written)
+
+    def close(self):
+        """Stop the background thread, write any remaining samples,
+        and finish the recording.
+        Raises the exception that stopped autosaving, if one did.
+        """
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        if self.error is not None:
+            try:
+                self.recording.close()
+            except Exception:
+                pass    # the first error is the one to report
+            raise self.error
+        self.recording.close()
+        if self._call_after_write is not None:
+            self._call_after_write(self.recording.num_written)
@@ -5,10 +5,30 @@ import fcntl
 import struct
 import select
 import errno
+from threading import Lock
+from timeit import default_timer as clock
 
 plat_linux = sys.platform.startswith('linux')
 plat_osx = sys.platform.startswith('darwin')
 
+# Linux serial driver settings (struct serial_struct),
+# for the low-latency flag: type, line, port, irq, flags, ...
+TIOCGSERIAL = getattr(termios, 'TIOCGSERIAL', 0x541E)
+TIOCSSERIAL = getattr(termios, 'TIOCSSERIAL', 0x541F)
+ASYNC_LOW_LATENCY = 1 << 13
+_serial_flags = struct.Struct('iiIii')
+SERIAL_STRUCT_SIZE = 128        # at least sizeof(struct serial_struct)
+
+if hasattr(os, 'readv'):
+    def _readinto(fd, buffer):
+        return os.readv(fd, [buffer])
+else:
+    # Python 2: read, then copy
+    def _readinto(fd, buffer):
+        data = os.read(fd, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
 class Serial(object):
     """A Posix serial port.
     
@@ -18,8 +38,21 @@ class Serial(object):
         """Open and initialize the serial port at path fn.
         
         Sets up a non-blocking, raw, 8N1, 1 Mbaud port.
+        write_timeout (seconds, default 5, None for no limit)
+        bounds how long write() waits for a full port to take the data.
+        low_latency (default False) asks a Linux serial driver
+        to hand over received bytes at once rather than batching them
+        (its ASYNC_LOW_LATENCY flag, restored on close);
+        self.low_latency tells whether the driver accepted.
+        Whether that shortens response times depends on the driver:
+        many (USB CDC ACM, pseudo-terminals) ignore or refuse it.
         """
-        self._rdcnt = 0
+        self.syscalls = 0       # count of select and read/write calls made
+        self.write_timeout = args.get('write_timeout', 5.0)
+        self._write_lock = Lock()   # keeps writes from different threads whole
+        low_latency = args.get('low_latency', False)
+        self.low_latency = False    # True once the driver's low-latency flag is set
+        self._saved_serial = None   # driver settings to restore on close
         
         custombaud = False # on osx, B1000000 might not be defined
          # but we can set the baudrate another way
@@ -57,9 +90,29 @@ class Serial(object):
             # use osx-specific IOSSIOSPEED ioctl to set baudrate
             fcntl.ioctl(self.fd, 0x80045402, struct.pack('I', 1000000))
         
+        if low_latency and plat_linux:
+            self._set_low_latency()
+        
         # flush input
         termios.tcflush(self.fd, termios.TCIFLUSH)
     
+    def _set_low_latency(self):
+        """Set the driver's ASYNC_LOW_LATENCY flag, if it has one
+        (USB CDC and pseudo-terminals may not), keeping the old settings.
+        """
+        settings = bytearray(SERIAL_STRUCT_SIZE)
+        try:
+            fcntl.ioctl(self.fd, TIOCGSERIAL, settings)
+            saved = bytes(settings)
+            fields = list(_serial_flags.unpack_from(settings))
+            fields[4] |= ASYNC_LOW_LATENCY
+            _serial_flags.pack_into(settings, 0, *fields)
+            fcntl.ioctl(self.fd, TIOCSSERIAL, settings)
+        except (IOError, OSError):
+            return
+        self._saved_serial = saved
+        self.low_latency = True
+    
     def read(self, n):
         """Reads n characters from the port
         
@@ -74,11 +127,13 @@ class Serial(object):
         while remaining:
             try:
                 # check if ready to read with 1 sec timeout
+                self.syscalls += 1
                 rlist, wlist, xlist = select.select([self.fd], [], [], 1.0)
                 if not rlist:
                     # not ready to read
                     break
                 # read up to however many we still need
+                self.syscalls += 1
                 buf = os.read(self.fd, remaining)
                 remaining -= len(buf)
                 result.append(buf)
@@ -90,28 +145,110 @@ class Serial(object):
         
         return b''.join(result)
     
-    def write(self, d):
-        """Write the given bytestring to the port.
+    def read_some(self, n):
+        """Reads up to n characters from the port, returning
+        whatever is available without waiting for all n.
         
-        Should be bytes (py3) / str (py2) object.
+        If nothing is available, waits up to 1 sec for something to arrive,
+        returning an empty string on timeout.
+        When data is streaming in, this takes one system call per read,
+        as select is only needed when the port has nothing waiting.
+        (With VMIN and VTIME 0, an empty port may return nothing
+        rather than raising EAGAIN, so both mean "wait".)
         
-        Blocking write: waits until all data written.
+        Return value is bytes (py3) / str (py2).
         """
-        remaining = len(d)
-        while remaining:
+        waited = False
+        while True:
             try:
-                # write as many bytes as possible
-                written = os.write(self.fd, d[-remaining:])
-                # os.write returns how many were written
-                remaining -= written
+                self.syscalls += 1
+                buf = os.read(self.fd, n)
             except OSError as e:
-                # on EAGAIN, keep trying
                 if e.errno != errno.EAGAIN:
                     raise
+                buf = b''
+            if buf or waited:
+                return buf
+            self.syscalls += 1
+            rlist, wlist, xlist = select.select([self.fd], [], [], 1.0)
+            if not rlist:
+                # nothing arrived before timeout
+                return b''
+            waited = True
+    
+    def readinto(self, buffer):
+        """Reads into buffer (a writable bytes-like object, such as
+        a bytearray or a memoryview of one) up to len(buffer) bytes,
+        whatever is available, waiting as read_some does,
+        and returns the number of bytes read (0 on timeout).
+        No bytes object is created for the data.
+        """
+        waited = False
+        while True:
+            try:
+                self.syscalls += 1
+                n = _readinto(self.fd, buffer)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                n = 0
+            if n or waited:
+                return n
+            self.syscalls += 1
+            rlist, wlist, xlist = select.select([self.fd], [], [], 1.0)
+            if not rlist:
+                # nothing arrived before timeout
+                return 0
+            waited = True
+    
+    def write(self, d):
+        """Write the given bytestring to the port.
+        
+        Should be bytes (py3) / str (py2) object.
+        
+        Blocking write: waits until all data written.
+        When the port has room, the data goes out in a single write;
+        while its output buffer is full, waits in select for it to drain
+        (rather than retrying the write), raising OSError (ETIMEDOUT)
+        if it takes more than write_timeout seconds.
+        Writes from different threads are not interleaved.
+        """
+        view = memoryview(d)
+        deadline = None
+        with self._write_lock:
+            while True:
+                try:
+                    self.syscalls += 1
+                    written = os.write(self.fd, view)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    written = 0
+                view = view[written:]
+                if not len(view):
+                    return
+                # port full: wait until it can take more
+                wait = None
+                if self.write_timeout is not None:
+                    now = clock()
+                    if deadline is None:
+                        deadline = now + self.write_timeout
+                    wait = deadline - now
+                    if wait <= 0:
+                        raise OSError(errno.ETIMEDOUT,
+                                'write timed out with {0} bytes unsent'.format(len(view)))
+                self.syscalls += 1
+                select.select([], [self.fd], [], wait)
     
     def close(self):
         """Close the serial port.
         """
+        if self._saved_serial is not None:
+            try:
+                fcntl.ioctl(self.fd, TIOCSSERIAL, self._saved_serial)
+            except (IOError, OSError):
+                pass
+            self._saved_serial = None
         os.close(self.fd)
         self.fd = None
     
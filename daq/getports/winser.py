@@ -186,7 +186,8 @@ class Serial(object):
         if not k32.PurgeComm(self.fd, PURGE_TXCLEAR|PURGE_TXABORT|PURGE_RXCLEAR|PURGE_RXABORT):
             raise c.WinError()
     
-    def read(self, n):
+    def _read(self, buf, n):
+        """Read up to n bytes into ctypes buffer buf, returning the number read."""
         if not k32.ResetEvent(self._ovr.hEvent):
             raise c.WinError()
         flags = wt.DWORD()
@@ -194,13 +195,41 @@ class Serial(object):
         cs = COMSTAT()
         if not k32.ClearCommError(self.fd, c.byref(flags), c.byref(cs)):
             raise c.WinError()
-        buf = c.create_string_buffer(n)
         if not k32.ReadFile(self.fd, buf, n, c.byref(rc), c.byref(self._ovr)):
             if c.GetLastError() != ERROR_IO_PENDING:
                 raise c.WinError()
         if not k32.GetOverlappedResult(self.fd, c.byref(self._ovr), c.byref(rc), True):
             raise c.WinError()
-        return buf.raw[:rc.value]
+        return rc.value
+    
+    def read(self, n):
+        buf = c.create_string_buffer(n)
+        return buf.raw[:self._read(buf, n)]
+    
+    def _waiting(self, n):
+        """Return how many bytes to ask for to get up to n without waiting
+        for more than the first byte to arrive.
+        """
+        flags = wt.DWORD()
+        cs = COMSTAT()
+        if not k32.ClearCommError(self.fd, c.byref(flags), c.byref(cs)):
+            raise c.WinError()
+        return max(1, min(n, cs.cbInQue))
+    
+    def read_some(self, n):
+        """Read up to n bytes, returning whatever is already waiting
+        in the input queue, or else the first byte to arrive
+        within the 1 sec timeout.
+        """
+        return self.read(self._waiting(n))
+    
+    def readinto(self, buffer):
+        """Like read_some, but reading straight into buffer
+        (a writable bytes-like object) up to len(buffer) bytes,
+        and returning the number of bytes read.
+        """
+        n = self._waiting(len(buffer))
+        return self._read((c.c_char * len(buffer)).from_buffer(buffer), n)
     
     def write(self, d):
         n = wt.DWORD()
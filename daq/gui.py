@@ -3,7 +3,7 @@ from __future__ import division, print_function
 import os.path
 import sys
 from itertools import chain
-from math import sqrt,log
+from math import log
 from functools import partial
 
 try:
@@ -26,10 +26,17 @@ from getports import ports
 from comm import tostr
 from newtext import create_newtext
 from tkversionpatch import tk_patch_if_needed
+try:
+    from procacq import AcquisitionProcess
+except ImportError:     # no multiprocessing.shared_memory before Python 3.8
+    AcquisitionProcess = None
 
 # global variables:
 #       root - the root of the Tkinter windowing
-#       daq - the DataAcquisition object from core
+#       daq - the DataAcquisition object from core,
+#               or (unless run with --in-process) an AcquisitionProcess
+#               reading and decoding in a child process, so that redrawing
+#               the GUI never holds up reading the serial port
 #       maindir - the main directory containing the daq folder
 #       os_background_color - background color for frames
 #       master_frame - the Frame that holds all the GUI interface
@@ -199,12 +206,16 @@ class CommandBar(ttk.Frame):
         config = self.makeconf()
         if config is None:
             return
+        filetypes = [('Text recording', '*.txt'),
+                     ('Binary recording', '*.pdaq'),
+                     ('All files', '*')]
         if self.last_file_saved:
             dir,file_base = os.path.split(self.last_file_saved)
             self.last_file_saved = tkf.asksaveasfilename(defaultextension='.txt',
-                initialfile=file_base, initialdir=dir)
+                filetypes=filetypes, initialfile=file_base, initialdir=dir)
         else:
-            self.last_file_saved = tkf.asksaveasfilename(defaultextension='.txt')
+            self.last_file_saved = tkf.asksaveasfilename(defaultextension='.txt',
+                filetypes=filetypes)
         if self.last_file_saved:
             daq.save(self.last_file_saved, notes=master_frame.notesbox.get('1.0', 'end'), 
                 convvolts = master_frame.other_global_options.use_power_voltage.get(),
@@ -513,11 +524,6 @@ class ChannelWidget(ttk.Frame):
         width_in_chars=int(0.999 + self.display_font.measure('-123.45e-03')/self.display_font.measure('n'))
         self.display_value = ttk.Label(self,width=width_in_chars, anchor='e', font=self.display_font,justify='right')
         
-        # 0th, 1st, and 2nd moment for computing mean and rms
-        self.x0=0
-        self.x1=0
-        self.x2=0
-        
         ## grid all the items
         namefield.grid(row=0, column=0, sticky='ew')
         self.columnconfigure(0, weight=1)       # let namefield stretch
@@ -554,15 +560,8 @@ class ChannelWidget(ttk.Frame):
         """ return the descriptor used by the core for intepreting this channel
         """
         pin_name = self.pinvar.get()
-        self.descriptor = core.ChannelDescriptor(name=self.namevar.get(),
-                    probe= daq.board.probe_from_name[pin_name],
-                    interpretation=core.Interpretation(
-                        is_analog= daq.board.is_analog(pin_name) or daq.board.is_differential(pin_name),
-                        is_signed=daq.board.is_differential(pin_name),
-                        is_frequency=daq.board.is_frequency(pin_name),
-                        downsample=self.downsamp, 
-                        gain=daq.board.gain_from_name[pin_name])
-                    )
+        self.descriptor = core.channel_for_pin(daq.board, pin_name,
+                    name=self.namevar.get(), downsample=self.downsamp)
 #        print("DEBUG: pin_name=", pin_name, "gain=", daq.board.gain_from_name[pin_name], file=sys.stderr)
         return self.descriptor
     
@@ -576,8 +575,8 @@ class ChannelWidget(ttk.Frame):
     
     def make_sparkline(self, chan_num, freeze_count):
         """Make a sparkline for data up to time point freeze_count
-        from daq.data()[chan_num]
-        (essentially daq.data()[freeze_count-width:freeze_count][chan_num])
+        from column chan_num of daq.data()
+        (essentially daq.data().column(chan_num, freeze_count-width, freeze_count))
 
         For analog channels, those are 16-bit unsigned values.
         For digital channels, those are 0 or 1.
@@ -589,26 +588,20 @@ class ChannelWidget(ttk.Frame):
         
         x,y,width,height=self.grid_bbox(row=0,column=3)
         # make a copy of the data into visible_data, to transform in place
-        start = max(0, freeze_count-width)
-        visible_data = [x[chan_num] for x in daq.data()[start:freeze_count]]
+        data = daq.data()
+        start = max(data.first_row, freeze_count-width)
+        visible_data = list(data.column(chan_num, start, freeze_count))
+        if not visible_data:
+            return
 #        print("DEBUG: len(visible_data)=",len(visible_data), file=sys.stderr)
         
         # update value at end of line
         self.average_label['text']='last:\nDC:\nRMS:'
         last_value = visible_data[-1]
-        if self.x0 < 100:
-            # zero out the old sums, to recompute from the beginning
-            #   This is a crude, possibly buggy attempt to correct for
-            #   frequency channels getting their first value patched
-            self.x0 = 0
-            self.x1 = 0
-            self.x2 = 0
-        self.x1 += sum(x[chan_num]    for x in daq.data()[self.x0:freeze_count])
-        self.x2 += sum(x[chan_num]**2 for x in daq.data()[self.x0:freeze_count])
-        self.x0 = freeze_count
-        mean=self.x1/self.x0
-        ms=max(0,self.x2/self.x0-mean**2)
-        rms=sqrt(ms)
+        # running statistics are maintained by the store as samples arrive
+        stats = data.stats(chan_num)
+        mean = stats.mean
+        rms = stats.rms
         if  self.descriptor.interpretation.is_analog and master_frame.other_global_options.use_power_voltage.get():
             last_value = self.descriptor.volts(last_value,daq.board.power_voltage)
             mean = self.descriptor.volts(mean,daq.board.power_voltage)
@@ -643,9 +636,6 @@ class ChannelWidget(ttk.Frame):
     
     def clear(self):
         self.sparkline_canvas.coords(self.sparkline, -2, -2, -2, -2)
-        self.x0=0
-        self.x1=0
-        self.x2=0
         self.display_value['text']=''
     def show_options(self, e):
         self.menu.post(e.x_root, e.y_root)
@@ -941,20 +931,16 @@ class MasterFrame(ttk.Frame):
         if daq.trigger_error:
             self.errorlabel['text']= 'Warning: '+daq.trigger_error
             self.errorlabel.grid(row=0, column=0)
-        elif freeze_count \
-            and freeze_count > daq.data_length_before_go \
-                and daq.is_timed_trigger():
-            # check for dropped packets in time stream
-            implied_packets = daq.data_length_before_go \
-                + int(daq.data()[freeze_count-1][0]/ daq.conf[0].period  +1.1)
-#            print("DEBUG: implied_packets=",implied_packets, "freeze_count=", freeze_count, file=sys.stderr)
-            if implied_packets>freeze_count:
-                self.errorlabel['text'] = 'Warning: {0} samples dropped'.format(implied_packets - freeze_count)
+        else:
+            # dropped packets, as found by the gap index while acquiring
+            gaps = daq.gaps()
+            num_dropped = gaps.num_dropped()
+            if num_dropped:
+                self.errorlabel['text'] = 'Warning: {0} samples dropped in {1} gaps'.format(
+                        num_dropped, len(gaps))
                 self.errorlabel.grid(row=0, column=0)
             else:
                 self.errorlabel.grid_forget()
-        else:
-            self.errorlabel.grid_forget()
         
         if force_refresh or freeze_count>int(self.commandbar.countlabel['text']):
             for n, ch in enumerate(self.channel_list(), 1):
@@ -1023,10 +1009,16 @@ def create_root():
     
     return root
 
-daq = core.DataAcquisition()
+if AcquisitionProcess is None or '--in-process' in sys.argv[1:]:
+    daq = core.DataAcquisition()
+else:
+    daq = AcquisitionProcess(ring_rows=1 << 16)   # enough for the sparklines
 
 root = create_root()
 
 ps = PortSelect(root, partial(daq.connect, call_when_done=startmain))
 
 root.mainloop()
+
+if AcquisitionProcess is not None and isinstance(daq, AcquisitionProcess):
+    daq.close()
@@ -0,0 +1,308 @@
+"""Acquiring from several boards at once.
+
+MultiAcquisition runs one DataAcquisition per board (each with its own
+CommPort reading thread, PacketDecoder, Board description, and store),
+so the number of channels grows with the number of boards
+rather than being limited by one board's multiplexer.
+        multi = MultiAcquisition(['/dev/ttyACM0', '/dev/ttyACM1'])
+        multi.connect(call_when_done)
+        multi.config([conf0, conf1])    # one configuration per board
+        multi.go()
+        for block in multi.stream(block_size=1024, max_wait=0.1):
+            ...
+        multi.stop()
+        merged = multi.store()
+
+The boards' clocks are independent, so their samples are put on one timeline
+by the host clock: each DataAcquisition estimates host_offset,
+the host time of its board time 0, and a sample's host time is
+its timestamp plus that offset.
+The merged timeline has a row for every sample of every board, in host-time order;
+in each row the channels of the other boards hold their latest sample
+(or, before a board's first sample, that first sample).
+Timestamps of the merged timeline are in seconds from go().
+"""
+
+from __future__ import division, print_function
+
+import heapq
+from bisect import bisect_right
+from threading import Lock
+from timeit import default_timer as clock
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional, used only to merge large timelines faster
+    np = None
+
+from core import DataAcquisition
+from store import SampleStore, TICKS64
+from stream import SampleBlock
+
+HOST_TICK = 1e-6        # seconds per tick of merged timestamps
+# merged timestamps are signed: a sample taken just before go() may come first
+HOST_TICKS = 'd' if TICKS64 == 'd' else 'q'
+
+
+def merge_timelines(parts, held=None):
+    """Merge the samples of several boards into one timeline.
+    parts: for each board, (times, columns), with times ascending
+            and columns a list of that board's channel columns, all as long as times
+    held: for each board, the channel values to hold before its first sample here
+            (None, or None for a board, to use the board's first sample)
+    Returns (times, columns): the merged times (a list) and a list with,
+    for each board in turn, a list per channel of the held values at every merged time.
+    """
+    counts = [len(times) for times, columns in parts]
+    if held is None:
+        held = [None] * len(parts)
+    held = [h if h is not None else [col[0] if len(col) else 0 for col in columns]
+            for h, (times, columns) in zip(held, parts)]
+    if np is not None and sum(counts) >= 1024:
+        return _numpy_merge(parts, counts, held)
+    # indexes[k][r] is the last sample of board k at or before merged row r (-1 if none)
+    indexes = [[] for part in parts]
+    current = [-1] * len(parts)
+    times = []
+    def labelled(k, part_times):
+        return ((t, k, i) for i, t in enumerate(part_times))
+    streams = [labelled(k, part_times) for k, (part_times, columns) in enumerate(parts)]
+    for t, k, i in heapq.merge(*streams):
+        current[k] = i
+        times.append(t)
+        for index, cur in zip(indexes, current):
+            index.append(cur)
+    merged = []
+    for (part_times, columns), index, hold in zip(parts, indexes, held):
+        merged.append([[col[i] if i >= 0 else h for i in index]
+                       for col, h in zip(columns, hold)])
+    return times, merged
+
+
+def _numpy_merge(parts, counts, held):
+    times = np.concatenate([np.asarray(times, dtype=np.float64) for times, columns in parts])
+    boards = np.repeat(np.arange(len(parts)), counts)
+    order = np.argsort(times, kind='stable')
+    boards = boards[order]
+    merged = []
+    for k, ((part_times, columns), hold) in enumerate(zip(parts, held)):
+        index = np.cumsum(boards == k) - 1
+        before = index < 0
+        index[before] = 0
+        board_columns = []
+        for col, h in zip(columns, hold):
+            if len(col):
+                values = np.asarray(col)[index]
+                values = np.where(before, h, values)
+            else:
+                values = np.full(len(index), h)
+            board_columns.append(values.tolist())
+        merged.append(board_columns)
+    return times[order].tolist(), merged
+
+
+class MultiAcquisition(object):
+    """Several DataAcquisitions, one per board, run together."""
+
+    def __init__(self, ports=()):
+        self.daqs = []          # one DataAcquisition per board, in the order added
+        self.ports = []
+        self.epoch = None       # host clock() at go(), time 0 of the merged timeline
+        for port in ports:
+            self.add(port)
+
+    def add(self, port):
+        """Add the board on port (connect() connects all the boards added)."""
+        daq = DataAcquisition()
+        self.daqs.append(daq)
+        self.ports.append(port)
+        return daq
+
+    def connect(self, call_when_done):
+        """Non-blocking attempt to connect to all the boards at once.
+        When every attempt has finished, call_when_done is called with None
+        if all succeeded, or with the error messages, one line per failed port.
+        """
+        lock = Lock()
+        results = {}
+        def done(port, fail):
+            with lock:
+                results[port] = fail
+                if len(results) < len(self.ports):
+                    return
+            errors = ['{0}: {1}'.format(p, results[p]) for p in self.ports if results[p]]
+            call_when_done('\n'.join(errors) if errors else None)
+        for daq, port in zip(self.daqs, self.ports):
+            daq.connect(port, lambda fail, port=port: done(port, fail))
+
+    def boards(self):
+        """Return the Board description of each board."""
+        return [daq.board for daq in self.daqs]
+
+    def config(self, confs):
+        """Configure each board with its own (trigger, aref, avg, channels)."""
+        if len(confs) != len(self.daqs):
+            raise ValueError('{0} configurations given for {1} boards'.format(
+                    len(confs), len(self.daqs)))
+        for daq, conf in zip(self.daqs, confs):
+            daq.config(conf)
+
+    def channels(self):
+        """Return the channels of the merged timeline: each board's in turn.
+        Downsampled channels are held at every row of the merged timeline,
+        so they are described with no downsampling.
+        """
+        return [ch._replace(interpretation=ch.interpretation._replace(downsample=1))
+                for daq in self.daqs for ch in daq.channels]
+
+    def go(self):
+        self.epoch = clock()
+        for daq in self.daqs:
+            daq.go()
+
+    def stop(self):
+        for daq in self.daqs:
+            daq.stop()
+
+    def clear(self):
+        for daq in self.daqs:
+            daq.clear()
+
+    def _host_part(self, daq, start, stop):
+        """Return (host times, channel columns) for rows start up to stop of daq's store,
+        with host times in seconds from go().
+        """
+        data = daq.data()
+        with data.lock:
+            offset = (daq.host_offset or 0) - self.epoch
+            times = [t + offset for t in data.column(0, start, stop)]
+            return times, [data.column(n, start, stop)
+                           for n in range(1, data.num_channels+1)]
+
+    def store(self, spill_rows=None, spill_dir=None):
+        """Return a new SampleStore holding the merged timeline of the samples
+        taken since go() (see channels() for its channels).
+        """
+        parts = [self._host_part(daq, daq.data_length_before_go, len(daq.data()))
+                 for daq in self.daqs]
+        times, merged = merge_timelines(parts)
+        store = SampleStore(self.channels(), spill_rows, spill_dir)
+        store.set_timebase(HOST_TICK, HOST_TICKS)
+        if times:
+            store.append_columns([[int(round(t/HOST_TICK)) for t in times]]
+                                 + [col for board_columns in merged for col in board_columns])
+        return store
+
+    def stream(self, block_size=1024, max_blocks=16, policy='block', max_wait=None):
+        """Return a MergedStream of the samples stored from now on, on the merged timeline.
+        block_size, max_blocks, policy, and max_wait apply to each board's
+        SampleStream (see DataAcquisition.stream).
+        """
+        return MergedStream(self, [daq.stream(block_size, max_blocks, policy, max_wait)
+                                   for daq in self.daqs], max_wait)
+
+
+class MergedStream(object):
+    """An iterator over SampleBlocks of the merged timeline.
+
+    A block holds the samples of every board up to the latest time that all
+    the boards have reached, so it waits for the board furthest behind.
+    A board that delivers nothing for max_wait seconds (if given) is taken
+    to have no samples older than max_wait ago, so that an idle board
+    (for instance, one triggered by a pin that is not changing)
+    does not hold up the others.
+    Each board's host offset is taken when its first block arrives
+    and kept for the rest of the stream, so the timeline never goes backwards
+    (store(), made afterwards, uses the final, best estimates).
+    """
+    def __init__(self, multi, streams, max_wait=None):
+        self.multi = multi
+        self.streams = streams
+        self.max_wait = max_wait
+        self.next_row = 0
+        num_boards = len(streams)
+        self._pending = [([], [[] for n in range(stream.data.num_channels)])
+                         for stream in streams]
+        self._held = [None] * num_boards
+        self._offsets = [None] * num_boards     # seconds from go() of each board's time 0
+        self._reached = [float('-inf')] * num_boards    # host time each board has reached
+
+    def num_dropped(self):
+        """Samples dropped by the boards' streams."""
+        return sum(stream.num_dropped for stream in self.streams)
+
+    def _receive(self, k, block):
+        offset = self._offsets[k]
+        if offset is None:
+            multi = self.multi
+            offset = self._offsets[k] = (multi.daqs[k].host_offset or 0) - multi.epoch
+        times, columns = self._pending[k]
+        times.extend(t + offset for t in block.columns[0])
+        for pending, col in zip(columns, block.columns[1:]):
+            pending.extend(col)
+        if times:
+            self._reached[k] = max(self._reached[k], times[-1])
+
+    def _take_until(self, reached):
+        """Return the merged block of the pending samples at or before time reached,
+        or None if there are none.
+        """
+        parts = []
+        for times, columns in self._pending:
+            cut = bisect_right(times, reached)
+            parts.append((times[:cut], [col[:cut] for col in columns]))
+            del times[:cut]
+            for col in columns:
+                del col[:cut]
+        if not any(times for times, columns in parts):
+            return None
+        times, merged = merge_timelines(parts, self._held)
+        for k, (board_columns, (part_times, columns)) in enumerate(zip(merged, parts)):
+            if part_times:
+                self._held[k] = [col[-1] for col in columns]
+        block = SampleBlock(self.next_row,
+                            [times] + [col for board_columns in merged for col in board_columns])
+        self.next_row = block.stop
+        return block
+
+    def get(self):
+        """Return the next block, or None once every board's stream has ended."""
+        streams = self.streams
+        ended = [False] * len(streams)
+        while True:
+            waiting = [k for k in range(len(streams)) if not ended[k]]
+            if not waiting:
+                return self._take_until(float('inf'))
+            k = min(waiting, key=lambda k: self._reached[k])
+            block = streams[k].get(self.max_wait)
+            if block is not None:
+                self._receive(k, block)
+            elif streams[k].closed:
+                ended[k] = True
+                self._reached[k] = float('inf')
+            else:
+                self._reached[k] = max(self._reached[k],
+                                       clock() - self.multi.epoch - self.max_wait)
+            merged = self._take_until(min(self._reached))
+            if merged is not None:
+                return merged
+
+    def __iter__(self):
+        try:
+            while True:
+                block = self.get()
+                if block is None:
+                    return
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
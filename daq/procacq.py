@@ -0,0 +1,477 @@
+"""Acquiring in a child process, publishing samples through shared memory
+(Python 3.8 and later).
+
+AcquisitionProcess runs the CommPort reading thread, the PacketDecoder,
+and the store in a child process, with an interpreter (and GIL) of its own,
+so nothing the parent does (redrawing a GUI, say) can delay reading the port.
+The parent drives it as it would a DataAcquisition:
+        acq = AcquisitionProcess()
+        fail = acq.connect('/dev/ttyACM0')      # waits for the handshake
+        acq.config(conf)
+        acq.go()
+        ...
+        acq.stop()
+        acq.close()
+and the child publishes every sample it stores into a SharedRing,
+which any local process can attach to, read-only, by name:
+        ring = SharedRing.attach(acq.ring_name)
+        start, stop = ring.rows()
+        for row, columns in ring.segments(start, stop):
+            ...     # columns[0] is timestamps (seconds), columns[n] channel n
+segments() returns views of the shared memory itself (NumPy arrays if NumPy
+is installed, memoryviews otherwise), so reading copies nothing and takes
+no lock shared with the child.
+AcquisitionProcess also has the other DataAcquisition methods the GUI uses,
+with data() reading the samples from the ring (see RingData),
+so the GUI acquires this way unless told otherwise (see gui.py).
+
+The ring holds the last capacity rows of the store, one float64 column
+for the timestamps (seconds) and one per channel, as store.column() returns them.
+Sequence counters in its header say which rows are there:
+the child raises 'reserved' to the end of the rows it is about to write,
+writes them, then raises 'written' to the same value.
+So rows start up to written can be read, and they were not overwritten
+while being read if start >= reserved - capacity afterwards (see valid_from).
+'run' counts the times the ring was emptied (by config() or clear()),
+and 'first' is the first row of the current run
+(rows are numbered as in the child's store).
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import mmap
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from time import sleep
+from threading import Thread, Event, Lock
+from timeit import default_timer as clock
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional: segments() then returns memoryviews
+    np = None
+
+MAGIC = b'PDAQRING'
+# magic, capacity (rows), columns, run, first, reserved, written
+_header = struct.Struct('<8sQQQQQQ')
+_COUNTERS_OFFSET = 8 + 8 + 8        # offset of run, first, reserved, written
+_counters = struct.Struct('<QQQQ')
+ITEM_SIZE = 8                       # bytes per value (float64)
+
+
+def _map_readonly(name):
+    """Return (a read-only memoryview, a function closing it)
+    of the shared memory block name, without registering the block
+    with this process's resource tracker (which would destroy it at exit,
+    when only its creator should).
+    """
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name, track=False)
+        return shm.buf.toreadonly(), shm.close
+    # Before 3.13, SharedMemory registers every block it opens on Posix
+    # with the resource tracker, and cannot be told not to; so the block
+    # is opened with _posixshmem, the private module SharedMemory uses,
+    # and mapped read-only.
+    try:
+        import _posixshmem
+    except ImportError:     # Windows: the block lives while any process has it open
+        shm = shared_memory.SharedMemory(name)
+        return shm.buf.toreadonly(), shm.close
+    fd = _posixshmem.shm_open('/' + name, os.O_RDONLY, mode=0o600)
+    try:
+        mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    return memoryview(mapping), mapping.close
+
+
+class SharedRing(object):
+    """A ring buffer of sample rows in a multiprocessing.shared_memory block."""
+
+    def __init__(self, name, buf, owner, close):
+        """Use create() or attach() rather than making a SharedRing directly."""
+        self.name = name
+        self.owner = owner      # True in the process that created it and writes to it
+        self._buf = buf
+        self._close = close
+        magic, self.capacity, self.num_columns = _header.unpack_from(buf, 0)[:3]
+        if magic != MAGIC:
+            raise ValueError('{0} is not a PteroDAQ sample ring'.format(name))
+        offset = _header.size
+        size = self.capacity * ITEM_SIZE
+        self._columns = []
+        for n in range(self.num_columns):
+            view = buf[offset + n*size:offset + (n+1)*size]
+            if np is not None:
+                view = np.frombuffer(view, dtype='<f8')
+            else:
+                view = view.cast('d')
+            self._columns.append(view)
+
+    @classmethod
+    def create(cls, num_columns, capacity):
+        """Create a new ring of capacity rows of num_columns values."""
+        shm = shared_memory.SharedMemory(create=True,
+                size=_header.size + num_columns*capacity*ITEM_SIZE)
+        _header.pack_into(shm.buf, 0, MAGIC, capacity, num_columns, 0, 0, 0, 0)
+        def close():
+            shm.close()
+            shm.unlink()
+        return cls(shm.name, shm.buf, True, close)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach read-only to the ring called name, created by another process."""
+        buf, close = _map_readonly(name)
+        return cls(name, buf, False, close)
+
+    def counters(self):
+        """Return (run, first, reserved, written)."""
+        return _counters.unpack_from(self._buf, _COUNTERS_OFFSET)
+
+    def rows(self):
+        """Return (start, stop): the rows that can be read now."""
+        run, first, reserved, written = self.counters()
+        return max(first, reserved - self.capacity), written
+
+    def valid_from(self):
+        """Return the first row not (being) overwritten:
+        rows read from before it may have changed while being read.
+        """
+        run, first, reserved, written = self.counters()
+        return max(first, reserved - self.capacity)
+
+    def segments(self, start, stop):
+        """Return [(row, columns), ...]: rows start up to stop as at most two
+        runs of consecutive rows, each with a view of every column.
+        Check valid_from() after reading them.
+        """
+        capacity = self.capacity
+        result = []
+        while start < stop:
+            first = start % capacity
+            last = min(first + stop - start, capacity)
+            result.append((start, [col[first:last] for col in self._columns]))
+            start += last - first
+        return result
+
+    def column(self, n, start, stop):
+        """Return a copy of the values of column n for rows start up to stop,
+        or None if some were overwritten while being copied.
+        """
+        values = [list(columns[n]) for row, columns in self.segments(start, stop)]
+        if self.valid_from() > start:
+            return None
+        return [v for segment in values for v in segment]
+
+    def publish(self, start, columns):
+        """Write rows start, start+1, ... holding columns (owner only)."""
+        num_rows = len(columns[0])
+        if num_rows > self.capacity:
+            start += num_rows - self.capacity
+            columns = [col[num_rows - self.capacity:] for col in columns]
+            num_rows = self.capacity
+        stop = start + num_rows
+        run, first, reserved, written = self.counters()
+        _counters.pack_into(self._buf, _COUNTERS_OFFSET, run, first, stop, written)
+        done = 0
+        for row, views in self.segments(start, stop):
+            length = len(views[0])
+            for view, col in zip(views, columns):
+                view[:] = col[done:done+length] if np is not None else \
+                        memoryview(_as_doubles(col[done:done+length]))
+            done += length
+        _counters.pack_into(self._buf, _COUNTERS_OFFSET, run, first, stop, stop)
+
+    def reset(self, first=0):
+        """Empty the ring, starting a new run at row first (owner only)."""
+        run = self.counters()[0]
+        _counters.pack_into(self._buf, _COUNTERS_OFFSET, run+1, first, first, first)
+
+    def close(self):
+        """Detach from the ring; its owner also destroys it.
+        Views from segments() must be released first.
+        """
+        self._columns = []
+        self._buf.release()
+        self._close()
+
+
+def _as_doubles(values):
+    from array import array
+    return array('d', [float(v) for v in values])
+
+
+def _serve(conn, ring_rows, block_size, max_wait):
+    """The child process: a DataAcquisition driven by requests from conn,
+    publishing what it stores into a SharedRing.
+    """
+    from core import DataAcquisition
+    daq = DataAcquisition()
+    state = dict(ring=None, publisher=None)
+    publish_lock = Lock()
+
+    def publish(stream, ring):
+        for block in stream:
+            with publish_lock:
+                ring.publish(block.start, block.columns)
+
+    def restart_publisher():
+        """Empty the ring (making a new one if the channels changed)
+        and publish from a new stream of the store.
+        """
+        for stream in daq._streams:
+            stream.close()
+        if state['publisher'] is not None:
+            state['publisher'].join()
+        ring = state['ring']
+        num_columns = len(getattr(daq, 'channels', ())) + 1
+        with publish_lock:
+            if ring is None or ring.num_columns != num_columns:
+                if ring is not None:
+                    ring.close()
+                ring = state['ring'] = SharedRing.create(num_columns, ring_rows)
+            stream = daq.stream(block_size, policy='block', max_wait=max_wait)
+            ring.reset(stream.next_row)
+        state['publisher'] = t = Thread(target=publish, args=(stream, ring))
+        t.daemon = True
+        t.start()
+        return ring.name
+
+    def connect(port, serial_class=None):
+        daq.serial_class = serial_class
+        done = Event()
+        result = []
+        daq.connect(port, lambda fail: (result.append(fail), done.set()))
+        done.wait()
+        if result[0]:
+            return result[0], None
+        return None, daq.board
+
+    def config(conf):
+        daq.config(conf)
+        return restart_publisher(), daq.conf    # the board may have rounded the period
+
+    def clear():
+        daq.clear()
+        return restart_publisher()
+
+    def stop():
+        daq.stop()      # flushes the stream into the publisher
+        num_rows = len(daq.data())
+        ring = state['ring']
+        deadline = clock() + 5
+        while ring.counters()[3] < num_rows and clock() < deadline:
+            sleep(0.001)
+        return daq.board
+
+    def status():
+        return dict(trigger_error=daq.trigger_error, num_rows=len(daq.data()),
+                    gaps=daq.gaps(), counters=daq.comm.counters())
+
+    requests = dict(connect=connect, config=config, clear=clear, stop=stop, status=status,
+                    go=daq.go, oneread=daq.oneread, save=daq.save, gaps=daq.gaps,
+                    stats=lambda n: daq.data().stats(n).copy(),
+                    trigger_error=lambda: daq.trigger_error,
+                    num_saved=lambda: daq.num_saved)
+    restart_publisher()
+    conn.send(('ok', state['ring'].name))
+    try:
+        while True:
+            try:
+                request, args = conn.recv()
+            except EOFError:
+                return
+            if request == 'close':
+                return
+            try:
+                conn.send(('ok', requests[request](*args)))
+            except Exception as e:
+                conn.send(('error', e))
+    finally:
+        for stream in daq._streams:
+            stream.close()
+        if state['publisher'] is not None:
+            state['publisher'].join(1)
+        if state['ring'] is not None:
+            state['ring'].close()
+
+
+class RingData(object):
+    """The samples an AcquisitionProcess has published, read from its SharedRing
+    through the parts of the SampleStore interface that the GUI uses:
+    len() (the rows stored), first_row, column(), and stats().
+    """
+
+    def __init__(self, acquisition, ring):
+        self._acquisition = acquisition
+        self.ring = ring
+
+    def __len__(self):
+        return self.ring.rows()[1]
+
+    @property
+    def first_row(self):
+        """The first row still in the ring."""
+        return self.ring.valid_from()
+
+    def column(self, n, start=0, stop=None):
+        """Return a list of the values of column n for rows start up to stop
+        (default, the last row published), leaving out rows no longer in the ring.
+        Returns an empty list if the rows were overwritten while being copied.
+        """
+        first, written = self.ring.rows()
+        start = max(start, first)
+        stop = written if stop is None else min(stop, written)
+        if stop <= start:
+            return []
+        return self.ring.column(n, start, stop) or []
+
+    def stats(self, n):
+        """Return a RunningStats for channel n (counting from 1),
+        as the child's store has it now.
+        """
+        return self._acquisition._request('stats', n)
+
+
+class AcquisitionProcess(object):
+    """A DataAcquisition running in a child process,
+    publishing the samples it stores into a SharedRing (see ring_name).
+    Requests wait for the child's reply; errors in the child are raised here.
+    The GUI drives it through the same methods as a DataAcquisition,
+    with data() reading the samples from the ring.
+    """
+
+    def __init__(self, ring_rows=1 << 20, block_size=256, max_wait=0.02):
+        """ring_rows: rows kept in the shared ring
+        block_size, max_wait: samples are published in blocks of up to block_size rows,
+                at least every max_wait seconds while arriving
+        """
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve,
+                args=(child_conn, ring_rows, block_size, max_wait))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self._lock = Lock()
+        self.board = None
+        self.conf = None
+        self.channels = ()
+        self.ring_name = self._reply()   # changes when config() changes the number of channels
+        self._data = None       # RingData attached to the ring, made by data()
+
+    def _reply(self):
+        status, result = self._conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def _request(self, request, *args):
+        with self._lock:
+            self._conn.send((request, args))
+            return self._reply()
+
+    def connect(self, port, serial_class=None, call_when_done=None):
+        """Connect to the board on port, returning None on success
+        or an error message.
+        serial_class, if given, must be picklable (a module-level function or class).
+        If call_when_done is given, connect in a background thread instead,
+        returning at once, and call call_when_done with the result
+        (as DataAcquisition.connect does).
+        """
+        if call_when_done is not None:
+            def connect():
+                try:
+                    fail = self.connect(port, serial_class)
+                except Exception as e:
+                    fail = 'Could not connect to {0}: {1}'.format(port, e)
+                call_when_done(fail)
+            t = Thread(target=connect)
+            t.daemon = True
+            t.start()
+            return None
+        fail, self.board = self._request('connect', port, serial_class)
+        return fail
+
+    def config(self, conf):
+        """Configure the board (as DataAcquisition.config) and empty the ring.
+        conf is then the configuration as the board took it.
+        """
+        self.ring_name, self.conf = self._request('config', conf)
+        self.channels = conf[3]
+
+    def is_timed_trigger(self):
+        from core import TriggerTimed
+        return self.conf and isinstance(self.conf[0], TriggerTimed)
+
+    def go(self):
+        self._request('go')
+
+    def oneread(self):
+        self._request('oneread')
+
+    def stop(self):
+        """Stop, returning once every sample stored is published."""
+        self.board = self._request('stop')
+
+    def clear(self):
+        """Forget the stored samples and empty the ring."""
+        self.ring_name = self._request('clear')
+
+    def save(self, fn, notes, convvolts, new_conf):
+        """Save the samples the child has stored (as DataAcquisition.save)."""
+        self._request('save', fn, notes, convvolts, new_conf)
+
+    def status(self):
+        """Return a dict of the child's trigger_error, num_rows (samples stored),
+        gaps (a copy of its GapIndex), and counters (its CommPort's counters()).
+        """
+        return self._request('status')
+
+    @property
+    def trigger_error(self):
+        """The child's trigger_error (asked for each time)."""
+        return self._request('trigger_error')
+
+    @property
+    def num_saved(self):
+        """The number of samples the child had stored when last saved (asked for each time)."""
+        return self._request('num_saved')
+
+    def gaps(self):
+        """Return a copy of the child's GapIndex."""
+        return self._request('gaps')
+
+    def data(self):
+        """Return a RingData reading the samples published into the current ring."""
+        data = self._data
+        if data is None or data.ring.name != self.ring_name:
+            if data is not None:
+                data.ring.close()
+            data = self._data = RingData(self, self.ring())
+        return data
+
+    def ring(self):
+        """Attach to the current ring (the caller should close() it when done)."""
+        return SharedRing.attach(self.ring_name)
+
+    def close(self):
+        """End the child process (destroying the ring)."""
+        if self._data is not None:
+            self._data.ring.close()
+            self._data = None
+        if self.process.is_alive():
+            with self._lock:
+                self._conn.send(('close', ()))
+            self.process.join(5)
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
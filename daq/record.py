@@ -0,0 +1,265 @@
+"""Headless recording from the command line, without the GUI.
+
+Run from the PteroDAQ directory as
+        python -m daq record [options] FILE
+(or python daq/__main__.py record ...; "python -m daq record --help" lists the options).
+For example, to record A0 and A1 at 1 kHz for a minute:
+        python -m daq record --port /dev/ttyACM0 --rate 1000 \\
+                --channel A0 --channel A1=light --duration 60 run1.pdaq
+
+Samples are streamed to FILE as they arrive (in the binary format if FILE
+ends with .pdaq, otherwise as text), and older samples are moved out of memory
+(see DataAcquisition.spill_rows), so memory use stays bounded however long
+the recording.  tkinter is never imported.
+
+The exit status is 0 for a complete recording, 1 if the board could not be
+reached or configured, 2 for bad arguments, and 3 if samples were dropped.
+A summary is printed when the recording ends.
+"""
+
+from __future__ import division, print_function
+
+import sys
+import signal
+import argparse
+from threading import Event
+from timeit import default_timer as clock
+
+import core
+from getports import ports
+from comm import PacketQueue, tostr
+from capture import CaptureFile, Replay
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_DROPPED = 3
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m daq record',
+            description='Record from a PteroDAQ board without the GUI.')
+    parser.add_argument('file',
+            help='file to record into (.pdaq for the binary format, otherwise text)')
+    parser.add_argument('--port',
+            help='serial port of the board (default: the only port found)')
+    trigger = parser.add_mutually_exclusive_group(required=True)
+    trigger.add_argument('--period', type=float, help='sample every PERIOD seconds')
+    trigger.add_argument('--rate', type=float, help='sample RATE times a second')
+    trigger.add_argument('--pin', help='sample when the signal on PIN changes')
+    parser.add_argument('--sense', default='rises',
+            help='with --pin, which changes trigger a sample: rises, falls, or changes')
+    parser.add_argument('--aref', help='analog reference (default: the board\'s)')
+    parser.add_argument('--avg', help='number of readings averaged (default: the board\'s)')
+    parser.add_argument('--channel', '-c', action='append', required=True,
+            metavar='PIN[=NAME][/DOWNSAMPLE]',
+            help='record PIN, named NAME, keeping every DOWNSAMPLE-th sample; '
+                 'repeat for each channel')
+    stop = parser.add_mutually_exclusive_group()
+    stop.add_argument('--duration', type=float,
+            help='stop after DURATION seconds (default: when interrupted)')
+    stop.add_argument('--samples', type=int, help='stop after SAMPLES samples')
+    parser.add_argument('--notes', default='', help='notes for the file header')
+    parser.add_argument('--volts', action='store_true',
+            help='write analog channels in volts, rather than raw readings (text only)')
+    parser.add_argument('--interval', type=float, default=1.0,
+            help='seconds between writes to the file (default 1)')
+    parser.add_argument('--memory-rows', type=int, default=1 << 20,
+            help='samples kept in memory before older ones are moved to disk')
+    parser.add_argument('--queue-size', type=int, default=16384,
+            help='packets that can wait between reading the port and decoding them'
+                 ' (0 to decode in the reading thread)')
+    parser.add_argument('--queue-policy', choices=PacketQueue.POLICIES, default='block',
+            help='what to do with packets arriving when the queue is full:'
+                 ' make the reader wait (the default), or discard the oldest or newest')
+    parser.add_argument('--low-latency', action='store_true',
+            help='set the serial driver\'s low-latency flag, where it has one (Linux)')
+    parser.add_argument('--capture', metavar='CAPTURE',
+            help='also record the raw serial byte stream into CAPTURE (see capture.py)')
+    parser.add_argument('--replay', metavar='CAPTURE',
+            help='replay CAPTURE instead of reading a board (stops at the end of its run)')
+    parser.add_argument('--replay-speed', type=float,
+            help='with --replay, multiple of the captured speed (default: as fast as possible)')
+    return parser
+
+
+def parse_channel(spec, number):
+    """Return (pin name, channel name, downsample) for a --channel argument
+    (number is used for the default name, as in the GUI).
+    """
+    spec, slash, downsample = spec.partition('/')
+    pin_name, equals, name = spec.partition('=')
+    return pin_name, name or 'ch{0}'.format(number), int(downsample) if slash else 1
+
+
+def make_conf(args, board):
+    """Return the configuration (trigger, aref, avg, channels) for config(),
+    or raise ValueError with a message naming the bad argument.
+    """
+    if args.pin is not None:
+        if args.pin not in [x[0] for x in board.eint]:
+            raise ValueError('--pin {0}: not a trigger pin of this board (choose from {1})'
+                    .format(args.pin, ', '.join(x[0] for x in board.eint)))
+        if args.sense not in [x[0] for x in board.intsense]:
+            raise ValueError('--sense {0}: choose from {1}'
+                    .format(args.sense, ', '.join(x[0] for x in board.intsense)))
+        trigger = core.TriggerPinchange(args.pin, args.sense)
+    else:
+        period = args.period if args.period is not None else 1./args.rate
+        if not period > 0:
+            raise ValueError('the sampling period must be positive')
+        trigger = core.TriggerTimed(period)
+    aref = args.aref or board.default_aref
+    if aref not in [x[0] for x in board.aref]:
+        raise ValueError('--aref {0}: choose from {1}'
+                .format(aref, ', '.join(x[0] for x in board.aref)))
+    avg = args.avg or board.default_avg
+    if avg not in [x[0] for x in board.avg]:
+        raise ValueError('--avg {0}: choose from {1}'
+                .format(avg, ', '.join(x[0] for x in board.avg)))
+    channels = []
+    for number, spec in enumerate(args.channel, 1):
+        try:
+            pin_name, name, downsample = parse_channel(spec, number)
+        except ValueError:
+            raise ValueError('--channel {0}: downsampling must be a whole number'.format(spec))
+        if pin_name not in board.probe_from_name:
+            raise ValueError('--channel {0}: {1} is not a pin of this board'
+                    .format(spec, pin_name))
+        if downsample < 1:
+            raise ValueError('--channel {0}: downsampling must be at least 1'.format(spec))
+        channels.append(core.channel_for_pin(board, pin_name, name, downsample))
+    return trigger, aref, avg, channels
+
+
+def choose_port(port):
+    """Return the port to use: port, if given, otherwise the only one found."""
+    if port:
+        return port
+    found = ports()
+    if not found:
+        raise ValueError('no serial ports found; plug in a board or give --port')
+    if len(found) > 1:
+        raise ValueError('{0} serial ports found; choose one with --port:\n  {1}'.format(
+                len(found), '\n  '.join('{0}  ({1})'.format(tostr(address), tostr(name))
+                                        for name, address in found)))
+    return tostr(found[0][1])
+
+
+def connect(daq, port, timeout=30):
+    """Connect daq to the board on port, waiting at most timeout seconds.
+    Returns None, or an error message.
+    """
+    done = Event()
+    result = []
+    def call_when_done(fail):
+        result.append(fail)
+        done.set()
+    daq.connect(port, call_when_done)
+    if not done.wait(timeout):
+        return 'no response from {0} within {1} seconds'.format(port, timeout)
+    return result[0]
+
+
+def summary(daq, fn, elapsed):
+    """Return a description of the finished recording."""
+    num_samples = len(daq.data())
+    gaps = daq.gaps()
+    lines = ['{0}: {1} samples in {2:.3f} seconds ({3:.1f} samples/sec)'.format(
+                fn, num_samples, elapsed, num_samples/elapsed if elapsed > 0 else 0)]
+    lines.append(gaps.describe())
+    if daq.trigger_error:
+        lines.append('board reported: ' + daq.trigger_error)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Record as directed by the command-line arguments argv
+    (default sys.argv[1:]), returning the exit status.
+    """
+    args = make_parser().parse_args(argv)
+    if args.rate is not None and not args.rate > 0:
+        print('record: --rate must be positive', file=sys.stderr)
+        return EXIT_USAGE
+    daq = core.DataAcquisition()
+    daq.spill_rows = args.memory_rows
+    daq.queue_size = args.queue_size or None
+    daq.queue_policy = args.queue_policy
+    daq.low_latency = args.low_latency
+    replay = capture = None
+    try:
+        if args.replay:
+            port = args.replay
+            replay = Replay(args.replay, args.replay_speed)
+            daq.serial_class = replay.serial_class()
+        else:
+            port = choose_port(args.port)
+            if args.capture:
+                capture = CaptureFile(args.capture)
+                daq.serial_class = capture.serial_class()
+    except (ValueError, IOError, OSError) as err:
+        print('record:', err, file=sys.stderr)
+        return EXIT_FAILED
+    try:
+        return record(args, daq, port, replay)
+    finally:
+        if capture is not None:
+            capture.close()
+
+
+def record(args, daq, port, replay=None):
+    """Connect daq to port and record as directed by args, returning the exit status."""
+    fail = connect(daq, port)
+    if fail:
+        print('record: cannot connect to {0}: {1}'.format(port, fail), file=sys.stderr)
+        return EXIT_FAILED
+    try:
+        conf = make_conf(args, daq.board)
+    except ValueError as err:
+        print('record:', err, file=sys.stderr)
+        return EXIT_USAGE
+
+    stop = Event()
+    def request_stop(signum=None, frame=None):
+        stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, request_stop)
+
+    daq.config(conf)
+    daq.start_recording(args.file, args.notes, args.volts, conf,
+            interval=args.interval)
+    start = clock()
+    daq.go()
+    try:
+        while not stop.is_set():
+            elapsed = clock() - start
+            if args.duration is not None and elapsed >= args.duration:
+                break
+            if args.samples is not None and len(daq.data()) >= args.samples:
+                break
+            if replay is not None and replay.needs_write.is_set():
+                break       # the captured run has been replayed
+            if daq.recording_error() is not None:
+                break       # writing the file failed
+            wait = 0.1
+            if args.duration is not None:
+                wait = min(wait, max(0, args.duration - elapsed))
+            stop.wait(wait)
+    finally:
+        daq.stop()
+        elapsed = clock() - start
+        failure = None
+        try:
+            daq.stop_recording()
+        except (IOError, OSError) as err:
+            failure = err
+    if failure is not None:
+        print('record: writing {0} failed: {1}'.format(args.file, failure), file=sys.stderr)
+        return EXIT_FAILED
+    print(summary(daq, args.file, elapsed))
+    return EXIT_DROPPED if daq.gaps().num_dropped() else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
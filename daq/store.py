@@ -0,0 +1,1384 @@
+"""Columnar storage for recorded samples.
+
+Rather than a list of rows (one Python list per sample, full of boxed numbers),
+samples are kept as one typed column per channel:
+        timestamps              array('I')     4 bytes/sample (sequence numbers)
+                             or array('Q')     8 bytes/sample (tick counts)
+        analog channels         array('H')     2 bytes/sample (array('h') if signed)
+        frequency channels      array('d')     8 bytes/sample
+        digital channels        BitColumn      1 bit/sample
+Column 0 is the timestamps, and column n is channel n (counting from 1),
+matching the layout of the rows produced by core.PacketDecoder.
+Timestamps are stored as the integers the board sends;
+a _Timebase records the seconds per tick for each run of rows,
+and column(0) converts to seconds only when it is read.
+
+Each channel also has a RunningStats, updated as samples are appended,
+so that summary statistics never require rescanning the data,
+and each store has a GapIndex recording where samples went missing.
+
+A SampleStore can be given a limit (spill_rows) on the rows kept in memory:
+older rows are then moved, SEGMENT_ROWS at a time, to temporary files
+mapped back into memory (so the operating system can page them out),
+and read back transparently.
+"""
+
+from __future__ import division, print_function
+
+import mmap
+import tempfile
+from array import array
+from math import sqrt
+from bisect import bisect_right
+from threading import RLock
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional; columns may also be filled from lists
+    np = None
+
+# _REVERSED_BITS translates a byte to the byte with its bits in reverse order,
+#       turning the high-order-first output of np.packbits into low-order-first
+_REVERSED_BITS = bytes(bytearray(int('{0:08b}'.format(b)[::-1], 2) for b in range(256)))
+
+try:
+    array(str('Q'))
+    TICKS64 = 'Q'
+except ValueError:      # Python 2 arrays have no 64-bit integers
+    TICKS64 = 'd'       # exact up to 2**53 ticks
+
+def tick_typecode(is_timed):
+    """Return the array typecode for the timestamps of a timed trigger
+    (32-bit sequence numbers) or a pin-change trigger (64-bit tick counts).
+    """
+    return 'I' if is_timed else TICKS64
+
+def column_typecode(interp):
+    """Return the array typecode for a channel with Interpretation interp,
+    or None for a digital channel (stored in a BitColumn).
+    """
+    if interp.is_analog:
+        return 'h' if interp.is_signed else 'H'
+    if interp.is_frequency:
+        return 'd'
+    return None
+
+def new_column(typecode):
+    """Return an empty column for the typecode (None for a BitColumn)."""
+    if typecode is None:
+        return BitColumn()
+    return array(typecode)
+
+def _tobytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()  # Python 2
+
+def _frombytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)   # Python 2
+    return values
+
+def _extend(col, values):
+    """Append the values to col, converting NumPy arrays in bulk."""
+    if (np is not None and isinstance(values, np.ndarray)
+            and not isinstance(col, BitColumn)):
+        frombytes = getattr(col, 'frombytes', None) or col.fromstring  # Python 2
+        frombytes(values.astype(col.typecode).tobytes())
+    else:
+        col.extend(values)
+
+
+class RunningStats(object):
+    """Count, mean, RMS, minimum, and maximum of a stream of values,
+    updated incrementally with Welford's numerically stable method
+    (batches are merged with the pairwise formula of Chan et al.).
+    All queries are O(1).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0          # sum of squared deviations from the mean
+        self.min = None
+        self.max = None
+
+    @property
+    def rms(self):
+        """Root-mean-square deviation from the mean
+        (the RMS of the signal once its DC component is removed).
+        """
+        if not self.count:
+            return 0.0
+        return sqrt(max(self._m2 / self.count, 0.0))
+
+    def copy(self):
+        """Return a RunningStats holding the current values
+        (a snapshot, which can be pickled even when self is a WindowStats).
+        """
+        stats = RunningStats()
+        stats.count, stats.mean, stats._m2 = self.count, self.mean, self._m2
+        stats.min, stats.max = self.min, self.max
+        return stats
+
+    def add(self, x):
+        """Include one more value."""
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+        self._include_range(x, x)
+
+    def _include_range(self, low, high):
+        """Widen min and max to include low and high."""
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    @staticmethod
+    def _summarize(values):
+        """Return (count, mean, sum of squared deviations, min, max) of values."""
+        n = len(values)
+        if np is not None and isinstance(values, np.ndarray):
+            v = values.astype(np.float64)
+            batch_mean = v.mean()
+            batch_m2 = float(((v - batch_mean)**2).sum())
+            return n, float(batch_mean), batch_m2, v.min().item(), v.max().item()
+        batch_mean = float(sum(values)) / n
+        batch_m2 = sum((x - batch_mean)**2 for x in values)
+        return n, batch_mean, batch_m2, min(values), max(values)
+
+    def add_many(self, values):
+        """Include a batch of values (list, array, or NumPy array)."""
+        if not len(values):
+            return
+        n, batch_mean, batch_m2, batch_min, batch_max = self._summarize(values)
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += batch_m2 + delta * delta * self.count * n / total
+        self.count = total
+        self._include_range(batch_min, batch_max)
+
+    def remove_many(self, values):
+        """Exclude a batch of values that were included earlier
+        (reversing the pairwise merge of add_many).
+        min and max are not narrowed; see WindowStats.
+        Returns the minimum and maximum of the values removed.
+        """
+        if not len(values):
+            return None, None
+        n, batch_mean, batch_m2, batch_min, batch_max = self._summarize(values)
+        remaining = self.count - n
+        if remaining <= 0:
+            self.reset()
+            return batch_min, batch_max
+        old_mean = self.mean
+        self.mean = (self.count * old_mean - n * batch_mean) / remaining
+        delta = batch_mean - self.mean
+        self._m2 -= batch_m2 + delta * delta * remaining * n / self.count
+        self.count = remaining
+        return batch_min, batch_max
+
+    def replace(self, old, new):
+        """Replace one value already included (old) by new.
+        Exact when it is the only value;
+        otherwise min and max can only be widened to include new.
+        """
+        if self.count <= 1:
+            self.reset()
+            self.add(new)
+            return
+        # remove old, then add new
+        self.count -= 1
+        delta = old - self.mean
+        self.mean -= delta / self.count
+        self._m2 -= delta * (old - self.mean)
+        self.add(new)
+
+
+class WindowStats(RunningStats):
+    """RunningStats for a window of values that also loses old values.
+    When a removed value was the minimum or maximum,
+    the new minimum and maximum are found lazily, by scanning
+    the values returned by scan() the next time they are asked for.
+    """
+    def __init__(self, scan):
+        """scan: function returning the values currently in the window"""
+        self._scan = scan
+        RunningStats.__init__(self)
+
+    def reset(self):
+        self._stale = False
+        RunningStats.reset(self)
+
+    @property
+    def min(self):
+        if self._stale:
+            self._rescan()
+        return self._min
+
+    @min.setter
+    def min(self, value):
+        self._min = value
+
+    @property
+    def max(self):
+        if self._stale:
+            self._rescan()
+        return self._max
+
+    @max.setter
+    def max(self, value):
+        self._max = value
+
+    def _rescan(self):
+        values = self._scan()
+        self._stale = False
+        self._min = min(values) if len(values) else None
+        self._max = max(values) if len(values) else None
+
+    def _include_range(self, low, high):
+        if not self._stale:
+            RunningStats._include_range(self, low, high)
+
+    def remove_many(self, values):
+        removed_min, removed_max = RunningStats.remove_many(self, values)
+        if self.count and not self._stale and removed_min is not None and (
+                removed_min <= self._min or removed_max >= self._max):
+            self._stale = True
+        return removed_min, removed_max
+
+
+class GapIndex(object):
+    """Where samples went missing during acquisition, and why.
+
+    gaps is a list of (row, count, cause): count samples were lost
+    just before row (the number of the next sample stored).
+    cause is 'checksum' or 'framing' if damaged frames were seen there,
+    'overflow' if the host's hand-off queue discarded packets there (see comm.PacketQueue),
+    or 'sequence' if the sequence numbers of a timed trigger skipped without any of these.
+    For a timed trigger the counts come from the sequence numbers and are exact;
+    otherwise they are estimated from the damaged frames (see flush_pending).
+    Packets the queue discarded after the last one stored in a run
+    are recorded when the run stops (see flush_overflows).
+
+    counters holds the number of checksum, framing, and timeout events,
+    and of packets discarded by the hand-off queue (overflow).
+    """
+    CAUSES = ('checksum', 'framing', 'timeout', 'overflow')
+
+    def __init__(self):
+        self.gaps = []
+        self.counters = dict.fromkeys(self.CAUSES, 0)
+        # expected sequence number of the next timed packet, None if unknown
+        self.next_sequence = None
+        self._pending = []      # causes of damaged frames since the last packet
+        self._pending_overflows = 0     # packets discarded since the last packet
+        self._num_dropped = 0
+
+    def __len__(self):
+        return len(self.gaps)
+
+    def num_dropped(self):
+        """Total number of samples lost."""
+        return self._num_dropped
+
+    def describe(self):
+        """Return a one-line summary of the samples lost and the events counted."""
+        counters = self.counters
+        text = ('{0} samples dropped in {1} gaps'
+                ' ({2[checksum]} checksum errors, {2[framing]} framing errors,'
+                ' {2[timeout]} timeouts').format(self._num_dropped, len(self.gaps), counters)
+        if counters.get('overflow'):
+            text += ', {0} packets discarded by a full queue'.format(counters['overflow'])
+        return text + ')'
+
+    def expect(self, sequence):
+        """Set the sequence number of the next timed packet (None if unknown)."""
+        self.next_sequence = sequence
+
+    def record_error(self, cause, count=1):
+        """Count an event (one of CAUSES) reported by the communication layer
+        (for 'overflow', count is the number of packets discarded).
+        """
+        self.counters[cause] += count
+        if cause == 'overflow':
+            self._pending_overflows += count
+        if cause != 'timeout':
+            self._pending.append(cause)
+
+    def _add(self, row, count, cause):
+        self._num_dropped += count
+        if self.gaps and self.gaps[-1][0] == row and self.gaps[-1][2] == cause:
+            count += self.gaps.pop()[1]
+        self.gaps.append((row, count, cause))
+
+    def check_sequence(self, row, sequences, max_sequence=None):
+        """Record gaps in the sequence numbers (the timestamps) of timed packets
+        about to be stored starting at row, and return the indices (a list)
+        of the packets that should not be stored.
+        A frame can pass the checksum with its sequence number damaged,
+        so a packet whose sequence number is not the one expected is trusted
+        only when the next packet follows on from it (a packet ending the batch
+        has no next one, and is trusted only if it moves forward).
+        A sequence number above max_sequence (if given: the most packets
+        the board can have sent by now) is never trusted.
+        Untrusted packets are counted as checksum errors and returned.
+        A trusted sequence number lower than expected starts a new run, and is not a gap.
+        """
+        start = 0
+        if np is not None and len(sequences):
+            sequences = np.asarray(sequences, dtype=np.int64)
+            expected = self.next_sequence
+            if expected is None or sequences[0] == expected:
+                # only packets from the first that does not follow on
+                # from the one before, or is above max_sequence, need checking
+                suspects = np.flatnonzero(sequences[1:] - sequences[:-1] != 1)[:1] + 1
+                if max_sequence is not None:
+                    suspects = np.append(suspects, np.flatnonzero(sequences > max_sequence)[:1])
+                if not len(suspects):
+                    self._pending = []
+                    self._pending_overflows = 0
+                    self.next_sequence = int(sequences[-1]) + 1
+                    return []
+                start = int(suspects.min())
+            sequences = sequences.tolist()
+        return self._check_from(row, sequences, max_sequence, start)
+
+    def _check_from(self, row, sequences, max_sequence, start=0):
+        """check_sequence in pure Python, for the packets from start on
+        (those before start follow on, one by one, from the sequence number expected).
+        """
+        if not len(sequences):
+            return []
+        pending, self._pending = self._pending, []
+        overflows, self._pending_overflows = self._pending_overflows, 0
+        expected = sequences[start-1] + 1 if start else self.next_sequence
+        rejected = []
+        last = len(sequences) - 1
+        for i in range(start, last+1):
+            sequence = sequences[i]
+            if expected is not None and sequence != expected:
+                confirmed = sequences[i+1] == sequence + 1 if i < last else sequence > expected
+                if not confirmed or max_sequence is not None and sequence > max_sequence:
+                    rejected.append(i)
+                    self.counters['checksum'] += 1
+                    continue
+                if sequence > expected:
+                    # damaged frames just before the packet explain its gap
+                    at = row + i - len(rejected)
+                    missing = sequence - expected
+                    if rejected and rejected[-1] == i-1:
+                        cause = 'checksum'
+                    elif i == 0 and (pending or overflows):
+                        # the queue reported how many packets it discarded;
+                        # any other damaged frames explain the rest
+                        if overflows:
+                            self._add(at, min(overflows, missing), 'overflow')
+                            missing -= min(overflows, missing)
+                        cause = next((c for c in pending if c != 'overflow'), 'sequence')
+                    else:
+                        cause = 'sequence'
+                    if missing:
+                        self._add(at, missing, cause)
+            elif max_sequence is not None and sequence > max_sequence:
+                rejected.append(i)
+                self.counters['checksum'] += 1
+                continue
+            expected = sequence + 1
+        self.next_sequence = expected
+        if rejected and rejected[-1] == last:
+            self._pending.append('checksum')    # explains the next batch's gap
+        return rejected
+
+    def flush_pending(self, row):
+        """Record the damaged frames seen since the last packet
+        as a gap before row (when there are no sequence numbers),
+        counting one sample per bad checksum and per discarded packet.
+        Skipped bytes count as a lost sample only without either,
+        since the parser resynchronizes after each one.
+        """
+        pending, self._pending = self._pending, []
+        overflows, self._pending_overflows = self._pending_overflows, 0
+        if pending:
+            self._add(row, pending.count('checksum') + overflows or 1, pending[0])
+
+    def flush_overflows(self, row):
+        """Record the packets the hand-off queue discarded since the last packet
+        as a gap before row.  Called at the end of a run,
+        when no later packet will arrive to carry them.
+        """
+        overflows, self._pending_overflows = self._pending_overflows, 0
+        self._pending = [cause for cause in self._pending if cause != 'overflow']
+        if overflows:
+            self._add(row, overflows, 'overflow')
+
+    def discard_before(self, row):
+        """Forget the gaps before row."""
+        self.gaps = [gap for gap in self.gaps if gap[0] >= row]
+        self._num_dropped = sum(count for row, count, cause in self.gaps)
+
+
+class _Timebase(object):
+    """Seconds per tick for the timestamps of a store,
+    as runs of rows with the same scale.
+    """
+    def __init__(self, scale=1.0):
+        self.runs = [(0, scale)]    # (first row, seconds per tick)
+
+    def set_scale(self, row, scale):
+        """Use scale for the timestamps from row on."""
+        first, old_scale = self.runs[-1]
+        if first == row:
+            self.runs[-1] = (row, scale)
+        elif scale != old_scale:
+            self.runs.append((row, scale))
+
+    def scale_at(self, row):
+        k = bisect_right(self.runs, (row, float('inf'))) - 1
+        return self.runs[max(k, 0)][1]
+
+    def spans(self, start, stop):
+        """Return a list of (start, stop, scale) for the runs covering rows start to stop."""
+        runs = self.runs
+        spans = []
+        for k, (first, scale) in enumerate(runs):
+            lo = max(start, first)
+            hi = min(stop, runs[k+1][0]) if k+1 < len(runs) else stop
+            if lo < hi:
+                spans.append((lo, hi, scale))
+        return spans
+
+    def seconds(self, ticks, start):
+        """Return array('d') of the ticks for rows start on, in seconds."""
+        stop = start + len(ticks)
+        if np is not None:
+            seconds = np.asarray(ticks, dtype=np.float64)
+            for lo, hi, scale in self.spans(start, stop):
+                seconds[lo-start:hi-start] *= scale
+            return _frombytes('d', seconds.tobytes())
+        seconds = array('d')
+        for lo, hi, scale in self.spans(start, stop):
+            seconds.extend([tick*scale for tick in ticks[lo-start:hi-start]])
+        return seconds
+
+    def discard_before(self, row):
+        """Forget the runs that end before row."""
+        while len(self.runs) > 1 and self.runs[1][0] <= row:
+            del self.runs[0]
+
+
+class BitColumn(object):
+    """A column of Booleans, packed 8 per byte (low-order bit first).
+    Supports len(), indexing, slicing (returning a list), append, and extend.
+    """
+    typecode = None
+
+    def __init__(self, values=()):
+        self._bytes = bytearray()
+        self._len = 0
+        self.extend(values)
+
+    @classmethod
+    def from_packed(cls, packed, length):
+        """Return a BitColumn of the first length bits of packed
+        (bytes, low-order bit first, as returned by packed()).
+        """
+        column = cls()
+        column._bytes = bytearray(packed)
+        column._len = length
+        return column
+
+    def __len__(self):
+        return self._len
+
+    def drop_front(self, num_bits):
+        """Remove the first num_bits bits."""
+        shift = num_bits & 7
+        del self._bytes[:num_bits >> 3]
+        self._len -= num_bits
+        if shift:
+            # move the remaining bits down to start at bit 0 of the first byte
+            old = self._bytes
+            if np is not None:
+                packed = np.frombuffer(bytes(old), np.uint8)
+                following = np.append(packed[1:], np.uint8(0))
+                self._bytes = bytearray(((packed >> shift) | (following << (8-shift))).tobytes())
+            else:
+                self._bytes = bytearray(
+                    ((old[k] >> shift) | (old[k+1] << (8-shift) if k+1 < len(old) else 0)) & 0xff
+                    for k in range(len(old)))
+            del self._bytes[(self._len + 7) >> 3:]
+
+    def append(self, value):
+        bit = self._len & 7
+        if not bit:
+            self._bytes.append(0)
+        if value:
+            self._bytes[-1] |= 1 << bit
+        self._len += 1
+
+    def extend(self, values):
+        if np is not None and isinstance(values, np.ndarray):
+            # finish any partial byte one bit at a time, then pack the rest
+            lead = (-self._len) & 7
+            for value in values[:lead]:
+                self.append(value)
+            rest = values[lead:]
+            if len(rest):
+                packed = np.packbits(rest.astype(bool)).tobytes()
+                self._bytes.extend(packed.translate(_REVERSED_BITS))
+                self._len += len(rest)
+            return
+        append = self.append
+        for value in values:
+            append(value)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if np is not None and step == 1 and stop - start > 64:
+                # unpack whole bytes at once, then trim the bits outside the slice
+                # (copying the bytes first, as the reader thread may be appending)
+                packed = bytes(self._bytes[start >> 3:(stop+7) >> 3])
+                bits = np.unpackbits(np.frombuffer(packed, np.uint8), bitorder='little')
+                return bits[start & 7:stop - (start & ~7)].astype(bool).tolist()
+            return [bool((self._bytes[i >> 3] >> (i & 7)) & 1)
+                    for i in range(start, stop, step)]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('BitColumn index out of range')
+        return bool((self._bytes[index >> 3] >> (index & 7)) & 1)
+
+    def packed(self, start, stop):
+        """Return bits start up to (not including) stop packed into bytes,
+        low-order bit first, with any unused high-order bits of the last byte zero.
+        """
+        if start & 7:
+            packed = bytearray((stop - start + 7) >> 3)
+            for i, bit in enumerate(self[start:stop]):
+                if bit:
+                    packed[i >> 3] |= 1 << (i & 7)
+            return bytes(packed)
+        packed = bytearray(self._bytes[start >> 3:(stop+7) >> 3])
+        if stop & 7:
+            packed[-1] &= (1 << (stop & 7)) - 1
+        return bytes(packed)
+
+    def write(self, start, values):
+        """Overwrite the bits from start with values
+        (which must not run past the end).
+        """
+        lead = min((-start) & 7, len(values))
+        for i in range(lead):
+            self[start+i] = values[i]
+        whole = (len(values) - lead) & ~7
+        if np is not None and whole:
+            first = (start + lead) >> 3
+            packed = np.packbits(np.asarray(values[lead:lead+whole], dtype=bool)).tobytes()
+            self._bytes[first:first + (whole >> 3)] = packed.translate(_REVERSED_BITS)
+        else:
+            whole = 0
+        for i in range(lead + whole, len(values)):
+            self[start+i] = values[i]
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('BitColumn index out of range')
+        if value:
+            self._bytes[index >> 3] |= 1 << (index & 7)
+        else:
+            self._bytes[index >> 3] &= ~(1 << (index & 7))
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class _SpillFile(object):
+    """A temporary file holding spilled segments, mapped into memory.
+    The mapping is remade whenever the file grows;
+    callers only copy data out of it, never keep views.
+    """
+    MAX_BYTES = 1 << 28     # start a new file after this size
+
+    def __init__(self, spill_dir):
+        self._file = tempfile.TemporaryFile(dir=spill_dir)
+        self.size = 0
+        self._map = None
+
+    def append(self, chunks):
+        """Append a list of byte strings, returning the offset of each."""
+        offsets = []
+        for data in chunks:
+            offsets.append(self.size)
+            self._file.write(data)
+            self.size += len(data)
+        self._file.flush()
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+        return offsets
+
+    def read(self, offset, length):
+        return self._map[offset:offset+length]
+
+    def write(self, offset, data):
+        self._map[offset:offset+len(data)] = data
+
+
+class _Segment(object):
+    """Rows start up to start+num_rows of a SampleStore, spilled to a _SpillFile.
+    Column n holds samples native_starts[n] up to native_starts[n]+counts[n]
+    of its channel (all the samples taken at those rows).
+    Keeps the types the columns had when spilled.
+    """
+    def __init__(self, start, num_rows, columns, native_starts, counts, spill_file):
+        self.start = start
+        self.num_rows = num_rows
+        self.native_starts = native_starts
+        self.counts = counts
+        self.typecodes = [col.typecode for col in columns]
+        self._spill_file = spill_file
+        self._offsets = spill_file.append(
+                [col.packed(0, count) if col.typecode is None
+                 else _tobytes(col[:count]) for col, count in zip(columns, counts)])
+
+    def get(self, n, start, stop):
+        """Return samples start up to stop of column n (counting from this segment)."""
+        typecode = self.typecodes[n]
+        offset = self._offsets[n]
+        if typecode is None:
+            first = start & ~7
+            packed = self._spill_file.read(offset + (first >> 3), (stop - first + 7) >> 3)
+            return BitColumn.from_packed(packed, stop - first)[start-first:]
+        itemsize = array(typecode).itemsize
+        return _frombytes(typecode,
+                self._spill_file.read(offset + start*itemsize, (stop-start)*itemsize))
+
+    def set(self, n, i, value):
+        typecode = self.typecodes[n]
+        offset = self._offsets[n]
+        if typecode is None:
+            old = bytearray(self._spill_file.read(offset + (i >> 3), 1))
+            if value:
+                old[0] |= 1 << (i & 7)
+            else:
+                old[0] &= ~(1 << (i & 7))
+            self._spill_file.write(offset + (i >> 3), bytes(old))
+        else:
+            itemsize = array(typecode).itemsize
+            self._spill_file.write(offset + i*itemsize, _tobytes(array(typecode, [value])))
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+def _select_downsampled(values, downsample, first_index):
+    """Return the values (a column for rows starting at row first_index)
+    for the rows that are multiples of downsample.
+    """
+    return values[(-first_index) % downsample::downsample]
+
+def _hold_downsampled(values, downsample, first_index, prev):
+    """Return a copy of values (a column for rows starting at row first_index)
+    in which the value for every row that is not a multiple of downsample
+    is replaced by the most recent value for a row that is.
+    prev is the value stored for row first_index-1 (None if first_index is 0).
+    """
+    if np is not None and isinstance(values, np.ndarray):
+        source = (np.arange(first_index, first_index+len(values))
+                    // downsample * downsample - first_index)
+        held = values[np.maximum(source, 0)]
+        if len(source) and source[0] < 0:
+            held[source < 0] = prev
+        return held
+    held = list(values)
+    for i in range(len(held)):
+        if (first_index+i) % downsample:
+            held[i] = prev
+        else:
+            prev = held[i]
+    return held
+
+def _hold(values, counts, typecode):
+    """Return a column with each of values repeated the corresponding count times."""
+    if np is not None:
+        held = np.repeat(np.asarray(values), counts)
+        if typecode is None:
+            return held.tolist()
+        return _frombytes(typecode, held.astype(typecode).tobytes())
+    held = [v for v, count in zip(values, counts) for k in range(count)]
+    return held if typecode is None else array(typecode, held)
+
+
+class SampleStore(object):
+    """Columnar store for the samples of one recording.
+
+    Rows are appended in batches (append_columns), but read back by column:
+    column(n, start, stop) returns a sequence of values without building rows.
+    Row access (row, indexing, slicing, iteration) is provided for
+    convenience, but builds a list for each row.
+
+    A channel with Interpretation.downsample d > 1 is stored at its own rate:
+    only the samples taken at rows that are multiples of d are kept.
+    native_column() and sample_times() return those samples and their timestamps.
+    column() and the other row-oriented methods give the "hold" view,
+    in which each sample is repeated for the rows up to the next one.
+    If the downsampling of a channel is changed by reconfigure(),
+    the new rate applies from the next row appended.
+
+    The reader thread appends while the GUI reads.
+    len() only counts rows once all their columns have been appended,
+    so a reader that freezes len() first always sees complete rows.
+    Moving rows to disk is done holding lock, as are the read methods;
+    hold lock while reading several columns that must line up.
+    """
+    first_row = 0       # all rows are kept (compare RingStore)
+
+    SEGMENT_ROWS = 1 << 16      # rows moved to disk at a time (a multiple of 8)
+
+    def __init__(self, channels=(), spill_rows=None, spill_dir=None):
+        """channels: list of ChannelDescriptors
+        spill_rows: if not None, keep at most about this many rows in memory,
+                moving older ones to temporary files in spill_dir
+                (default, the system's temporary directory)
+        """
+        self.columns = [array(TICKS64)]
+        self.columns.extend(new_column(column_typecode(ch.interpretation))
+                for ch in channels)
+        self._timebase = _Timebase()
+        # RunningStats for each channel, indexed like columns (no stats for timestamps)
+        self._stats = [None] + [RunningStats() for ch in channels]
+        # For each column, a list of runs (first row, downsample, first sample):
+        #       from the first row, samples were taken at multiples of downsample.
+        self._runs = [[(0, 1, 0)]] + [[(0, max(1, ch.interpretation.downsample), 0)]
+                                      for ch in channels]
+        self._len = 0
+        self.spill_rows = spill_rows
+        self.spill_dir = spill_dir
+        self._base = 0          # number of rows spilled: columns start with row _base
+        self._native_base = [0] * len(self.columns)   # samples spilled, for each column
+        self._segments = []     # _Segments holding rows 0 to _base
+        # for each column, the first sample in each segment
+        self._segment_samples = [[] for col in self.columns]
+        self._spill_file = None
+        self.gaps = GapIndex()
+        self.lock = RLock()
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def num_channels(self):
+        return len(self.columns) - 1
+
+    @property
+    def num_spilled(self):
+        """Number of rows moved to disk."""
+        return self._base
+
+    def downsample(self, n):
+        """Current downsampling of column n."""
+        return self._runs[n][-1][1]
+
+    def reconfigure(self, channels):
+        """Adjust column types and downsampling for a new configuration
+        with the same number of channels.
+        If the store is empty, columns are just remade with the new types.
+        Otherwise, a column whose type changed is converted to array('d'),
+        which can hold the old and the new values.
+        """
+        assert len(channels) == self.num_channels
+        for n, ch in enumerate(channels, 1):
+            downsample = max(1, ch.interpretation.downsample)
+            if downsample != self.downsample(n):
+                if self._len:
+                    self._runs[n].append((self._len, downsample,
+                                          self._num_samples(n, self._len)))
+                else:
+                    self._runs[n] = [(0, downsample, 0)]
+            typecode = column_typecode(ch.interpretation)
+            col = self.columns[n]
+            if col.typecode == typecode:
+                continue
+            if self._len:
+                self.columns[n] = array('d', (float(x) for x in col))
+            else:
+                self.columns[n] = new_column(typecode)
+                self._stats[n] = RunningStats()
+
+    def set_timebase(self, scale, typecode):
+        """Set the seconds per tick (scale) of the timestamps appended from now on,
+        and the typecode they need (see tick_typecode).
+        Stored timestamps are converted if typecode needs a wider column.
+        """
+        with self.lock:
+            self._timebase.set_scale(self._len, scale)
+            col = self.columns[0]
+            if not self._len:
+                self.columns[0] = array(typecode)
+            elif col.typecode == 'I' and typecode != 'I':
+                self.columns[0] = array(typecode, col.tolist())
+
+    def time_scales(self, start=0, stop=None):
+        """Return a list of (start, stop, seconds per tick)
+        for the runs of rows from start up to stop.
+        """
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            return self._timebase.spans(start, stop)
+
+    def _num_samples(self, n, row):
+        """Number of samples of column n taken at rows before row."""
+        runs = self._runs[n]
+        if len(runs) == 1:
+            return _ceil_div(row, runs[0][1])
+        if row <= 0:
+            return 0
+        first_row, downsample, first_sample = next(
+                run for run in reversed(runs) if run[0] < row)
+        return first_sample + _ceil_div(row, downsample) - _ceil_div(first_row, downsample)
+
+    def _sample_rows(self, n, start, stop):
+        """Return the rows from start up to stop at which column n was sampled."""
+        runs = self._runs[n]
+        rows = []
+        for k, (first_row, downsample, first_sample) in enumerate(runs):
+            run_stop = runs[k+1][0] if k+1 < len(runs) else stop
+            lo = max(start, first_row)
+            hi = min(stop, run_stop)
+            if lo < hi:
+                rows.extend(range(_ceil_div(lo, downsample)*downsample, hi, downsample))
+        return rows
+
+    def append_rows(self, rows):
+        """Append a list of rows, each [timestamp, value for each channel]."""
+        if rows:
+            self.append_columns(list(zip(*rows)))
+
+    def append_columns(self, columns):
+        """Append rows given column by column:
+        columns[n] is a sequence (list, tuple, array, or NumPy array)
+        of the new values for column n.  All must be the same length.
+        For downsampled channels, only the values for rows
+        at multiples of the downsampling are kept.
+        """
+        first_index = self._len
+        for n, (col, values) in enumerate(zip(self.columns, columns)):
+            downsample = self._runs[n][-1][1]
+            if downsample > 1:
+                values = _select_downsampled(values, downsample, first_index)
+            _extend(col, values)
+            if n:
+                self._stats[n].add_many(values)
+        self._len += len(columns[0])
+        if (self.spill_rows is not None
+                and self._len - self._base >= self.spill_rows + self.SEGMENT_ROWS):
+            self._spill()
+
+    def _spill(self):
+        """Move the oldest rows in memory to disk, SEGMENT_ROWS at a time,
+        until at most spill_rows + SEGMENT_ROWS rows are left.
+        """
+        num_rows = self.SEGMENT_ROWS
+        with self.lock:
+            while self._len - self._base >= self.spill_rows + num_rows:
+                if (self._spill_file is None
+                        or self._spill_file.size >= _SpillFile.MAX_BYTES):
+                    self._spill_file = _SpillFile(self.spill_dir)
+                stop = self._base + num_rows
+                native_starts = list(self._native_base)
+                counts = [self._num_samples(n, stop) - native_starts[n]
+                          for n in range(len(self.columns))]
+                segment = _Segment(self._base, num_rows, self.columns,
+                                   native_starts, counts, self._spill_file)
+                for n, col in enumerate(self.columns):
+                    if isinstance(col, BitColumn):
+                        col.drop_front(counts[n])
+                    else:
+                        del col[:counts[n]]
+                    self._native_base[n] += counts[n]
+                self._segments.append(segment)
+                for n, first in enumerate(native_starts):
+                    self._segment_samples[n].append(first)
+                self._base = stop
+
+    def stats(self, n):
+        """Return the RunningStats for channel n (counting from 1)."""
+        return self._stats[n]
+
+    def _native(self, n, start, stop):
+        """Return samples start up to stop of column n."""
+        with self.lock:
+            base = self._native_base[n]
+            col = self.columns[n]
+            if start >= base:
+                return col[start-base:stop-base]
+            values = [] if col.typecode is None else array(col.typecode)
+            starts = self._segment_samples[n]
+            for segment in self._segments[max(bisect_right(starts, start) - 1, 0):]:
+                first = segment.native_starts[n]
+                if first >= stop:
+                    break
+                lo = max(start, first) - first
+                hi = min(stop, first + segment.counts[n]) - first
+                if lo >= hi:
+                    continue
+                piece = segment.get(n, lo, hi)
+                if col.typecode is None or piece.typecode == col.typecode:
+                    values.extend(piece)
+                else:
+                    values.extend(piece.tolist())
+            if stop > base:
+                values.extend(col[0:stop-base])
+            return values
+
+    def _rows(self, start, stop):
+        """Convert start and stop (None or negative as for slices) to row numbers."""
+        if stop is None:
+            stop = self._len
+        elif stop < 0:
+            stop += self._len
+        if start < 0:
+            start = max(start + self._len, 0)
+        return start, max(start, min(stop, self._len))
+
+    def column(self, n, start=0, stop=None):
+        """Return the values of column n (0 for timestamps)
+        for rows start up to (not including) stop,
+        holding the samples of downsampled channels over the rows between them.
+        """
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            if n == 0:
+                return self._timebase.seconds(self._native(0, start, stop), start)
+            if len(self._runs[n]) == 1 and self._runs[n][0][1] == 1:
+                return self._native(n, start, stop)
+            if start == stop:
+                return self.columns[n][0:0]
+            first = self._num_samples(n, start+1) - 1   # sample held at row start
+            rows = self._sample_rows(n, start+1, stop)
+            values = self._native(n, first, first + len(rows) + 1)
+        bounds = [start] + rows + [stop]
+        return _hold(values, [hi-lo for lo, hi in zip(bounds, bounds[1:])],
+                     self.columns[n].typecode)
+
+    def num_samples(self, n, start=0, stop=None):
+        """Return the number of samples of column n taken at rows start up to stop."""
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            return self._num_samples(n, stop) - self._num_samples(n, start)
+
+    def native_column(self, n, start=0, stop=None):
+        """Return the samples of column n taken at rows start up to stop
+        (all rows, unless the channel is downsampled).
+        """
+        if n == 0:
+            return self.column(0, start, stop)
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            return self._native(n, self._num_samples(n, start), self._num_samples(n, stop))
+
+    def ticks(self, start=0, stop=None):
+        """Return the timestamps of rows start up to stop as stored, in ticks."""
+        start, stop = self._rows(start, stop)
+        return self._native(0, start, stop)
+
+    def sample_ticks(self, n, start=0, stop=None):
+        """Return the timestamps, in ticks, of the samples native_column(n, start, stop)."""
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            ticks = self._native(0, start, stop)
+            if len(self._runs[n]) == 1 and self._runs[n][0][1] == 1:
+                return ticks
+            return array(ticks.typecode,
+                         (ticks[row-start] for row in self._sample_rows(n, start, stop)))
+
+    def sample_times(self, n, start=0, stop=None):
+        """Return the timestamps, in seconds, of the samples native_column(n, start, stop)."""
+        start, stop = self._rows(start, stop)
+        with self.lock:
+            times = self.column(0, start, stop)
+            if len(self._runs[n]) == 1 and self._runs[n][0][1] == 1:
+                return times
+            return array('d', (times[row-start] for row in self._sample_rows(n, start, stop)))
+
+    def packed(self, n, start, stop):
+        """Return the samples of digital column n taken at rows start up to stop,
+        packed into bytes (see BitColumn.packed).
+        """
+        with self.lock:
+            first = self._num_samples(n, start)
+            last = self._num_samples(n, stop)
+            base = self._native_base[n]
+            if first >= base:
+                return self.columns[n].packed(first-base, last-base)
+            values = self._native(n, first, last)
+        return BitColumn(np.asarray(values, dtype=bool) if np is not None else values
+                         ).packed(0, len(values))
+
+    def value(self, i, n):
+        """Return the value in row i of column n."""
+        if i < 0:
+            i += self._len
+        with self.lock:
+            sample = self._num_samples(n, i+1) - 1
+            if n == 0:
+                return self._native(0, i, i+1)[0] * self._timebase.scale_at(i)
+            return self._native(n, sample, sample+1)[0]
+
+    def set_value(self, i, n, value):
+        """Replace the value in row i of column n (updating its statistics).
+        For a downsampled channel, row i must be one at which it was sampled.
+        Timestamps (column 0) are given in ticks.
+        """
+        if i < 0:
+            i += self._len
+        with self.lock:
+            sample = self._num_samples(n, i)
+            if self._num_samples(n, i+1) == sample:
+                raise ValueError('channel {0} was not sampled at row {1}'.format(n, i))
+            old = self._native(n, sample, sample+1)[0]
+            if n:
+                self._stats[n].replace(old, value)
+            base = self._native_base[n]
+            if sample >= base:
+                self.columns[n][sample-base] = value
+            else:
+                segment = self._segments[bisect_right(self._segment_samples[n], sample) - 1]
+                segment.set(n, sample-segment.native_starts[n], value)
+
+    def row(self, i):
+        """Return row i as a list [timestamp, value for each channel]."""
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('SampleStore row out of range')
+        return [self.value(i, n) for n in range(len(self.columns))]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return [self.row(i) for i in range(start, stop, step)]
+            return [list(r) for r in
+                    zip(*[self.column(n, start, stop) for n in range(len(self.columns))])]
+        return self.row(index)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def nbytes(self):
+        """Approximate number of bytes of memory used for the sample data
+        (not counting rows moved to disk).
+        """
+        total = 0
+        for col in self.columns:
+            if isinstance(col, BitColumn):
+                total += len(col._bytes)
+            else:
+                total += len(col) * col.itemsize
+        return total
+
+
+class RingStore(object):
+    """Fixed-capacity store keeping only the latest capacity samples,
+    for monitoring indefinitely in constant memory.
+
+    The columns are allocated once, and used as circular buffers:
+    appending overwrites the oldest samples in place.
+    Rows are numbered as in a SampleStore of everything ever appended,
+    so len() keeps growing, but only rows first_row up to len() are retained.
+    Reads clip requests to the retained rows.
+    The statistics (WindowStats) cover just the retained rows;
+    they are recomputed from scratch each time the buffer wraps around,
+    so rounding errors from removing values cannot accumulate.
+
+    Downsampled channels are stored at the full rate,
+    with each sample held over the rows up to the next one.
+    Its GapIndex forgets gaps before the oldest retained row.
+
+    Appends and reads are done holding lock;
+    hold lock while reading several columns that must line up.
+    """
+    def __init__(self, channels=(), capacity=1 << 20):
+        """channels: list of ChannelDescriptors
+        capacity: number of samples retained (at least 8)
+        """
+        assert capacity >= 8
+        self.capacity = capacity
+        self.columns = [_frombytes(TICKS64, b'\0' * (8*capacity))]
+        self._timebase = _Timebase()
+        for ch in channels:
+            typecode = column_typecode(ch.interpretation)
+            if typecode is None:
+                self.columns.append(BitColumn.from_packed(b'\0' * ((capacity+7) >> 3), capacity))
+            else:
+                itemsize = array(typecode).itemsize
+                self.columns.append(_frombytes(typecode, b'\0' * (itemsize*capacity)))
+        self._stats = [None] + [WindowStats(lambda n=n: self.column(n))
+                                for n in range(1, len(self.columns))]
+        self._downsample = [1] + [max(1, ch.interpretation.downsample) for ch in channels]
+        self._len = 0
+        self.gaps = GapIndex()
+        self.lock = RLock()
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def num_channels(self):
+        return len(self.columns) - 1
+
+    @property
+    def first_row(self):
+        """Number of the oldest row retained."""
+        return max(0, self._len - self.capacity)
+
+    def reconfigure(self, channels):
+        """Adjust column types for a new configuration
+        with the same number of channels.
+        A column whose type changed is remade (losing its old values,
+        which are reported as 0 until overwritten).
+        """
+        assert len(channels) == self.num_channels
+        for n, ch in enumerate(channels, 1):
+            self._downsample[n] = max(1, ch.interpretation.downsample)
+            typecode = column_typecode(ch.interpretation)
+            if self.columns[n].typecode == typecode:
+                continue
+            with self.lock:
+                if typecode is None:
+                    self.columns[n] = BitColumn.from_packed(
+                            b'\0' * ((self.capacity+7) >> 3), self.capacity)
+                else:
+                    self.columns[n] = _frombytes(typecode,
+                            b'\0' * (array(typecode).itemsize*self.capacity))
+                self._stats[n].reset()
+
+    def set_timebase(self, scale, typecode):
+        """Set the seconds per tick of the timestamps appended from now on,
+        and their typecode (as for SampleStore.set_timebase).
+        """
+        with self.lock:
+            self._timebase.set_scale(self._len, scale)
+            col = self.columns[0]
+            if not self._len:
+                itemsize = array(typecode).itemsize
+                self.columns[0] = _frombytes(typecode, b'\0' * (itemsize*self.capacity))
+            elif col.typecode == 'I' and typecode != 'I':
+                self.columns[0] = array(typecode, col.tolist())
+
+    def time_scales(self, start=0, stop=None):
+        """Return a list of (start, stop, seconds per tick)
+        for the runs of retained rows from start up to stop.
+        """
+        with self.lock:
+            start, stop = self._clip(start, stop)
+            return self._timebase.spans(start, stop)
+
+    def append_rows(self, rows):
+        """Append a list of rows, each [timestamp, value for each channel]."""
+        if rows:
+            self.append_columns(list(zip(*rows)))
+
+    def append_columns(self, columns):
+        """Append rows given column by column (as for SampleStore.append_columns),
+        overwriting the oldest rows once the store is full.
+        """
+        num_new = len(columns[0])
+        capacity = self.capacity
+        with self.lock:
+            columns = list(columns)
+            for n, downsample in enumerate(self._downsample):
+                if downsample > 1:
+                    columns[n] = _hold_downsampled(columns[n], downsample, self._len,
+                                    self.value(-1, n) if self._len else None)
+            old_first = self.first_row
+            old_len = self._len
+            new_len = old_len + num_new
+            new_first = max(0, new_len - capacity)
+            num_lost = max(0, min(new_first, old_len) - old_first)
+            if num_new > capacity:
+                # only the last capacity rows can be kept
+                columns = [values[num_new-capacity:] for values in columns]
+                num_new = capacity
+            pos = (new_len - num_new) % capacity
+            split = min(num_new, capacity - pos)
+            for n, (col, values) in enumerate(zip(self.columns, columns)):
+                if n and num_lost:
+                    lost = self.column(n, old_first, old_first+num_lost)
+                    self._stats[n].remove_many(lost if np is None else np.asarray(lost))
+                self._write(col, pos, values[:split])
+                self._write(col, 0, values[split:])
+            self._len = new_len
+            if new_len // capacity != old_len // capacity and new_len > capacity:
+                # recompute the statistics exactly once per trip around the buffer
+                for n in range(1, len(self.columns)):
+                    values = self.columns[n]
+                    if np is not None:
+                        values = np.asarray(values[:] if isinstance(values, BitColumn)
+                                            else values)
+                    self._stats[n].reset()
+                    self._stats[n].add_many(values)
+            else:
+                for stats, values in zip(self._stats[1:], columns[1:]):
+                    stats.add_many(values)
+            gaps = self.gaps
+            if gaps.gaps and gaps.gaps[0][0] < new_first:
+                gaps.discard_before(new_first)
+            self._timebase.discard_before(new_first)
+
+    @staticmethod
+    def _write(col, start, values):
+        if not len(values):
+            return
+        if isinstance(col, BitColumn):
+            col.write(start, values)
+            return
+        if np is not None and isinstance(values, np.ndarray):
+            values = _frombytes(col.typecode, values.astype(col.typecode).tobytes())
+        elif not isinstance(values, array) or values.typecode != col.typecode:
+            values = array(col.typecode, values)
+        col[start:start+len(values)] = values
+
+    def stats(self, n):
+        """Return the WindowStats for channel n (counting from 1)."""
+        return self._stats[n]
+
+    def _clip(self, start, stop):
+        """Convert start and stop (None or negative as for slices)
+        to row numbers, clipped to the retained rows.
+        """
+        if stop is None:
+            stop = self._len
+        elif stop < 0:
+            stop += self._len
+        if start < 0:
+            start += self._len
+        first = self.first_row
+        return max(start, first), max(min(stop, self._len), first)
+
+    def column(self, n, start=0, stop=None):
+        """Return the values of column n (0 for timestamps, in seconds)
+        for rows start up to (not including) stop,
+        leaving out rows no longer retained.
+        """
+        with self.lock:
+            start, stop = self._clip(start, stop)
+            if n == 0:
+                return self._timebase.seconds(self._slice(0, start, stop), start)
+            return self._slice(n, start, stop)
+
+    def _slice(self, n, start, stop):
+        """Return column n as stored for retained rows start up to stop."""
+        with self.lock:
+            col = self.columns[n]
+            capacity = self.capacity
+            first, last = start % capacity, stop % capacity
+            if stop - start == 0:
+                return col[0:0]
+            if first < last or last == 0:
+                return col[first:last or capacity]
+            return col[first:] + col[:last]
+
+    def downsample(self, n):
+        """Downsampling of the samples stored in column n: always 1."""
+        return 1
+
+    native_column = column      # all channels are stored at the full rate
+
+    def ticks(self, start=0, stop=None):
+        """Return the timestamps of retained rows start up to stop as stored, in ticks."""
+        with self.lock:
+            start, stop = self._clip(start, stop)
+            return self._slice(0, start, stop)
+
+    def sample_ticks(self, n, start=0, stop=None):
+        """Return the timestamps, in ticks, of the samples native_column(n, start, stop)."""
+        return self.ticks(start, stop)
+
+    def num_samples(self, n, start=0, stop=None):
+        """Return the number of samples of column n retained from rows start up to stop."""
+        with self.lock:
+            start, stop = self._clip(start, stop)
+            return stop - start
+
+    def sample_times(self, n, start=0, stop=None):
+        """Return the timestamps of the samples native_column(n, start, stop)."""
+        return self.column(0, start, stop)
+
+    def packed(self, n, start, stop):
+        """Return digital column n for rows start up to stop
+        packed into bytes (see BitColumn.packed).
+        """
+        values = self.column(n, start, stop)
+        return BitColumn(np.asarray(values, dtype=bool) if np is not None else values
+                         ).packed(0, len(values))
+
+    def _index(self, i):
+        if i < 0:
+            i += self._len
+        if not self.first_row <= i < self._len:
+            raise IndexError('RingStore row {0} not retained'.format(i))
+        return i % self.capacity
+
+    def value(self, i, n):
+        """Return the value in row i of column n."""
+        with self.lock:
+            if n == 0:
+                if i < 0:
+                    i += self._len
+                return self.columns[0][self._index(i)] * self._timebase.scale_at(i)
+            return self.columns[n][self._index(i)]
+
+    def set_value(self, i, n, value):
+        """Replace the value in row i of column n (updating its statistics).
+        Timestamps (column 0) are given in ticks.
+        """
+        with self.lock:
+            i = self._index(i)
+            col = self.columns[n]
+            if n:
+                self._stats[n].remove_many([col[i]])
+                self._stats[n].add_many([value])
+            col[i] = value
+
+    def row(self, i):
+        """Return row i as a list [timestamp, value for each channel]."""
+        with self.lock:
+            if i < 0:
+                i += self._len
+            return [self.value(i, n) for n in range(len(self.columns))]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            with self.lock:
+                start, stop, step = index.indices(self._len)
+                if step != 1:
+                    return [self.row(i) for i in range(start, stop, step)
+                            if i >= self.first_row]
+                return [list(r) for r in
+                        zip(*[self.column(n, start, stop) for n in range(len(self.columns))])]
+        return self.row(index)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def nbytes(self):
+        """Number of bytes of memory used for the sample data (fixed)."""
+        total = 0
+        for col in self.columns:
+            if isinstance(col, BitColumn):
+                total += len(col._bytes)
+            else:
+                total += len(col) * col.itemsize
+        return total
@@ -0,0 +1,189 @@
+"""Handing live samples to Python code as they arrive.
+
+A SampleStream is fed by the acquisition thread (DataAcquisition.stream()
+creates one and notifies it after each batch of packets is stored),
+and yields SampleBlocks of block_size rows to whatever iterates over it:
+        for block in daq.stream(block_size=1024):
+            process(block.columns[0], block.columns[1])
+so the consumer neither polls nor rereads the whole store.
+
+At most max_blocks blocks wait between the two threads.
+When that many are waiting, the policy decides what happens:
+        'block'         the acquisition thread waits for the consumer
+                        (backpressure: the serial link stops being read,
+                        so a slow consumer eventually makes the board drop samples,
+                        which the GapIndex records)
+        'drop-oldest'   the oldest waiting block is discarded
+        'drop-newest'   the new block is discarded
+Discarded samples are counted in num_dropped, and show up as a jump
+between one block's stop and the next block's start.
+"""
+
+from __future__ import division, print_function
+
+from collections import namedtuple, deque
+from threading import Condition
+from timeit import default_timer as clock
+
+
+class SampleBlock(namedtuple('SampleBlock', ['start', 'columns'])):
+    """Consecutive rows of the store, from row start.
+    columns[0] is the timestamps (in seconds) and columns[n] is channel n,
+    as returned by the store's column() (so downsampled channels
+    hold each sample over the rows up to the next one).
+    """
+    __slots__ = ()
+
+    @property
+    def stop(self):
+        """Row number after the last row of the block."""
+        return self.start + len(self.columns[0])
+
+    @property
+    def num_rows(self):
+        return len(self.columns[0])
+
+
+class SampleStream(object):
+    """An iterator over the samples appended to a store from now on,
+    in blocks of block_size rows.
+
+    Iteration ends once close() has been called and the waiting blocks are used up.
+    Leaving a for loop over the stream early closes it.
+    """
+    POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, data, block_size=1024, max_blocks=16, policy='block',
+                 max_wait=None, call_on_close=None):
+        """data: the SampleStore or RingStore being filled
+        max_wait: if given, a block with fewer rows is yielded rather than
+                waiting more than max_wait seconds for rows to arrive
+        call_on_close: if given, called with the stream when it is closed
+        """
+        if policy not in self.POLICIES:
+            raise ValueError('policy must be one of {0}, not {1!r}'.format(
+                    ', '.join(self.POLICIES), policy))
+        if block_size < 1 or max_blocks < 1:
+            raise ValueError('block_size and max_blocks must be at least 1')
+        self.data = data
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.policy = policy
+        self.max_wait = max_wait
+        self.num_dropped = 0        # samples discarded by the policy (or overwritten)
+        self.next_row = len(data)   # first row not yet put in a block
+        self.closed = False
+        self._blocks = deque()
+        self._num_rows = self.next_row  # rows stored, as last notified
+        self._cond = Condition()
+        self._call_on_close = call_on_close
+
+    def notify(self, num_rows):
+        """Called (from the acquisition thread) with the number of rows stored.
+        Queues a block for every block_size new rows.
+        """
+        with self._cond:
+            self._num_rows = num_rows
+            self._skip_lost()
+            while not self.closed and num_rows - self.next_row >= self.block_size:
+                self._put(self._take(self.next_row + self.block_size))
+            if self.max_wait is not None:
+                self._cond.notify_all()
+
+    def flush(self):
+        """Queue any rows left over that do not fill a block
+        (DataAcquisition.stop() does this, so that no samples wait for the next run).
+        """
+        with self._cond:
+            self._skip_lost()
+            if not self.closed and self._num_rows > self.next_row:
+                self._put(self._take(self._num_rows))
+
+    def _skip_lost(self):
+        """Move next_row past (and count as dropped) any rows
+        that a RingStore has already overwritten.
+        """
+        first_row = self.data.first_row
+        if first_row > self.next_row:
+            self.num_dropped += first_row - self.next_row
+            self.next_row = first_row
+
+    def _take(self, stop):
+        """Return the block of rows next_row up to stop."""
+        data = self.data
+        start = self.next_row
+        with data.lock:
+            block = SampleBlock(start, [data.column(n, start, stop)
+                                        for n in range(data.num_channels + 1)])
+        self.next_row = stop
+        return block
+
+    def _put(self, block):
+        """Queue block, applying the policy if max_blocks are already waiting."""
+        blocks = self._blocks
+        if len(blocks) >= self.max_blocks:
+            if self.policy == 'block':
+                while len(blocks) >= self.max_blocks and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+            elif self.policy == 'drop-oldest':
+                self.num_dropped += blocks.popleft().num_rows
+            else:
+                self.num_dropped += block.num_rows
+                return
+        blocks.append(block)
+        self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Return the next block, waiting at most timeout seconds (default: forever),
+        or None if none arrives in time or the stream is closed and empty.
+        """
+        deadline = None if timeout is None else clock() + timeout
+        with self._cond:
+            waited_from = clock()
+            while not self._blocks:
+                if self.closed:
+                    return None
+                now = clock()
+                if self.max_wait is not None and now - waited_from >= self.max_wait:
+                    self._skip_lost()
+                    if self._num_rows > self.next_row:
+                        return self._take(self._num_rows)
+                wait = self.max_wait
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._cond.wait(wait)
+            block = self._blocks.popleft()
+            self._cond.notify_all()     # room for a waiting producer
+            return block
+
+    def __iter__(self):
+        try:
+            while True:
+                block = self.get()
+                if block is None:
+                    return
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop queueing blocks, releasing the acquisition thread if it is waiting.
+        Blocks already queued can still be read.
+        """
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        if self._call_on_close is not None:
+            self._call_on_close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()